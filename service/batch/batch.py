@@ -0,0 +1,273 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+"""Bulk generation of weather and recommendations through the Batch API.
+
+Submit a batch for every trip, then collect finished batches later:
+    $ python -m service.batch.batch submit weather
+    $ python -m service.batch.batch submit recommendation --limit 100
+    $ python -m service.batch.batch collect
+
+--local runs the requests through LocalBatchClient, which answers them
+with placeholder replies instead of calling the model, and collects them
+right away. It exercises the submit and collect steps end to end, other
+open batches are left for a collect without --local.
+"""
+
+from types import SimpleNamespace
+import argparse
+import uuid
+
+from service.prompt import prompt
+from service.prompt import planner
+from service.routing import routing
+from service.destination import destination as places
+from service.postgres.postgresdb import PostgresDB
+from service.serializer import serializer
+
+# message categories of batch results in Postgres's messages table
+WEATHER = "WEATHER"                 # hourly forecast for the destination
+RECOMMENDATION = "RECOMMENDATION"   # event recommendations for the itinerary
+
+BATCH_KINDS = {
+    "weather": WEATHER,
+    "recommendation": RECOMMENDATION
+}
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# provider statuses after which a batch won't change anymore
+BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+
+# Placeholder reply of LocalBatchClient, a JSON object so it also passes
+#   for routes asking for json_object responses
+def localCompletion(body):
+    return serializer.encode({
+        "local": True,
+        "model": body.get("model"),
+        "max_tokens": body.get("max_tokens")
+    }).decode()
+
+
+###########################################################
+#
+#  Local stand-in for the provider's files and batches API
+#
+#  Runs each request through 'complete' (a function taking a
+#  chat completion request body and returning the reply text,
+#  localCompletion by default) as soon as the batch is created.
+#
+###########################################################
+class LocalBatchClient():
+
+    def __init__(self, complete=localCompletion) -> None:
+        self.complete = complete
+        self.uploads = {}
+        self.jobs = {}
+        self.files = SimpleNamespace(create=self._create_file,
+                                     content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch,
+                                       retrieve=self._retrieve_batch)
+
+    def _create_file(self, file, purpose):
+        file_id = f"file-local-{uuid.uuid4().hex}"
+        self.uploads[file_id] = file[1]
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        return SimpleNamespace(text=self.uploads[file_id].decode())
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        output = []
+        for line in self.uploads[input_file_id].decode().splitlines():
+            request = serializer.decode(line)
+            body = {
+                "choices": [{
+                    "index": 0,
+                    "finish_reason": "stop",
+                    "message": {
+                        "role": "assistant",
+                        "content": self.complete(request["body"])
+                    }
+                }]
+            }
+            output.append(serializer.encode({
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": body},
+                "error": None
+            }))
+
+        output_file_id = f"file-local-{uuid.uuid4().hex}"
+        self.uploads[output_file_id] = b"\n".join(output)
+        job = SimpleNamespace(id=f"batch-local-{uuid.uuid4().hex}",
+                              status="completed",
+                              output_file_id=output_file_id)
+        self.jobs[job.id] = job
+        return job
+
+    # only batches of this process are known, others may be provider
+    #   batches still running, see run()
+    def _retrieve_batch(self, batch_id):
+        return self.jobs[batch_id]
+
+
+# Builds the chat completion request body of a trip
+# returns None when the trip has nothing to generate from
+def buildRequest(p, postgressconn, kind, trip):
+    trip_id, destination = trip[0], trip[2]
+
+    if kind == "weather":
+        # trips keep the destination as typed, see main.initialRequest
+        messages = p.getHourlyForcast(places.canonicalize(destination))
+    else:
+        messages = postgressconn.get_chat_history(trip_id)
+        if not messages:
+            return None
+        messages.append({
+            "role": "user",
+            "content": [{
+                "type": "text",
+                "text": p.getTravelRecommendation()
+            }]
+        })
+
+    # sized like the live routes' requests, batches can't continue a reply
+    #   cut off by max_tokens
+    params = routing.getChatParams(kind, messages)
+    params.update(planner.planOutput(kind, model=params.get("model")))
+    return dict(params, messages=messages)
+
+
+###########################################################
+#
+#  Submits one batch with a request for every trip
+#
+#  Receives:
+#   - client:   OpenAI client or LocalBatchClient
+#   - kind:     "weather" or "recommendation"
+#   - limit:    maximum number of trips, all trips when None
+#
+#  Returns:
+#   - the batch id, None if there was nothing to submit
+#
+###########################################################
+def submitBatch(client, postgressconn, kind, limit=None):
+    p = prompt.Prompt()
+    trips = postgressconn.get_all_trips() or []
+    if limit is not None:
+        trips = trips[:limit]
+
+    lines = []
+    for trip in trips:
+        body = buildRequest(p, postgressconn, kind, trip)
+        if body is None:
+            continue
+        lines.append(serializer.encode({
+            "custom_id": f"{kind}-{trip[0]}",
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": body
+        }))
+
+    if not lines:
+        print(f"Batch: no {kind} requests to submit")
+        return None
+
+    upload = client.files.create(file=(f"{kind}.jsonl", b"\n".join(lines)),
+                                 purpose="batch")
+    job = client.batches.create(input_file_id=upload.id,
+                                endpoint=BATCH_ENDPOINT,
+                                completion_window="24h")
+
+    postgressconn.create_batch_to_db(job.id, kind, job.status, len(lines))
+    print(f"Batch: submitted {len(lines)} {kind} requests as {job.id}")
+    return job.id
+
+
+# Writes the results of a completed batch to the 'messages' table
+#   results written by an earlier, interrupted run are skipped
+# returns the number of messages written
+def writeResults(client, postgressconn, kind, batch_id, output_file_id):
+    written = 0
+    content = client.files.content(output_file_id).text
+
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        result = serializer.decode(line)
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            print(f"Batch: {result['custom_id']} failed: "
+                  f"{result.get('error')}")
+            continue
+
+        trip_id = int(result["custom_id"].rsplit("-", 1)[1])
+        choice = response["body"]["choices"][0]
+        message = choice["message"]
+        if choice.get("finish_reason") == "length":
+            print(f"Batch: {result['custom_id']} hit max_tokens, "
+                  f"its reply is cut off")
+        message_id = postgressconn.create_batch_message(
+            batch_id, result["custom_id"], trip_id, message["role"],
+            message["content"], BATCH_KINDS[kind])
+        if message_id is not None:
+            written += 1
+
+    return written
+
+
+# Polls every open batch, writing results of the completed ones
+#   batch_ids limits polling to those batches when given
+def collectBatches(client, postgressconn, batch_ids=None):
+    for batch_id, kind, status, request_count, output_file_id in \
+            postgressconn.get_open_batches() or []:
+        if batch_ids is not None and batch_id not in batch_ids:
+            continue
+        job = client.batches.retrieve(batch_id)
+
+        if job.status != status or job.output_file_id != output_file_id:
+            postgressconn.update_batch_status(batch_id, job.status,
+                                              job.output_file_id)
+
+        if job.status == "completed" and job.output_file_id:
+            written = writeResults(client, postgressconn, kind, batch_id,
+                                   job.output_file_id)
+            postgressconn.update_batch_status(batch_id, "written",
+                                              job.output_file_id)
+            print(f"Batch: wrote {written}/{request_count} {kind} results "
+                  f"of {batch_id}")
+        elif job.status not in BATCH_DONE:
+            print(f"Batch: {batch_id} is still {job.status}")
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=("submit", "collect"))
+    parser.add_argument("kind", nargs="?", choices=tuple(BATCH_KINDS))
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--local", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "submit" and args.kind is None:
+        parser.error("submit needs a kind")
+
+    if args.local:
+        client = LocalBatchClient()
+    else:
+        client = prompt.Prompt().client
+
+    postgressconn = PostgresDB()
+    if args.command == "submit":
+        submitBatch(client, postgressconn, args.kind, args.limit)
+    # the local stand-in only keeps its results in memory, it collects
+    #   the batch it just submitted and leaves every other batch open
+    if args.local:
+        collectBatches(client, postgressconn, client.jobs)
+    elif args.command == "collect":
+        collectBatches(client, postgressconn)
+    postgressconn.close_db_connection()
+
+
+if __name__ == '__main__':
+    run()
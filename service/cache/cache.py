@@ -0,0 +1,149 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+from service.serializer import serializer
+
+load_dotenv()
+
+# memory budget and time-to-live of the database read cache
+#   other gunicorn workers' writes drop entries through Postgres NOTIFY
+#   (see postgresdb.CACHE_NOTIFY), the TTL bounds how stale a copy can get
+#   when a notification is missed
+DB_CACHE_MAX_BYTES = int(os.getenv('DB_CACHE_MAX_BYTES', str(32 * 1024 ** 2)))
+DB_CACHE_TTL = float(os.getenv('DB_CACHE_TTL', '300'))
+
+# memory budget and time-to-live of the conversation cache of active trips
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv('CONVERSATION_CACHE_MAX_BYTES',
+                                             str(64 * 1024 ** 2)))
+CONVERSATION_CACHE_TTL = float(os.getenv('CONVERSATION_CACHE_TTL', '900'))
+
+
+# Approximate memory used by a cached value: the size of its JSON encoding
+def sizeof(value):
+    return len(serializer.encode(value))
+
+
+###########################################################
+#
+#  Thread-safe LRU cache bounded by total value size.
+#
+#  Keys are tuples whose first item is the kind of value
+#  ("trip", "itinerary", "profile"...), hits and misses are
+#  counted per kind for the metrics route.
+#
+###########################################################
+class LRUCache():
+
+    def __init__(self, max_bytes, ttl=None, sizeof=sizeof) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()    # key -> (value, size, expires)
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    # Returns the cached value for key, or None on a miss
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and \
+                    entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            counter = self.misses if entry is None else self.hits
+            counter[key[0]] = counter.get(key[0], 0) + 1
+
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    # Stores value under key, evicting least recently used entries
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    # Appends item to the list cached under key, a miss is left as is
+    #   the list is replaced, not modified, so values handed out by get
+    #   never change under the caller
+    # returns True if the item was appended
+    def append(self, key, item):
+        size = self.sizeof(item)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            value, old_size, expires = entry
+            self.entries[key] = (value + [item], old_size + size, expires)
+            self.entries.move_to_end(key)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+
+    # Drops key from the cache, if present
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    # Returns hit-rate metrics per kind of value
+    def stats(self):
+        with self.lock:
+            kinds = {}
+            for kind in set(self.hits) | set(self.misses):
+                hits = self.hits.get(kind, 0)
+                misses = self.misses.get(kind, 0)
+                kinds[kind] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": hits / (hits + misses)
+                }
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "kinds": kinds
+            }
+
+
+# per-worker cache in front of PostgresDB's trip, itinerary and profile reads
+db_cache = LRUCache(DB_CACHE_MAX_BYTES, ttl=DB_CACHE_TTL)
+
+# per-worker cache of the chat history of recently active trips, kept apart
+#   from db_cache so long conversations don't evict trips and profiles
+conversation_cache = LRUCache(CONVERSATION_CACHE_MAX_BYTES,
+                              ttl=CONVERSATION_CACHE_TTL)
@@ -0,0 +1,75 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+import threading
+
+
+###########################################################
+#
+#  A request in progress, shared by the identical requests
+#  that arrive before it finishes
+#
+###########################################################
+class Flight():
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+flights = {}    # key -> Flight of this worker
+flights_lock = threading.Lock()
+
+coalesce_stats = {"leaders": 0, "followers": 0}
+
+
+###########################################################
+#
+#  Runs func once for identical concurrent requests
+#
+#  Receives:
+#   - key:   what makes two requests identical, e.g.
+#            ("update", trip_id)
+#   - func:  function doing the request's work
+#
+#  Returns:
+#   - func's result; requests arriving while it runs wait
+#     and get the same result (or error) instead of running
+#     func again
+#
+#  Only coalesces within this worker, PostgresDB.lock_trip
+#  serializes the requests of a trip across workers.
+#
+###########################################################
+def coalesce(key, func):
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = flights[key] = Flight()
+        coalesce_stats["leaders" if leader else "followers"] += 1
+
+    if not leader:
+        print(f"Coalesce: {key} joins the request in progress")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = func()
+        return flight.result
+    except Exception as error:
+        flight.error = error
+        raise
+    finally:
+        with flights_lock:
+            flights.pop(key, None)
+        flight.done.set()
+
+
+# Returns how many requests ran and how many reused another's result
+def stats():
+    with flights_lock:
+        return dict(coalesce_stats, in_progress=len(flights))
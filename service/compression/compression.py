@@ -0,0 +1,176 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from dotenv import load_dotenv
+from flask import request
+import threading
+import zlib
+import os
+
+from service.cache.cache import LRUCache
+
+# brotli and zstd are used when their packages are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+load_dotenv()
+
+# responses smaller than this are sent as they are
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+
+# memory budget of compressed bodies kept for responses with an ETag
+COMPRESSED_CACHE_MAX_BYTES = int(os.getenv('COMPRESSED_CACHE_MAX_BYTES',
+                                           str(16 * 1024 ** 2)))
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE = ("application/json", "text/plain", "text/html")
+
+# encodings this worker can produce, preferred first when the client
+#   accepts several with the same quality
+ENCODINGS = tuple(encoding for encoding, available in
+                  (("zstd", zstandard is not None),
+                   ("br", brotli is not None),
+                   ("gzip", True)) if available)
+
+# compressed bodies by ("compressed", path, ETag, encoding): a body with
+#   the same ETag is the same body, so it is compressed once
+compressed_cache = LRUCache(COMPRESSED_CACHE_MAX_BYTES, sizeof=len)
+
+compression_stats = {
+    "responses": 0,
+    "bytes_in": 0,
+    "bytes_out": 0
+}
+stats_lock = threading.Lock()
+
+
+# Compresses a whole body
+def compressBody(data, encoding):
+    match(encoding):
+        case "zstd":
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        case "br":
+            return brotli.compress(data, quality=BROTLI_QUALITY)
+        case _:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+
+
+# Returns (compress, finish) functions of a streaming compressor, compress
+#   flushes every chunk so the client can decode it as soon as it arrives
+def streamCompressor(encoding):
+    match(encoding):
+        case "zstd":
+            compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL).compressobj()
+
+            def compress(chunk):
+                return compressor.compress(chunk) + compressor.flush(
+                    zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            return compress, compressor.flush
+        case "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+            def compress(chunk):
+                return compressor.process(chunk) + compressor.flush()
+            return compress, compressor.finish
+        case _:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+            def compress(chunk):
+                return compressor.compress(chunk) + compressor.flush(
+                    zlib.Z_SYNC_FLUSH)
+            return compress, compressor.flush
+
+
+# Compresses a streamed body chunk by chunk
+def compressStream(chunks, encoding):
+    compress, finish = streamCompressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        yield compress(chunk)
+    yield finish()
+
+
+# Returns the ETags a client may send back for an ETag: the ETag itself
+#   and the ETag of each compressed variant
+def etagVariants(etag):
+    return [etag] + [f"{etag}-{encoding}" for encoding in ENCODINGS]
+
+
+###########################################################
+#
+#  after_request hook compressing responses in the encoding
+#  the client prefers (Accept-Encoding)
+#
+#  Skipped for small bodies, files (send_file), partial and
+#  empty responses, and bodies that aren't text or JSON.
+#  A compressed variant gets its own ETag: "<etag>-<encoding>"
+#
+###########################################################
+def compressResponse(response):
+    if response.status_code < 200 or \
+            response.status_code in (204, 206, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers or \
+            response.mimetype not in COMPRESSIBLE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compressStream(response.response, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers.pop('Content-Length', None)
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    etag, weak = response.get_etag()
+    key = None if etag is None else \
+        ("compressed", request.path, etag, encoding)
+    body = None if key is None else compressed_cache.get(key)
+    if body is None:
+        body = compressBody(data, encoding)
+        if key is not None:
+            compressed_cache.put(key, body)
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag is not None:
+        response.set_etag(f"{etag}-{encoding}", weak)
+
+    with stats_lock:
+        compression_stats["responses"] += 1
+        compression_stats["bytes_in"] += len(data)
+        compression_stats["bytes_out"] += len(body)
+    return response
+
+
+# Returns compression ratios and the compressed body cache's hit rates
+def stats():
+    with stats_lock:
+        result = dict(compression_stats)
+    result["encodings"] = list(ENCODINGS)
+    result["cache"] = compressed_cache.stats()
+    return result
+
+
+def init_app(app):
+    app.after_request(compressResponse)
@@ -0,0 +1,130 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from dotenv import load_dotenv
+import unicodedata
+import threading
+import sys
+import os
+import re
+
+from service.serializer import serializer
+
+load_dotenv()
+
+# canonical place names and their aliases, see aliases.json
+ALIASES_FILE = os.getenv('DESTINATION_ALIASES_FILE',
+                         os.path.join(os.path.dirname(__file__),
+                                      'aliases.json'))
+
+# distinct raw strings remembered per canonical place for the stats
+STATS_MAX_RAW = 1000
+
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+# Normalizes free text: "  New York, NY " -> "new york ny"
+#   accents are dropped so "Zürich" and "Zurich" match
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(PUNCTUATION.sub(' ', text.lower()).split())
+
+
+###########################################################
+#
+#  Alias index: normalized alias -> canonical place name
+#
+#  Loaded once, the canonical names are interned so the
+#  index holds a single copy of each.
+#
+###########################################################
+class DestinationIndex():
+
+    def __init__(self, path) -> None:
+        self.index = {}
+        self.canonical_tokens = {}  # canonical -> its normalized tokens
+        self.raw_seen = {}          # canonical -> distinct raw strings
+        self.unmatched = 0
+        self.lock = threading.Lock()
+
+        try:
+            with open(path, 'rb') as f:
+                aliases = serializer.decode(f.read())
+        except (OSError, ValueError) as error:
+            print(f"Destination: could not load {path}: {error}")
+            aliases = {}
+
+        for canonical, names in aliases.items():
+            canonical = sys.intern(canonical)
+            normalized = normalize(canonical)
+            self.canonical_tokens[canonical] = frozenset(normalized.split())
+            # the canonical name, its city part and every alias
+            for name in [canonical, canonical.split(',')[0]] + names:
+                self.index.setdefault(normalize(name), canonical)
+
+    # Finds the canonical place of a normalized string
+    #   "tokyo japan" matches "Tokyo, Japan" through "tokyo" because the
+    #   dropped words are part of the canonical name, "paris texas"
+    #   doesn't match "Paris, France"
+    def lookup(self, normalized):
+        canonical = self.index.get(normalized)
+        if canonical is not None:
+            return canonical
+
+        tokens = normalized.split()
+        for end in range(len(tokens) - 1, 0, -1):
+            canonical = self.index.get(' '.join(tokens[:end]))
+            if canonical is not None:
+                if set(tokens[end:]) <= self.canonical_tokens[canonical]:
+                    return canonical
+                return None
+        return None
+
+    # Returns the canonical name of a destination, or the cleaned
+    #   original text when the place isn't known
+    def canonicalize(self, destination):
+        if destination is None:
+            return None
+        cleaned = ' '.join(str(destination).split())
+        canonical = self.lookup(normalize(cleaned))
+
+        with self.lock:
+            if canonical is None:
+                self.unmatched += 1
+                return cleaned
+            seen = self.raw_seen.setdefault(canonical, set())
+            if len(seen) < STATS_MAX_RAW:
+                seen.add(cleaned)
+        return canonical
+
+    # Returns the canonical name of a known destination, None otherwise
+    def find(self, destination):
+        if destination is None:
+            return None
+        return self.lookup(normalize(destination))
+
+    # Returns how many distinct raw strings collapsed to each place
+    def stats(self):
+        with self.lock:
+            places = {canonical: len(seen)
+                      for canonical, seen in self.raw_seen.items()}
+            return {
+                "aliases": len(self.index),
+                "unmatched": self.unmatched,
+                "raw_strings_per_place": dict(
+                    sorted(places.items(), key=lambda item: -item[1]))
+            }
+
+
+destination_index = DestinationIndex(ALIASES_FILE)
+
+
+# Returns the canonical name of a destination, see DestinationIndex
+def canonicalize(destination):
+    return destination_index.canonicalize(destination)
+
+
+# Returns the canonical name of a known destination, see DestinationIndex
+def find(destination):
+    return destination_index.find(destination)
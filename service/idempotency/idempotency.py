@@ -0,0 +1,199 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from dotenv import load_dotenv
+from flask import Response, g, request
+import threading
+import hashlib
+import time
+import os
+
+from service.postgres.postgresdb import PostgresDB
+
+load_dotenv()
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+# seconds a completed response is replayed for
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))
+
+# seconds a request in progress holds its key, another request takes the
+#   key over after that in case the worker died
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '600'))
+
+# seconds a retry waits for the request in progress before it gets a 409
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', '60'))
+
+POLL_INTERVAL = 0.25
+
+# seconds between deletions of expired keys by this worker
+CLEANUP_INTERVAL = 3600
+
+ERROR_INVALID_KEY = {
+    "svc": "prompt-svc",
+    "Error": "The Idempotency-Key header is invalid"
+}
+
+ERROR_KEY_REUSED = {
+    "svc": "prompt-svc",
+    "Error": "The Idempotency-Key was used with a different request body"
+}
+
+ERROR_IN_PROGRESS = {
+    "svc": "prompt-svc",
+    "Error": "A request with this Idempotency-Key is still in progress"
+}
+
+idempotency_stats = {"claimed": 0, "replayed": 0, "in_progress": 0,
+                     "reused": 0}
+stats_lock = threading.Lock()
+last_cleanup = time.monotonic()
+
+
+def count(name):
+    with stats_lock:
+        idempotency_stats[name] += 1
+
+
+# Key of a request: the same header value from another user or on another
+#   route is another request
+def requestKey(key):
+    user = request.headers.get('Authorization', '')
+    scope = f"{user}\n{request.method} {request.path}\n{key}"
+    return hashlib.sha256(scope.encode()).digest()
+
+
+###########################################################
+#
+#  Runs before every POST request with an Idempotency-Key
+#
+#  Returns:
+#   - None when the request claimed its key and runs, its
+#     response is stored by storeResponse
+#   - the stored response of the request that used the key
+#     first, waiting up to IDEMPOTENCY_WAIT seconds for it
+#     to complete
+#   - 409 if it is still in progress after that, 422 if the
+#     key was used with another request body
+#
+#  Requests run without idempotency if the database fails.
+#
+###########################################################
+def claimRequest():
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if request.method != 'POST' or key is None:
+        return None
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return (ERROR_INVALID_KEY, 400)
+
+    request_key = requestKey(key)
+    request_hash = hashlib.sha256(request.get_data()).digest()
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+
+    postgressconn = PostgresDB()
+    claimed = False
+    try:
+        while True:
+            claimed = postgressconn.claim_idempotency_key(
+                request_key, request_hash, IDEMPOTENCY_LOCK_TIMEOUT)
+            if claimed is None:
+                return None
+            if claimed:
+                count("claimed")
+                g.idempotency = (postgressconn, request_key)
+                return None
+
+            row = postgressconn.get_idempotency_key(request_key)
+            if row is None:
+                # released or expired since the claim, claim it again
+                continue
+            stored_hash, status, status_code, content_type, body = row
+
+            if bytes(stored_hash) != request_hash:
+                count("reused")
+                return (ERROR_KEY_REUSED, 422)
+
+            if status == 'complete':
+                count("replayed")
+                print(f"Idempotency: replaying {request.path}")
+                response = Response(bytes(body), status=status_code,
+                                    content_type=content_type)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            if time.monotonic() >= deadline:
+                count("in_progress")
+                return (ERROR_IN_PROGRESS, 409, {"Retry-After": "1"})
+            time.sleep(POLL_INTERVAL)
+
+    finally:
+        if not claimed:
+            postgressconn.close_db_connection()
+
+
+# Stores the response of a request that claimed its key
+#   failed requests release the key instead, so a retry runs again
+def storeResponse(response):
+    claim = g.pop('idempotency', None)
+    if claim is None:
+        return response
+
+    postgressconn, request_key = claim
+    try:
+        if isFailure(response) or response.is_streamed:
+            postgressconn.release_idempotency_key(request_key)
+        else:
+            postgressconn.complete_idempotency_key(
+                request_key, response.status_code, response.content_type,
+                response.get_data(), IDEMPOTENCY_TTL)
+        deleteExpiredKeys(postgressconn)
+    finally:
+        postgressconn.close_db_connection()
+    return response
+
+
+# Returns True for server errors, and for model failures, which the chat,
+#   itinerary and update routes send as 200s with an "error" field
+def isFailure(response):
+    if response.status_code >= 500:
+        return True
+    if response.is_streamed or not response.is_json:
+        return False
+    body = response.get_json(silent=True)
+    return isinstance(body, dict) and "error" in body
+
+
+# Releases the key of a request that ended without a response
+def releaseRequest(error):
+    claim = g.pop('idempotency', None)
+    if claim is not None:
+        postgressconn, request_key = claim
+        postgressconn.release_idempotency_key(request_key)
+        postgressconn.close_db_connection()
+
+
+# Deletes expired keys, at most once per CLEANUP_INTERVAL per worker
+def deleteExpiredKeys(postgressconn):
+    global last_cleanup
+    with stats_lock:
+        if time.monotonic() - last_cleanup < CLEANUP_INTERVAL:
+            return
+        last_cleanup = time.monotonic()
+    postgressconn.delete_expired_idempotency_keys()
+
+
+# Returns how many requests claimed a key and how many retries were
+#   answered from a stored response
+def stats():
+    with stats_lock:
+        return dict(idempotency_stats)
+
+
+# storeResponse has to see the response before compression, so init_app
+#   is called after compression.init_app (after_request functions run in
+#   reverse order)
+def init_app(app):
+    app.before_request(claimRequest)
+    app.after_request(storeResponse)
+    app.teardown_request(releaseRequest)
@@ -0,0 +1,177 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import threading
+import hashlib
+import time
+import os
+
+from service.prompt import prompt
+from service.destination import destination as places
+
+load_dotenv()
+
+# generated images, one file per normalized prompt and size
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR',
+                            os.path.join('instance', 'images'))
+
+# bytes of images kept on disk, the least recently served are removed
+#   once a new image takes the cache over it
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_BYTES',
+                                      str(512 * 1024 * 1024)))
+
+# sizes the image model accepts
+IMAGE_SIZES = ("256x256", "512x512", "1024x1024")
+DEFAULT_IMAGE_SIZE = "512x512"
+
+# seconds after which a claim on a generation is taken over, in case the
+#   worker that claimed it died
+IMAGE_CLAIM_TIMEOUT = 120
+
+PROMPT_DESTINATION_IMAGE = """A bright travel photograph of {destination},
+                           showing its best known sights, no text."""
+
+# images are generated off the request thread
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="image")
+
+pending = {}    # key -> Future of generations started by this worker
+failures = {}   # key -> error of the last failed generation
+pending_lock = threading.Lock()
+
+
+# Returns the image prompt for a canonical destination, see places.find
+def destinationPrompt(destination):
+    return prompt.cleanString(PROMPT_DESTINATION_IMAGE.format(
+        destination=destination))
+
+
+# Content address of an image: same prompt text and size, same file
+def imageKey(text, size):
+    content = f"{places.normalize(text)}|{size}"
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def imagePath(key):
+    return os.path.join(IMAGE_CACHE_DIR, key[:2], f"{key}.png")
+
+
+# Claims the generation of an image across workers with an O_EXCL file
+# returns False if another worker is generating it
+def claim(key):
+    path = imagePath(key) + ".claim"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        try:
+            if os.stat(path).st_mtime < time.time() - IMAGE_CLAIM_TIMEOUT:
+                os.remove(path)
+        except OSError:
+            pass
+        return False
+
+
+def release(key):
+    try:
+        os.remove(imagePath(key) + ".claim")
+    except OSError:
+        pass
+
+
+# Removes the least recently served images until the cache fits in
+#   max_bytes, their modification time is bumped when served
+# returns the number of images removed
+def evict(max_bytes=IMAGE_CACHE_MAX_BYTES):
+    images = []
+    for root, _, names in os.walk(IMAGE_CACHE_DIR):
+        for name in names:
+            if not name.endswith('.png'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            images.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in images)
+    removed = 0
+    for _, size, path in sorted(images):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+def generate(key, text, size):
+    path = imagePath(key)
+    try:
+        data = prompt.Prompt().promptImageBytes(text, size)
+        # written under another name first, so readers never see half
+        #   an image
+        partial = f"{path}.{os.getpid()}.part"
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, path)
+        print(f"Images: stored {len(data)} bytes as {key}")
+        removed = evict()
+        if removed:
+            print(f"Images: removed {removed} least recently served")
+    except Exception as error:
+        print(f"Images: could not generate {key}: {error}")
+        with pending_lock:
+            failures[key] = str(error)
+    finally:
+        release(key)
+        with pending_lock:
+            pending.pop(key, None)
+
+
+###########################################################
+#
+#  Looks up an image, starting its generation if needed
+#
+#  Receives:
+#   - text:  image prompt
+#   - size:  one of IMAGE_SIZES
+#
+#  Returns:
+#   - ("ready", key), the PNG file is at imagePath(key)
+#   - ("pending", key) while it is being generated
+#   - ("failed", error) once after a failed generation,
+#     the next lookup tries again
+#
+#  An image that exists on disk is not generated again until
+#  evict removes it.
+#
+###########################################################
+def requestImage(text, size):
+    key = imageKey(text, size)
+    path = imagePath(key)
+    try:
+        # marks it recently served, see evict
+        os.utime(path)
+        return ("ready", key)
+    except OSError:
+        pass
+
+    with pending_lock:
+        if key in failures:
+            return ("failed", failures.pop(key))
+        if key in pending:
+            return ("pending", key)
+        if claim(key):
+            # another worker may have finished it since the first check
+            if os.path.exists(path):
+                release(key)
+                return ("ready", key)
+            pending[key] = executor.submit(generate, key, text, size)
+    return ("pending", key)
@@ -0,0 +1,113 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from dotenv import load_dotenv
+import os
+
+from service.serializer import serializer
+
+load_dotenv()
+
+# every SNAPSHOT_INTERVAL-th version of a trip's itinerary is stored whole,
+#   the versions in between as deltas, so rebuilding any version applies at
+#   most SNAPSHOT_INTERVAL - 1 deltas
+SNAPSHOT_INTERVAL = int(os.getenv('ITINERARY_SNAPSHOT_INTERVAL', '10'))
+
+
+# Reads an itinerary reply as a {"Day 1": [...], ...} dictionary
+#   text around the JSON object (markdown fences) is ignored
+# returns None if the reply isn't a JSON object
+def parseItinerary(text):
+    if not text:
+        return None
+    start, end = text.find('{'), text.rfind('}')
+    if start < 0 or end < start:
+        return None
+    try:
+        itinerary = serializer.decode(text[start:end + 1])
+    except ValueError:
+        return None
+    return itinerary if isinstance(itinerary, dict) else None
+
+
+###########################################################
+#
+#  Structural delta between two itineraries
+#
+#  Receives:
+#   - old, new:  itinerary dictionaries
+#
+#  Returns:
+#   - {"set": {day: events of added or changed days},
+#      "remove": [removed days],
+#      "order": [every day of new], only when applying set and
+#               remove to old wouldn't give new's day order}
+#
+###########################################################
+def makeDelta(old, new):
+    delta = {
+        "set": {day: events for day, events in new.items()
+                if old.get(day) != events},
+        "remove": [day for day in old if day not in new]
+    }
+    if list(applyDelta(old, delta)) != list(new):
+        delta["order"] = list(new)
+    return delta
+
+
+# Returns a new itinerary with delta applied to base
+def applyDelta(base, delta):
+    itinerary = {day: events for day, events in base.items()
+                 if day not in delta["remove"]}
+    itinerary.update(delta["set"])
+    if "order" in delta:
+        itinerary = {day: itinerary[day] for day in delta["order"]}
+    return itinerary
+
+
+# Returns how a version is stored: (is_snapshot, body)
+#   previous is the text of the trip's previous version, None for the first
+def encodeVersion(version, previous, text):
+    old, new = parseItinerary(previous), parseItinerary(text)
+    if version % SNAPSHOT_INTERVAL == 1 or old is None or new is None:
+        return (True, text)
+
+    body = serializer.encode(makeDelta(old, new)).decode()
+    # a delta of a mostly rewritten itinerary can outgrow the itinerary
+    if len(body) >= len(text):
+        return (True, text)
+    return (False, body)
+
+
+# Rebuilds the text of the last version in rows
+#   rows are (version, is_snapshot, body), in version order, from the
+#   closest snapshot on
+# returns a snapshot byte for byte as stored, a version rebuilt from deltas
+#   normalized: its itinerary as compact JSON, without the reply's
+#   whitespace or the text around the object. The ITINERARY message keeps
+#   the reply exactly as it was sent.
+def reconstruct(rows):
+    if not rows or not rows[0][1]:
+        return None
+    if len(rows) == 1:
+        return rows[0][2]
+
+    itinerary = parseItinerary(rows[0][2])
+    for version, is_snapshot, body in rows[1:]:
+        itinerary = applyDelta(itinerary, serializer.decode(body))
+    return serializer.encode(itinerary).decode()
+
+
+# Returns the days added, removed and changed from one version to another
+#   with the events of the added and changed days
+def diffVersions(old_text, new_text):
+    old, new = parseItinerary(old_text), parseItinerary(new_text)
+    if old is None or new is None:
+        return None
+    delta = makeDelta(old, new)
+    return {
+        "added": [day for day in delta["set"] if day not in old],
+        "removed": delta["remove"],
+        "changed": [day for day in delta["set"] if day in old],
+        "days": delta["set"]
+    }
@@ -1,20 +1,34 @@
 # CS467 Online Capstone: GPT API Challenge
 # Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
 
-from flask import Flask, request
+from flask import Flask, request, send_file
 from flask_session import Session
 from openai import OpenAI
 from dotenv import load_dotenv, find_dotenv
 import os
 # from flask import jsonify, send_file
 # import requests
-import json
 # import io
 
 # from pytest import Session
 from service.promptType import promptType
 from service.prompt import prompt
-from service.postgres.postgresdb import PostgresDB
+from service.prompt import hedge
+from service.routing import routing
+from service.precompute import precompute
+from service.destination import destination as places
+from service.itinerary import itinerary
+from service.retrieval import retrieval
+from service.images import images
+from service.compression import compression
+from service.coalesce import coalesce
+from service.idempotency import idempotency
+from service.postgres import postgresdb
+from service.postgres.postgresdb import (PostgresDB,
+                                         start_cache_listener,
+                                         migrate_database)
+from service.serializer import serializer
+from service.cache.cache import db_cache, conversation_cache
 
 # Load ENV variables
 load_dotenv(find_dotenv(".env"))
@@ -25,6 +39,22 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 # Set up Flask app
 app = Flask(__name__)
 
+# Use msgspec for request.get_json() and for JSON responses
+app.json = serializer.MsgspecJSONProvider(app)
+
+# Compress large responses in the encoding the client accepts
+compression.init_app(app)
+
+# POST requests retried with the same Idempotency-Key header get the
+#   stored response of the first one instead of running again
+idempotency.init_app(app)
+
+# Read-your-writes with read replicas: the WAL position of a user's last
+#   write travels in a cookie (or header, for clients without cookies)
+LSN_COOKIE = "pg_lsn"
+LSN_HEADER = "X-Postgres-LSN"
+LSN_MAX_AGE = 300   # seconds, longer than any replica lag we tolerate
+
 # Load configurations from config.py file
 # app.config.from_object('service.config.DevelopmentConfig')
 
@@ -32,6 +62,26 @@ app = Flask(__name__)
 app.config['SESSION_TYPE'] = 'filesystem'
 Session(app)
 
+# create or upgrade the tables when the worker starts, for local setups
+#   deploys run the migrate maintenance command once instead
+if os.getenv('DATABASE_MIGRATE_ON_START', '0') == '1':
+    migrate_database()
+
+# keep this worker's caches in step with the other workers
+start_cache_listener()
+
+# Cache-Control of the polled GET routes: clients keep the response but
+#   revalidate it every time, which costs an ETag lookup and a 304
+CACHE_POLICIES = {
+    "trip": "private, no-cache",
+    "history": "private, no-cache",
+    "profile": "private, no-cache",
+    "itinerary-version": "private, max-age=31536000, immutable"
+}
+
+# seconds clients may cache a generated image, it never changes
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
 ERROR_MESSAGE_400 = {
     "svc": "prompt-svc",
     "Error": "The request body is invalid"
@@ -92,7 +142,11 @@ def initialRequest():
         return (ERROR_MESSAGE_400, 400)
 
     # extract variables from the request body content
+    #   the trip keeps the destination as the user typed it, prompts and
+    #   lookups use its canonical place so "NYC" and "New York City"
+    #   share prompts, cache keys and precomputed itineraries
     destination = content['destination']
+    place = places.canonicalize(destination)
     travelers_num = content['num-users']
     days_num = content['num-days']
     travel_preferences = content['preferences']
@@ -103,7 +157,14 @@ def initialRequest():
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
 
-    travel_preferences.join(profileString(user_id))
+    # the user's profile is sent as its own system message after the shared
+    #   system prompt, keeping the start of every trip's prompt identical
+    profile = profilePrompt(postgressconn, user_id)
+
+    # popular trips start from a precomputed base itinerary, see
+    #   precompute.py, which only needs to be personalized
+    base_itinerary = precompute.findBase(postgressconn, place,
+                                         days_num, budget)
 
     # messages is an array of 'message' objects
     # a 'message' objects is a dictionary of "role" and "content"
@@ -112,11 +173,21 @@ def initialRequest():
     try:
         print("Initial req: constructing system message and sending to GPT")
         p = prompt.Prompt()
-        messages = p.initialPlanATrip(destination, travelers_num,
-                                      days_num, travel_preferences,
-                                      budget)
+        if base_itinerary:
+            print("Initial req: personalizing a precomputed itinerary")
+            messages, request_messages = p.personalizeATrip(
+                base_itinerary, place, travelers_num, days_num,
+                travel_preferences, budget, profile=profile)
+            route = "personalize"
+        else:
+            messages = p.initialPlanATrip(place, travelers_num,
+                                          days_num, travel_preferences,
+                                          budget, profile=profile)
+            request_messages = messages
+            route = "itinerary"
         completion = p.prompt(promptType.PromptType.ChatCompletions,
-                              messages)
+                              request_messages, route=route,
+                              days_num=days_num)
         print("Initial req: succesfully recieved completion from GPT")
         # print(completion)
 
@@ -145,19 +216,18 @@ def initialRequest():
                                 travel_preferences=travel_preferences,
                                 user_id=user_id)
 
-    # create a new system prompt on db's 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role=messages[0]['role'],
-                                       content_type=messages[0]['content'][0]['type'],
-                                       content_text=messages[0]['content'][0]['text'],
-                                       message_category=SYSTEMPROMPT)
-
-    # create a new user prompt on db's 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role=messages[1]['role'],
-                                       content_type=messages[1]['content'][0]['type'],
-                                       content_text=messages[1]['content'][0]['text'],
-                                       message_category=USERPROMPT)
+    # create the system prompt(s) and user prompt on db's 'messages' table
+    for message in messages:
+        if message['role'] == "system":
+            message_category = SYSTEMPROMPT
+        else:
+            message_category = USERPROMPT
+        postgressconn.create_message_to_db(
+                                trip_id=trip_id,
+                                role=message['role'],
+                                content_type=message['content'][0]['type'],
+                                content_text=message['content'][0]['text'],
+                                message_category=message_category)
 
     # create a new GPT's reply message to 'messages' table
     postgressconn.create_message_to_db(trip_id=trip_id,
@@ -206,20 +276,154 @@ def getTrip(trip_id):
     # get trip from database
     trip = postgressconn.get_trip(trip_id)
 
-    # get most recent itinerary from database
-    recent_itinerary = postgressconn.get_recent_itinerary(trip_id)
+    # check that the correct user is requesting the trip
+    if (user_id != trip['user_id']):
+        postgressconn.close_db_connection()
+        return ({"Error": "Unauthorized, this trip does not belong to you."},
+                401)
+
+    # the trip only changes with a new itinerary
+    etag = postgressconn.get_trip_etag(trip_id)
+    if notModified(etag):
+        postgressconn.close_db_connection()
+        return ("", 304, cacheHeaders(etag, "trip"))
+
+    # get most recent itinerary from database, with the ETag of that
+    #   itinerary: it may be newer than the one just compared
+    etag, recent_itinerary = postgressconn.get_trip_itinerary(trip_id)
 
     # close postgres DB connection
     postgressconn.close_db_connection()
 
-    # check that the correct user is requesting the trip
-    if (user_id == trip['user_id']):
-        return ({"gpt-message": recent_itinerary,
-                 "trip_id": trip_id,
-                 "destination": trip['destination']}, 200)
-    else:
-        return ({"Error": "Unauthorized, this trip does not belong to you."},
-                401)
+    return ({"gpt-message": recent_itinerary,
+             "trip_id": trip_id,
+             "destination": trip['destination']}, 200,
+            cacheHeaders(etag, "trip"))
+
+
+###########################################################
+#
+#  Itinerary versions of a trip, one per itinerary GPT created
+#
+#  Receives:
+#   - URL variable: trip_id
+#   - URL variable: version, to get a single version
+#   - URL query: from, to (version numbers) for the diff
+#
+#  Returns:
+#   - JSON: {"versions": [{version, message_id, stored_as, bytes,
+#                          created_at}], "trip_id"}
+#   - JSON: {"gpt-message": itinerary of that version [library],
+#            "version", "trip_id"}
+#   - JSON: {"added", "removed", "changed": day names,
+#            "days": events of added and changed days, "from", "to"}
+#
+###########################################################
+@app.route('/v1/prompt/itinerary-versions/<trip_id>', methods=['GET'])
+def getItineraryVersions(trip_id):
+    postgressconn = PostgresDB()
+    error = tripAccessError(postgressconn, trip_id)
+    if error is None:
+        versions = postgressconn.get_itinerary_versions(trip_id)
+    postgressconn.close_db_connection()
+
+    if error is not None:
+        return error
+    return ({"versions": versions, "trip_id": trip_id}, 200)
+
+
+@app.route('/v1/prompt/itinerary-versions/<trip_id>/<int:version>',
+           methods=['GET'])
+def getItineraryVersion(trip_id, version):
+    postgressconn = PostgresDB()
+    error = tripAccessError(postgressconn, trip_id)
+    if error is None:
+        text = postgressconn.get_itinerary_version(trip_id, version)
+    postgressconn.close_db_connection()
+
+    if error is not None:
+        return error
+    if text is None:
+        return ({"Error": "No such itinerary version"}, 404)
+    # a version never changes, its compressed body is cached by this ETag
+    return ({"gpt-message": text, "version": version, "trip_id": trip_id},
+            200, cacheHeaders(f"v{trip_id}-{version}", "itinerary-version"))
+
+
+@app.route('/v1/prompt/itinerary-diff/<trip_id>', methods=['GET'])
+def getItineraryDiff(trip_id):
+    old_version = request.args.get('from', type=int)
+    new_version = request.args.get('to', type=int)
+    if old_version is None or new_version is None:
+        return (ERROR_MESSAGE_400, 400)
+
+    postgressconn = PostgresDB()
+    error = tripAccessError(postgressconn, trip_id)
+    if error is None:
+        old_text = postgressconn.get_itinerary_version(trip_id, old_version)
+        new_text = postgressconn.get_itinerary_version(trip_id, new_version)
+    postgressconn.close_db_connection()
+
+    if error is not None:
+        return error
+    if old_text is None or new_text is None:
+        return ({"Error": "No such itinerary version"}, 404)
+
+    diff = itinerary.diffVersions(old_text, new_text)
+    if diff is None:
+        return ({"Error": "These versions are not in itinerary format"}, 422)
+    diff.update({"from": old_version, "to": new_version})
+    return (diff, 200)
+
+
+###########################################################
+#
+#  Image of a destination, generated once and served from disk
+#
+#  Receives:
+#   - Authorization header, like the other prompt routes
+#   - URL query: destination, a place of the alias index (see
+#     service/destination), size (256x256, 512x512 or 1024x1024)
+#
+#  Returns:
+#   - the PNG image, with an ETag and Range support
+#   - 202 JSON: {"status": "pending"} while it is being generated,
+#     ask again after Retry-After seconds
+#   - 401 without an Authorization header, 404 for unknown places
+#
+###########################################################
+@app.route('/v1/prompt/image', methods=['GET'])
+def imagePrompt():
+
+    # every image is a paid generation, only users get them
+    if 'Authorization' not in request.headers:
+        return ({"error": "Unauthorized access forbidden"}, 401)
+
+    size = request.args.get('size', images.DEFAULT_IMAGE_SIZE)
+    if not request.args.get('destination') or \
+            size not in images.IMAGE_SIZES:
+        return (ERROR_MESSAGE_400, 400)
+
+    # only places of the alias index, so the images stay a bounded set
+    destination = places.find(request.args.get('destination'))
+    if destination is None:
+        return ({"Error": "Unknown destination"}, 404)
+
+    status, result = images.requestImage(
+        images.destinationPrompt(destination), size)
+
+    if status == "failed":
+        return ({"svc": "prompt-svc", "error": result}, 502)
+    if status == "pending":
+        return ({"svc": "prompt-svc", "status": "pending"}, 202,
+                {"Retry-After": "5"})
+
+    # the file never changes, its content address is a strong ETag
+    response = send_file(images.imagePath(result), mimetype="image/png",
+                         conditional=True, etag=result,
+                         max_age=IMAGE_MAX_AGE)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/v1/prompt/get-trip-history', methods=['GET'])
@@ -240,13 +444,19 @@ def getHistory():
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
 
+    # trips never change, the history only changes with a new trip
+    etag = postgressconn.get_history_etag(user_id)
+    if notModified(etag):
+        postgressconn.close_db_connection()
+        return ("", 304, cacheHeaders(etag, "history"))
+
     # get all trips of a user and store in 'history'
     history = postgressconn.get_trip_from_user(user_id)
 
     # close postgres DB connection
     postgressconn.close_db_connection()
 
-    return ({"history": history}, 200)
+    return ({"history": history}, 200, cacheHeaders(etag, "history"))
 
 
 ###########################################################
@@ -278,7 +488,7 @@ def chatPrompt():
     try:
         p = prompt.Prompt()
         completion = p.prompt(promptType.PromptType.ChatCompletions,
-                              content['messages'])
+                              content['messages'], route="chat")
 
     except TypeError:
         return {
@@ -344,7 +554,7 @@ def localInfo():
         return (ERROR_MESSAGE_400, 400)
 
     # extract variables from the request body content
-    destination = content['destination']
+    destination = places.canonicalize(content['destination'])
     time = content['time']
     date = content['date']
     resterauntConditions = content['resterauntConditions']
@@ -355,7 +565,7 @@ def localInfo():
         content['messages'] = p.getLocalInfo(destination, time,
                                              date, resterauntConditions)
         completion = p.prompt(promptType.PromptType.ChatCompletions,
-                              content['messages'])
+                              content['messages'], route="local-info")
 
     except TypeError:
         return {
@@ -415,9 +625,10 @@ def weatherPrompt():
 
     try:
         p = prompt.Prompt()
-        content['messages'] = p.getHourlyForcast(content['location'])
+        content['messages'] = p.getHourlyForcast(
+            places.canonicalize(content['location']))
         completion = p.prompt(promptType.PromptType.ChatCompletions,
-                              content['messages'])
+                              content['messages'], route="weather")
 
     except TypeError:
         return {
@@ -443,7 +654,8 @@ def weatherPrompt():
             "content": [
                 {
                     "type": "text",
-                    "json": json.loads(completion.choices[0].message.content)
+                    "json": serializer.decode(
+                        completion.choices[0].message.content)
                 }
             ]
         }
@@ -481,71 +693,98 @@ def chatTripPlanningPrompt():
 
     print(request.get_data())
 
-    # get json body from POST request
-    content = request.get_json()
-    trip_id = content['trip_id']
-    user_chat_message = content['message']
-
-    # check that the request body is valid
-    if ('message' not in content or 'trip_id' not in content):
+    # get json body from POST request, check that the request body is valid
+    try:
+        content = serializer.decode(request.get_data(),
+                                    serializer.ChatMessage)
+    except ValueError:
         return (ERROR_MESSAGE_400, 400)
 
+    trip_id = content.trip_id
+    user_chat_message = content.message
+
+    # the same message sent twice (double-click, retry) gets one answer
+    return coalesce.coalesce(("chat", str(trip_id), user_chat_message),
+                             lambda: chatTrip(trip_id, user_chat_message))
+
+
+# Answers a chat message, the trip's chats and updates run one at a time
+#   so each one sees the history written by the one before
+def chatTrip(trip_id, user_chat_message):
+
     # read chat history from database using trip_id
     # Database work (no need for try blocks, they are already in postgresdb.py)
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
-
-    # read all messages with trip_id from 'message' table in database
-    # returns an array of message objects
-    messages = postgressconn.get_chat_history(trip_id)
-    print("User chat: retrieved chat history from database")
+    postgressconn.lock_trip(trip_id)
 
     try:
-        p = prompt.Prompt()
-        user_message = {
-            "role": "user",
-            "content": [{
-                "type": "text",
-                "text": user_chat_message + " Answer in normal formatting."
-            }]
-        }
-        messages.append(user_message)
-        completion = p.prompt(promptType.PromptType.ChatCompletions, messages)
+        # read all messages with trip_id from 'message' table in database
+        # returns an array of message objects
+        messages = postgressconn.get_chat_history(trip_id)
+        print("User chat: retrieved chat history from database")
+
+        # long conversations only send the past turns relevant to the message
+        context = retrieval.retrieveContext(postgressconn, trip_id, messages,
+                                            user_chat_message)
+        if context is not None:
+            print("User chat: sending retrieved turns instead of the history")
+            messages = context
+
+        try:
+            p = prompt.Prompt()
+            user_message = {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": user_chat_message + " Answer in normal formatting."
+                }]
+            }
+            messages.append(user_message)
+            completion = p.prompt(promptType.PromptType.ChatCompletions,
+                                  messages, route="chat")
+
+        except TypeError:
+            return {
+                "svc": "prompt-svc",
+                "error": "Invalid type: please use 1) chat,\
+                    2) embedded, or 3) image",
+                "messages": user_chat_message,
+            }
 
-    except TypeError:
-        return {
-            "svc": "prompt-svc",
-            "error": "Invalid type: please use 1) chat,\
-                2) embedded, or 3) image",
-            "messages": user_chat_message,
-        }
+        # check that the request body is valid
+        if ('error' in completion):
+            return {
+                "svc": "prompt-svc",
+                "error": completion['error'],
+                "messages": user_chat_message,
+            }
 
-    # check that the request body is valid
-    if ('error' in completion):
-        return {
-            "svc": "prompt-svc",
-            "error": completion['error'],
-            "messages": user_chat_message,
-        }
+        reply = completion.choices[0].message
 
-    # create a new user prompt on db's 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role="user",
-                                       content_type="text",
-                                       content_text=user_chat_message,
-                                       message_category=USERCHAT)
+        # create a new user prompt on db's 'messages' table
+        postgressconn.create_message_to_db(trip_id=trip_id,
+                                           role="user",
+                                           content_type="text",
+                                           content_text=user_chat_message,
+                                           message_category=USERCHAT)
 
-    # create a new GPT's reply message to 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role=completion.choices[0].message.role,
-                                       content_type="text",
-                                       content_text=completion.choices[0].message.content,
-                                       message_category=GPTCHAT)
+        # create a new GPT's reply message to 'messages' table
+        postgressconn.create_message_to_db(trip_id=trip_id,
+                                           role=reply.role,
+                                           content_type="text",
+                                           content_text=reply.content,
+                                           message_category=GPTCHAT)
 
-    # close postgres DB connection
-    postgressconn.close_db_connection()
+    finally:
+        # close postgres DB connection, which also releases the trip
+        postgressconn.unlock_trip(trip_id)
+        postgressconn.close_db_connection()
 
-    return ({"messages": completion.choices[0].message.content}, 200)
+    # embed the new messages for later retrieval, off the request
+    retrieval.embedTripAsync(trip_id)
+
+    return ({"messages": reply.content}, 200)
 
 
 ###########################################################
@@ -577,68 +816,94 @@ def updateTripPlanningPrompt():
 
     trip_id = content['trip_id']
 
+    # a double-click or a second tab sends the same update: one
+    #   regeneration answers all of them
+    return coalesce.coalesce(("update", str(trip_id)),
+                             lambda: updateTrip(trip_id))
+
+
+# Regenerates the itinerary, the trip's chats and updates run one at a time
+#   an update that waited for another worker's update returns its itinerary
+def updateTrip(trip_id):
+
     # read chat history from database using trip_id
     # Database work (no need for try blocks, they are already in postgresdb.py)
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
-
-    # read all messages with trip_id from 'message' table in database
-    # returns an array of message objects
-    messages = postgressconn.get_chat_history(trip_id)
-    print("Update itinerary: retrieved chat history from database")
+    itinerary_id, _ = postgressconn.get_latest_itinerary(trip_id)
+    waited = postgressconn.lock_trip(trip_id)
 
     try:
-        p = prompt.Prompt()
-        user_message = {
-            "role": "user",
-            "content": [{
-                "type": "text",
-                "text": p.updateATripMessage()
-            }]
-        }
-        messages.append(user_message)
-        completion = p.prompt(promptType.PromptType.ChatCompletions, messages)
-        print("Update itinerary: succesfully recieved completion from GPT")
+        # get the trip for its length (sizes the reply) and for its location
+        #   for the weather service
+        trip = postgressconn.get_trip(trip_id=trip_id)
+
+        if waited:
+            latest_id, latest = postgressconn.get_latest_itinerary(trip_id)
+            if latest_id != itinerary_id:
+                print("Update itinerary: another update just finished")
+                return ({"gpt-message": latest,
+                         "destination": trip['destination']}, 200)
+
+        # read all messages with trip_id from 'message' table in database
+        # returns an array of message objects
+        messages = postgressconn.get_chat_history(trip_id)
+        print("Update itinerary: retrieved chat history from database")
+
+        try:
+            p = prompt.Prompt()
+            user_message = {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": p.updateATripMessage()
+                }]
+            }
+            messages.append(user_message)
+            completion = p.prompt(promptType.PromptType.ChatCompletions,
+                                  messages, route="itinerary",
+                                  days_num=trip['days_num'])
+            print("Update itinerary: succesfully recieved completion from GPT")
+
+        except TypeError:
+            return {
+                "svc": "prompt-svc",
+                "error": "Invalid type: please use 1) chat,\
+                    2) embedded, or 3) image",
+                "messages": p.updateATripMessage,
+            }
 
-    except TypeError:
-        return {
-            "svc": "prompt-svc",
-            "error": "Invalid type: please use 1) chat,\
-                2) embedded, or 3) image",
-            "messages": p.updateATripMessage,
-        }
+        # check that the request body is valid
+        if ('error' in completion):
+            return {
+                "svc": "prompt-svc",
+                "error": completion['error'],
+                "messages": p.updateATripMessage,
+            }
 
-    # check that the request body is valid
-    if ('error' in completion):
-        return {
-            "svc": "prompt-svc",
-            "error": completion['error'],
-            "messages": p.updateATripMessage,
-        }
+        reply = completion.choices[0].message
 
-    # create a new user prompt on db's 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role="user",
-                                       content_type="text",
-                                       content_text=p.updateATripMessage(),
-                                       message_category=USERCHAT)
+        # create a new user prompt on db's 'messages' table
+        postgressconn.create_message_to_db(trip_id=trip_id,
+                                           role="user",
+                                           content_type="text",
+                                           content_text=p.updateATripMessage(),
+                                           message_category=USERCHAT)
 
-    # create a new GPT's reply message to 'messages' table
-    postgressconn.create_message_to_db(trip_id=trip_id,
-                                       role=completion.choices[0].message.role,
-                                       content_type="text",
-                                       content_text=completion.choices[0].message.content,
-                                       message_category=ITINERARY)
+        # create a new GPT's reply message to 'messages' table
+        postgressconn.create_message_to_db(trip_id=trip_id,
+                                           role=reply.role,
+                                           content_type="text",
+                                           content_text=reply.content,
+                                           message_category=ITINERARY)
 
-    # get location from trips table for the weather service
-    trip = postgressconn.get_trip(trip_id=trip_id)
-    destination = trip['destination']
+    finally:
+        # close postgres DB connection, which also releases the trip
+        postgressconn.unlock_trip(trip_id)
+        postgressconn.close_db_connection()
 
-    # close postgres DB connection
-    postgressconn.close_db_connection()
-
-    return ({"gpt-message": completion.choices[0].message.content,
-             "destination": destination}, 200)
+    return ({"gpt-message": reply.content,
+             "destination": trip['destination']}, 200)
 
 ###########################################################
 #
@@ -672,20 +937,18 @@ def getTravelRecommendationPrompt():
     messages = postgressconn.get_chat_history(trip_id)
     print("User event: retrieved chat history from database")
 
-    # Create payload response to send to ChatGPT API
-    payload = '. Provide 8 different event recommendations instead. Each recommendation is a maximum of 2 sentences. output should be like: { "Event 1": { "recommendation": "Some recommendation text"},"Event 2": {"recommendation": "Another recommendation text"},...}'
-    
     try:
         p = prompt.Prompt()
         user_message = {
             "role": "user",
             "content": [{
                 "type": "text",
-                "text": event + payload
+                "text": p.getTravelRecommendation(event)
             }]
         }
         messages.append(user_message)
-        completion = p.prompt(promptType.PromptType.ChatCompletions, messages)
+        completion = p.prompt(promptType.PromptType.ChatCompletions,
+                              messages, route="recommendation")
 
     except TypeError:
         return {
@@ -726,14 +989,23 @@ def getUserProfile():
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
 
+    # every profile update bumps its version
+    etag = postgressconn.get_profile_etag(user_id)
+    if notModified(etag):
+        postgressconn.close_db_connection()
+        return ("", 304, cacheHeaders(etag, "profile"))
+
     profile = postgressconn.get_profile(user_id)
 
+    # close postgres DB connection
+    postgressconn.close_db_connection()
+
     if profile is None:
         return {
             "error": "Error with database"
         }
 
-    return profile
+    return (profile, 200, cacheHeaders(etag, "profile"))
 
 
 @app.route('/v1/prompt/profile', methods=['POST'])
@@ -751,45 +1023,51 @@ def updateUserProfile():
             "error": "Unauthorized access forbidden"
         }
 
-    # get json body from POST request
-    content = request.get_json()
-
-    # check that the request body is valid
-    if ('age' not in content or
-            'travel-style' not in content or
-            'travel-priorities' not in content or
-            'travel-avoidances' not in content or
-            'dietary-restrictions' not in content or
-            'accomodations' not in content):
+    # get json body from POST request, check that the request body is valid
+    try:
+        content = serializer.decode(request.get_data(), serializer.Profile)
+    except ValueError:
         return (ERROR_MESSAGE_400, 400)
 
     # Get form data
-    age = content['age']
-    travelStyle = content['travel-style']
-    travelPriorities = content['travel-priorities']
-    travelAvoidances = content['travel-avoidances']
-    dietaryRestrictions = content['dietary-restrictions']
-    accomodations = content['accomodations']
+    age = content.age
+    travelStyle = content.travelStyle
+    travelPriorities = content.travelPriorities
+    travelAvoidances = content.travelAvoidances
+    dietaryRestrictions = content.dietaryRestrictions
+    accomodations = content.accomodations
 
     # Database work (no need for try blocks, they are already in postgresdb.py)
     # create a PostgresDB() object, this automatically connects to PostgresDB
     postgressconn = PostgresDB()
 
+    # render the profile block for trip planning prompts once, here,
+    #   instead of on every trip request
+    profile_prompt = prompt.renderProfile(age, travelStyle, travelPriorities,
+                                          travelAvoidances,
+                                          dietaryRestrictions, accomodations)
+    prompt_tokens = routing.estimateTextTokens(profile_prompt)
+
     profile = postgressconn.get_profile(user_id)
     response = None
 
     if profile is not None:
-        response = postgressconn.update_profile(age, travelStyle,
-                                                travelPriorities,
-                                                travelAvoidances,
-                                                dietaryRestrictions,
-                                                accomodations, user_id)
+        response = postgressconn.update_profile(
+                                    age, travelStyle, travelPriorities,
+                                    travelAvoidances, dietaryRestrictions,
+                                    accomodations, user_id,
+                                    profile_prompt=profile_prompt,
+                                    profile_prompt_tokens=prompt_tokens)
     else:
-        response = postgressconn.insert_profile(user_id, age, travelStyle,
-                                                travelPriorities,
-                                                travelAvoidances,
-                                                dietaryRestrictions,
-                                                accomodations)
+        response = postgressconn.insert_profile(
+                                    user_id, age, travelStyle,
+                                    travelPriorities, travelAvoidances,
+                                    dietaryRestrictions, accomodations,
+                                    profile_prompt=profile_prompt,
+                                    profile_prompt_tokens=prompt_tokens)
+
+    # close postgres DB connection
+    postgressconn.close_db_connection()
 
     if response is None:
         return {
@@ -801,25 +1079,111 @@ def updateUserProfile():
     }
 
 
-def profileString(user_id):
+###########################################################
+#
+#  Service metrics, per gunicorn worker
+#
+#  Returns:
+#   - JSON: {"db_cache": hit rates and memory use of the database cache,
+#            "conversation_cache": the same for cached chat histories,
+#            "prompt_usage": prompt and cached (prefix) token counts,
+#            "hedging": hedge and win rates per route,
+#            "retrieval": history vs sent tokens of retrieved chats,
+#            "compression": bytes before and after response compression,
+#            "coalesced_requests": requests that reused another's reply,
+#            "idempotency": claimed keys and replayed responses,
+#            "destinations": raw destination strings per canonical place}
+#
+###########################################################
+@app.route('/v1/prompt/metrics', methods=['GET'])
+def getMetrics():
+    return {
+        "svc": "prompt-svc",
+        "db_cache": db_cache.stats(),
+        "conversation_cache": conversation_cache.stats(),
+        "prompt_usage": dict(prompt.usage_stats),
+        "hedging": hedge.stats(),
+        "retrieval": dict(retrieval.retrieval_stats),
+        "compression": compression.stats(),
+        "coalesced_requests": coalesce.stats(),
+        "idempotency": idempotency.stats(),
+        "destinations": places.destination_index.stats()
+    }
+
+
+# Reads of this request wait for the user's last write on the replicas
+@app.before_request
+def readAfterLastWrite():
+    postgresdb.written_lsn.set(None)
+    postgresdb.read_after_lsn.set(postgresdb.parse_lsn(
+        request.headers.get(LSN_HEADER) or request.cookies.get(LSN_COOKIE)))
 
-    # Database work (no need for try blocks, they are already in postgresdb.py)
-    # create a PostgresDB() object, this automatically connects to PostgresDB
-    postgressconn = PostgresDB()
+
+# Hands the WAL position of this request's last write back to the client
+@app.after_request
+def rememberLastWrite(response):
+    lsn = postgresdb.written_lsn.get()
+    if lsn is not None:
+        response.headers[LSN_HEADER] = lsn
+        response.set_cookie(LSN_COOKIE, lsn, max_age=LSN_MAX_AGE,
+                            httponly=True, samesite="Lax")
+    return response
+
+
+# Whether the client's cached copy (If-None-Match) is still current
+#   the client may hold a compressed variant of the response
+def notModified(etag):
+    return etag is not None and any(
+        request.if_none_match.contains(variant)
+        for variant in compression.etagVariants(etag))
+
+
+# ETag and Cache-Control headers of a GET route's response
+def cacheHeaders(etag, route):
+    headers = {"Cache-Control": CACHE_POLICIES[route]}
+    if etag is not None:
+        headers["ETag"] = f'"{etag}"'
+    return headers
+
+
+# Checks the Authorization header's user owns the trip, like getTrip
+# returns None if they do, otherwise the error response
+def tripAccessError(postgressconn, trip_id):
+    user_id = None
+    if 'Authorization' in request.headers:
+        user_id = request.headers['Authorization'].split()[1]
+
+    trip = postgressconn.get_trip(trip_id)
+    if trip is None:
+        return ({"Error": "No such trip"}, 404)
+    if user_id != trip['user_id']:
+        return ({"Error": "Unauthorized, this trip does not belong to you."},
+                401)
+    return None
+
+
+# Returns the user's rendered profile block, "" if they have no profile
+#   profiles written before the block was stored are rendered and stored once
+def profilePrompt(postgressconn, user_id):
+
+    profile_prompt = postgressconn.get_profile_prompt(user_id)
+    if profile_prompt is not None:
+        return profile_prompt
 
     profile = postgressconn.get_profile(user_id)
 
     if profile is None:
         return ""
-    else:
-        return f"""
-        Plan a trip for a person {profile.get('age')} years old. This person's
-        travel style involves: {profile.get('travelStyle')}. This person
-        prioritizes: {profile.get('travelPriorities')}. This person avoids:
-        {profile.get('travelAvoidances')}. Dietary restrictions:
-        {profile.get('travelAvoidances')}. Additional accomodations include:
-        {profile.get('accomodations')}.
-        """
+
+    profile_prompt = prompt.renderProfile(profile['age'],
+                                          profile['travelStyle'],
+                                          profile['travelPriorities'],
+                                          profile['travelAvoidances'],
+                                          profile['dietaryRestrictions'],
+                                          profile['accomodations'])
+    prompt_tokens = routing.estimateTextTokens(profile_prompt)
+    postgressconn.set_profile_prompt(user_id, profile_prompt, prompt_tokens)
+    return profile_prompt
 
 
 if __name__ == "__main__":
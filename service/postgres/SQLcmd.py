@@ -1,5 +1,5 @@
 create_trips_table = """CREATE TABLE IF NOT EXISTS trips (
-                              trip_id SERIAL NOT NULL PRIMARY KEY,
+                              trip_id BIGSERIAL NOT NULL PRIMARY KEY,
                               user_id VARCHAR(255),
                               destination VARCHAR(255) NOT NULL,
                               days_num VARCHAR(255) NOT NULL,
@@ -11,18 +11,70 @@ create_trips_table = """CREATE TABLE IF NOT EXISTS trips (
                                 ON DELETE CASCADE
                              );"""
 
+# trips on a shard, see sharding.py: ids are allocated by prompt-svc and
+#   the users table stays on the home database
+create_shard_trips_table = """CREATE TABLE IF NOT EXISTS trips (
+                              trip_id BIGINT NOT NULL PRIMARY KEY,
+                              user_id VARCHAR(255),
+                              destination VARCHAR(255) NOT NULL,
+                              days_num VARCHAR(255) NOT NULL,
+                              travelers_num VARCHAR(255) NOT NULL,
+                              budget VARCHAR(255) NOT NULL,
+                              travel_preferences TEXT
+                             );"""
+
+# texts stored once, by sha256 of their UTF-8 bytes, and referenced from
+#   messages.content_hash (system prompts, update requests, itineraries)
+create_message_blobs_table = """CREATE TABLE IF NOT EXISTS message_blobs (
+                            content_hash BYTEA NOT NULL PRIMARY KEY,
+                            content_text TEXT NOT NULL
+                            );"""
+
+# a message keeps its text either in content_text or in message_blobs
+#   partitioned by month of created_at, see create_messages_partition
 create_messages_table = """CREATE TABLE IF NOT EXISTS messages (
-                            message_id SERIAL NOT NULL PRIMARY KEY,
-                            trip_id INT NOT NULL,
+                            message_id SERIAL NOT NULL,
+                            trip_id BIGINT NOT NULL,
                             role VARCHAR(255) NOT NULL,
                             content_type VARCHAR(255) NOT NULL,
-                            content_text TEXT NOT NULL,
+                            content_text TEXT,
+                            content_hash BYTEA,
                             message_category VARCHAR(255) NOT NULL,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            PRIMARY KEY (message_id, created_at),
                             FOREIGN KEY(trip_id)
                                 REFERENCES trips(trip_id)
                                 ON DELETE CASCADE,
-                            CONSTRAINT message_pk UNIQUE (message_id, trip_id)
-                            );"""
+                            FOREIGN KEY(content_hash)
+                                REFERENCES message_blobs(content_hash)
+                            ) PARTITION BY RANGE (created_at);"""
+
+# one month of messages, the name and bounds come from
+#   records.month_partitions
+create_messages_partition = """CREATE TABLE IF NOT EXISTS {name}
+                            PARTITION OF messages
+                            FOR VALUES FROM (%s) TO (%s);"""
+
+# messages of months without a partition yet
+create_messages_default_partition = """CREATE TABLE IF NOT EXISTS
+                            messages_default
+                            PARTITION OF messages DEFAULT;"""
+
+# trips untouched for months, their messages exported with COPY and
+#   zlib compressed, see PostgresDB.archive_trips
+#   the archive is compressed already, so TOAST stores it as is
+create_archived_trips_table = """CREATE TABLE IF NOT EXISTS archived_trips (
+                            trip_id BIGINT NOT NULL PRIMARY KEY,
+                            message_count INT NOT NULL,
+                            raw_bytes BIGINT NOT NULL,
+                            archive BYTEA NOT NULL,
+                            archived_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            FOREIGN KEY(trip_id)
+                                REFERENCES trips(trip_id)
+                                ON DELETE CASCADE
+                            );
+                            ALTER TABLE archived_trips
+                            ALTER COLUMN archive SET STORAGE EXTERNAL;"""
 
 create_profiles_table = """CREATE TABLE IF NOT EXISTS profiles (
                             profile_id SERIAL NOT NULL PRIMARY KEY,
@@ -33,12 +85,201 @@ create_profiles_table = """CREATE TABLE IF NOT EXISTS profiles (
                             travelAvoidances TEXT NOT NULL,
                             dietaryRestrictions TEXT NOT NULL,
                             accomodations TEXT NOT NULL,
+                            profile_prompt TEXT,
+                            profile_prompt_tokens INT,
                               FOREIGN KEY(user_id)
                                 REFERENCES users(id)
                                 ON DELETE CASCADE,
                             CONSTRAINT profile_pk UNIQUE (profile_id, user_id)
                             );"""
 
+# provider batch jobs submitted by service/batch/batch.py
+create_batches_table = """CREATE TABLE IF NOT EXISTS batches (
+                            batch_id VARCHAR(255) NOT NULL PRIMARY KEY,
+                            kind VARCHAR(255) NOT NULL,
+                            status VARCHAR(255) NOT NULL,
+                            request_count INT NOT NULL,
+                            output_file_id VARCHAR(255),
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+                            );"""
+
+# batch results already written as messages, kept with the trip's messages
+#   so a result and its message are committed together
+create_batch_results_table = """CREATE TABLE IF NOT EXISTS batch_results (
+                            batch_id VARCHAR(255) NOT NULL,
+                            custom_id VARCHAR(255) NOT NULL,
+                            trip_id BIGINT NOT NULL,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            PRIMARY KEY (batch_id, custom_id),
+                            FOREIGN KEY(trip_id)
+                                REFERENCES trips(trip_id)
+                                ON DELETE CASCADE
+                            );"""
+
+# base itineraries precomputed for popular trips by
+#   service/precompute/precompute.py, a new version per regeneration
+create_base_itineraries_table = """CREATE TABLE IF NOT EXISTS
+                            base_itineraries (
+                            base_id SERIAL NOT NULL PRIMARY KEY,
+                            destination VARCHAR(255) NOT NULL,
+                            days_num VARCHAR(255) NOT NULL,
+                            budget_bucket VARCHAR(255) NOT NULL,
+                            version INT NOT NULL,
+                            prompt_version VARCHAR(255) NOT NULL,
+                            content_text TEXT NOT NULL,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            CONSTRAINT base_itinerary_version UNIQUE
+                                (destination, days_num, budget_bucket, version)
+                            );"""
+
+# per trip snapshot of the chat history, in the exact 'messages' format
+#   sent to GPT, appended to with every chat message
+create_conversations_table = """CREATE TABLE IF NOT EXISTS conversations (
+                            trip_id BIGINT NOT NULL PRIMARY KEY,
+                            messages JSONB NOT NULL,
+                            last_message_id INT NOT NULL,
+                            FOREIGN KEY(trip_id)
+                                REFERENCES trips(trip_id)
+                                ON DELETE CASCADE
+                            );"""
+
+# version history of a trip's itinerary: whole snapshots with structural
+#   deltas in between, see service/itinerary/itinerary.py
+# the ITINERARY messages keep their whole text too: conversation snapshots
+#   (seed_conversation, rebuild_conversations) and archives
+#   (export_trip_messages) are built from messages in SQL, which can't
+#   apply deltas, so dropping it waits for those to read versions instead
+create_itinerary_versions_table = """CREATE TABLE IF NOT EXISTS
+                            itinerary_versions (
+                            trip_id BIGINT NOT NULL,
+                            version INT NOT NULL,
+                            message_id INT NOT NULL,
+                            is_snapshot BOOLEAN NOT NULL,
+                            body TEXT NOT NULL,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            PRIMARY KEY (trip_id, version),
+                            FOREIGN KEY(trip_id)
+                                REFERENCES trips(trip_id)
+                                ON DELETE CASCADE
+                            );"""
+
+# float32 embedding of a chat message, see service/retrieval/retrieval.py
+create_message_embeddings_table = """CREATE TABLE IF NOT EXISTS
+                            message_embeddings (
+                            message_id INT NOT NULL PRIMARY KEY,
+                            trip_id BIGINT NOT NULL,
+                            model VARCHAR(255) NOT NULL,
+                            embedding BYTEA NOT NULL,
+                            FOREIGN KEY(trip_id)
+                                REFERENCES trips(trip_id)
+                                ON DELETE CASCADE
+                            );"""
+
+create_message_embeddings_index = """CREATE INDEX IF NOT EXISTS
+                            message_embeddings_trip
+                            ON message_embeddings (trip_id);"""
+
+# embeddings by sha256 of the embedded text, see service/prompt/embeddings.py
+create_embedding_cache_table = """CREATE TABLE IF NOT EXISTS
+                            embedding_cache (
+                            content_hash BYTEA NOT NULL,
+                            model VARCHAR(255) NOT NULL,
+                            embedding BYTEA NOT NULL,
+                            PRIMARY KEY (content_hash, model)
+                            );"""
+
+# responses of POST requests sent with an Idempotency-Key header, see
+#   service/idempotency/idempotency.py
+#   idempotency_key: sha256 of the user, route and header value
+#   request_hash: sha256 of the request body
+#   status: 'in_progress' until the response is stored, then 'complete'
+create_idempotency_keys_table = """CREATE TABLE IF NOT EXISTS
+                            idempotency_keys (
+                            idempotency_key BYTEA NOT NULL PRIMARY KEY,
+                            request_hash BYTEA NOT NULL,
+                            status VARCHAR(255) NOT NULL,
+                            status_code INT,
+                            content_type VARCHAR(255),
+                            body BYTEA,
+                            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                            expires_at TIMESTAMP NOT NULL
+                            );"""
+
+create_idempotency_keys_index = """CREATE INDEX IF NOT EXISTS
+                            idempotency_keys_expires
+                            ON idempotency_keys (expires_at);"""
+
+# messages tables created before message_blobs existed
+alter_messages_table_blobs = """ALTER TABLE messages
+                            ADD COLUMN IF NOT EXISTS content_hash BYTEA
+                                REFERENCES message_blobs(content_hash),
+                            ALTER COLUMN content_text DROP NOT NULL;"""
+
+# messages tables created before messages were partitioned, the rows
+#   already stored count as created now
+alter_messages_table_created = """ALTER TABLE messages
+                            ADD COLUMN IF NOT EXISTS
+                                created_at TIMESTAMP NOT NULL DEFAULT NOW();"""
+
+# whether messages is partitioned, see partition_messages
+select_messages_partitioned = """SELECT relkind = 'p' FROM pg_class
+                            WHERE oid = 'messages'::regclass;"""
+
+# moves an unpartitioned messages table into a partitioned one, in order
+#   the partitions holding the old rows are created before the copy
+partition_messages = ("""ALTER TABLE message_embeddings
+                        DROP CONSTRAINT IF EXISTS
+                            message_embeddings_message_id_fkey,
+                        ADD CONSTRAINT message_embeddings_trip_id_fkey
+                            FOREIGN KEY(trip_id)
+                            REFERENCES trips(trip_id)
+                            ON DELETE CASCADE;""",
+                      """ALTER TABLE messages
+                        RENAME TO messages_unpartitioned;""",
+                      create_messages_table)
+
+select_unpartitioned_months = """SELECT DISTINCT
+                            date_trunc('month', created_at)::date
+                        FROM messages_unpartitioned;"""
+
+copy_unpartitioned_messages = ("""INSERT INTO messages (message_id, trip_id,
+                            role, content_type, content_text, content_hash,
+                            message_category, created_at)
+                        SELECT message_id, trip_id, role, content_type,
+                            content_text, content_hash, message_category,
+                            created_at
+                        FROM messages_unpartitioned;""",
+                               """SELECT setval(
+                            pg_get_serial_sequence('messages', 'message_id'),
+                            (SELECT COALESCE(MAX(message_id), 0) + 1
+                             FROM messages), false);""",
+                               """DROP TABLE messages_unpartitioned;""")
+
+# profiles created before the rendered profile prompt was stored
+alter_profiles_table_prompt = """ALTER TABLE profiles
+                            ADD COLUMN IF NOT EXISTS profile_prompt TEXT,
+                            ADD COLUMN IF NOT EXISTS
+                                profile_prompt_tokens INT;"""
+
+# profile_version is bumped by every update, it is the profile's ETag
+alter_profiles_table_version = """ALTER TABLE profiles
+                            ADD COLUMN IF NOT EXISTS
+                                profile_version INT NOT NULL DEFAULT 1;"""
+
+# indexes answering the ETag lookups of the GET routes from the index alone
+create_messages_trip_index = """CREATE INDEX IF NOT EXISTS
+                            messages_trip_category
+                            ON messages (trip_id, message_category,
+                                         message_id);"""
+
+create_trips_user_index = """CREATE INDEX IF NOT EXISTS trips_user
+                            ON trips (user_id, trip_id);"""
+
+create_profiles_user_index = """CREATE INDEX IF NOT EXISTS profiles_user
+                            ON profiles (user_id)
+                            INCLUDE (profile_id, profile_version);"""
+
 insert_trips_table = """INSERT INTO trips (user_id, destination,
                         days_num, travelers_num, budget, travel_preferences)
                         VALUES(%s, %s, %s, %s, %s, %s)
@@ -49,28 +290,221 @@ insert_trips_table_no_user_id = """INSERT INTO trips (destination, days_num,
                             VALUES(%s, %s, %s, %s, %s)
                             RETURNING trip_id;"""
 
+# trip with an id from sharding.allocate_trip_id, nothing is returned if
+#   the id is taken
+insert_shard_trips_table = """INSERT INTO trips (trip_id, user_id,
+                        destination, days_num, travelers_num, budget,
+                        travel_preferences)
+                        VALUES(%s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (trip_id) DO NOTHING
+                        RETURNING trip_id;"""
+
 insert_messages_table = """INSERT INTO messages (trip_id, role, content_type,
-                            content_text, message_category)
-                            VALUES(%s, %s, %s, %s, %s)
+                            content_text, content_hash, message_category)
+                            VALUES(%s, %s, %s, %s, %s, %s)
                             RETURNING message_id;"""
 
+insert_message_blob = """INSERT INTO message_blobs (content_hash, content_text)
+                        VALUES(%s, %s)
+                        ON CONFLICT (content_hash) DO NOTHING;"""
+
+# moves every text of at least %s characters into message_blobs
+dedupe_message_blobs = """INSERT INTO message_blobs (content_hash,
+                            content_text)
+                        SELECT DISTINCT
+                            sha256(convert_to(content_text, 'UTF8')),
+                            content_text
+                        FROM messages
+                        WHERE content_hash IS NULL
+                            AND length(content_text) >= %s
+                        ON CONFLICT (content_hash) DO NOTHING;"""
+
+dedupe_messages = """UPDATE messages
+                    SET content_hash = sha256(convert_to(content_text,
+                                                         'UTF8')),
+                        content_text = NULL
+                    WHERE content_hash IS NULL
+                        AND length(content_text) >= %s;"""
+
+# blobs no message references anymore (their trips were deleted)
+delete_unused_blobs = """DELETE FROM message_blobs b
+                        WHERE NOT EXISTS (SELECT 1 FROM messages m
+                            WHERE m.content_hash = b.content_hash);"""
+
+# bytes of text messages reference vs bytes message_blobs stores
+select_blob_report = """SELECT
+                        (SELECT COUNT(*) FROM messages
+                            WHERE content_hash IS NOT NULL),
+                        (SELECT COALESCE(SUM(octet_length(b.content_text)), 0)
+                            FROM messages m JOIN message_blobs b
+                            ON b.content_hash = m.content_hash),
+                        (SELECT COUNT(*) FROM message_blobs),
+                        (SELECT COALESCE(SUM(octet_length(content_text)), 0)
+                            FROM message_blobs);"""
+
 insert_profiles_table = """INSERT INTO profiles (user_id, age,
                             travelStyle, travelPriorities, travelAvoidances,
-                            dietaryRestrictions, accomodations)
-                            VALUES(%s, %s, %s, %s, %s, %s, %s)
+                            dietaryRestrictions, accomodations,
+                            profile_prompt, profile_prompt_tokens)
+                            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
                             RETURNING profile_id;"""
 
-# returns the entire chat history
-select_message = """SELECT role, content_type, content_text, message_category
-                    FROM messages
-                    WHERE trip_id=%s
-                    ORDER BY message_id;"""
+# returns the entire chat history, system prompts first so every
+#   conversation starts with the same prefix. Batch results (weather and
+#   recommendations) are stored with the trip but are not part of the chat
+#   message texts stored in message_blobs are resolved with one join
+select_message = """SELECT m.role, m.content_type,
+                        COALESCE(m.content_text, b.content_text),
+                        m.message_category
+                    FROM messages m
+                    LEFT JOIN message_blobs b
+                        ON b.content_hash = m.content_hash
+                    WHERE m.trip_id=%s
+                    AND m.message_category NOT IN
+                        ('WEATHER', 'RECOMMENDATION')
+                    ORDER BY m.message_category <> 'SYSTEMPROMPT',
+                        m.message_id;"""
+
+# appends one message object to a trip's conversation snapshot
+append_conversation = """UPDATE conversations
+                        SET messages = messages
+                                || jsonb_build_array(%s::jsonb),
+                            last_message_id = %s
+                        WHERE trip_id=%s;"""
+
+select_conversation = """SELECT messages FROM conversations
+                        WHERE trip_id=%s;"""
+
+# rebuilds trip snapshots from the messages table,
+#   in the same order as select_message
+rebuild_conversations = """INSERT INTO conversations (trip_id, messages,
+                            last_message_id)
+                        SELECT m.trip_id,
+                            jsonb_agg(jsonb_build_object(
+                                'role', m.role,
+                                'content', jsonb_build_array(
+                                    jsonb_build_object(
+                                        'type', m.content_type,
+                                        'text', COALESCE(m.content_text,
+                                                         b.content_text))))
+                                ORDER BY
+                                    m.message_category <> 'SYSTEMPROMPT',
+                                    m.message_id),
+                            MAX(m.message_id)
+                        FROM messages m
+                        LEFT JOIN message_blobs b
+                            ON b.content_hash = m.content_hash
+                        WHERE m.message_category NOT IN
+                            ('WEATHER', 'RECOMMENDATION') {trip_filter}
+                        GROUP BY m.trip_id
+                        ON CONFLICT (trip_id) DO UPDATE
+                        SET messages = EXCLUDED.messages,
+                            last_message_id = EXCLUDED.last_message_id;"""
+
+# tells other prompt-svc workers a trip's conversation changed
+#   (delivered on commit), payload is "<trip_id>:<worker id>"
+notify_conversation = """SELECT pg_notify('conversations', %s);"""
+
+# tells other prompt-svc workers a user's profile changed, payload is
+#   "<user_id>:<worker id>"
+notify_profile = """SELECT pg_notify('profiles', %s);"""
+
+listen_cache_changes = """LISTEN conversations;
+                        LISTEN profiles;"""
+
+# every trip, for the backfill command
+backfill_conversations = rebuild_conversations.format(trip_filter="")
+
+# a single trip, when its first snapshot append finds no snapshot
+seed_conversation = rebuild_conversations.format(
+    trip_filter="AND m.trip_id=%s")
+
+select_latest_itinerary_version = """SELECT COALESCE(MAX(version), 0)
+                        FROM itinerary_versions
+                        WHERE trip_id=%s;"""
+
+# no row back when a concurrent update already took the version
+insert_itinerary_version = """INSERT INTO itinerary_versions (trip_id,
+                            version, message_id, is_snapshot, body)
+                        VALUES(%s, %s, %s, %s, %s)
+                        ON CONFLICT (trip_id, version) DO NOTHING
+                        RETURNING version;"""
+
+select_itinerary_versions = """SELECT version, message_id, is_snapshot,
+                            octet_length(body), created_at
+                        FROM itinerary_versions
+                        WHERE trip_id=%s
+                        ORDER BY version;"""
+
+# the rows needed to rebuild one version: the closest snapshot at or
+#   before it, and every delta after that snapshot up to the version
+select_itinerary_chain = """SELECT version, is_snapshot, body
+                        FROM itinerary_versions
+                        WHERE trip_id=%s AND version <= %s
+                            AND version >= (SELECT MAX(version)
+                                FROM itinerary_versions
+                                WHERE trip_id=%s AND version <= %s
+                                    AND is_snapshot)
+                        ORDER BY version;"""
+
+# chat messages of a trip that still need an embedding of the model, after
+#   a routing change too
+select_unembedded_messages = """SELECT m.message_id,
+                            COALESCE(m.content_text, b.content_text)
+                        FROM messages m
+                        LEFT JOIN message_blobs b
+                            ON b.content_hash = m.content_hash
+                        LEFT JOIN message_embeddings e
+                            ON e.message_id = m.message_id
+                        WHERE m.trip_id=%s
+                            AND m.message_category IN ('USERCHAT', 'GPTCHAT')
+                            AND (e.message_id IS NULL OR e.model <> %s)
+                        ORDER BY m.message_id;"""
 
-# returns only itinerary message where the first row is the most recent
-select_recent_itinerary = """SELECT role, content_type, content_text,
-                            message_category FROM messages
-                            WHERE trip_id=%s AND message_category='ITINERARY'
-                            ORDER BY message_id DESC;"""
+# embeddings of another model are replaced
+insert_message_embeddings = """INSERT INTO message_embeddings (message_id,
+                            trip_id, model, embedding)
+                        VALUES %s
+                        ON CONFLICT (message_id) DO UPDATE
+                        SET model = EXCLUDED.model,
+                            embedding = EXCLUDED.embedding;"""
+
+select_cached_embeddings = """SELECT content_hash, embedding
+                        FROM embedding_cache
+                        WHERE model=%s AND content_hash = ANY(%s);"""
+
+insert_cached_embeddings = """INSERT INTO embedding_cache (content_hash,
+                            model, embedding)
+                        VALUES %s
+                        ON CONFLICT (content_hash, model) DO NOTHING;"""
+
+# the chat history with message ids, categories and embeddings, in the
+#   same order as select_message
+select_chat_turns = """SELECT m.message_id, m.role, m.content_type,
+                        COALESCE(m.content_text, b.content_text),
+                        m.message_category, e.embedding
+                    FROM messages m
+                    LEFT JOIN message_blobs b
+                        ON b.content_hash = m.content_hash
+                    LEFT JOIN message_embeddings e
+                        ON e.message_id = m.message_id AND e.model = %s
+                    WHERE m.trip_id=%s
+                    AND m.message_category NOT IN
+                        ('WEATHER', 'RECOMMENDATION')
+                    ORDER BY m.message_category <> 'SYSTEMPROMPT',
+                        m.message_id;"""
+
+# returns only the most recent itinerary message
+select_recent_itinerary = """SELECT m.role, m.content_type,
+                            COALESCE(m.content_text, b.content_text),
+                            m.message_category
+                            FROM messages m
+                            LEFT JOIN message_blobs b
+                                ON b.content_hash = m.content_hash
+                            WHERE m.trip_id=%s
+                                AND m.message_category='ITINERARY'
+                            ORDER BY m.message_id DESC
+                            LIMIT 1;"""
 
 select_all_trips = """SELECT trip_id, user_id, destination,
                 days_num, travelers_num, budget, travel_preferences
@@ -96,11 +530,251 @@ select_profile = """SELECT profile_id, user_id, age,
 update_profiles_table = """UPDATE profiles
                            SET (age,
                             travelStyle, travelPriorities, travelAvoidances,
-                            dietaryRestrictions, accomodations)
-                            = (%s, %s, %s, %s, %s, %s)
+                            dietaryRestrictions, accomodations,
+                            profile_prompt, profile_prompt_tokens)
+                            = (%s, %s, %s, %s, %s, %s, %s, %s),
+                            profile_version = profile_version + 1
                             WHERE user_id=%s
                             RETURNING profile_id;"""
 
+# WAL position of the last commit, on the primary
+select_current_lsn = """SELECT pg_current_wal_lsn()::text;"""
+
+# whether a replica replayed the WAL up to %s, false on a primary
+select_replica_caught_up = """SELECT COALESCE(
+                            pg_last_wal_replay_lsn() >= %s::pg_lsn, FALSE);"""
+
+# ETag sources of the GET routes, index-only lookups
+select_trip_etag = """SELECT COALESCE(MAX(message_id), 0) FROM messages
+                    WHERE trip_id=%s AND message_category='ITINERARY';"""
+
+select_history_etag = """SELECT COUNT(*), COALESCE(MAX(trip_id), 0)
+                        FROM trips
+                        WHERE user_id=%s;"""
+
+select_profile_etag = """SELECT profile_id, profile_version FROM profiles
+                        WHERE user_id=%s;"""
+
+# returns the profile block rendered when the profile was written
+select_profile_prompt = """SELECT profile_prompt FROM profiles
+                        WHERE user_id=%s;"""
+
+update_profile_prompt = """UPDATE profiles
+                        SET (profile_prompt, profile_prompt_tokens) = (%s, %s)
+                        WHERE user_id=%s;"""
+
+insert_batches_table = """INSERT INTO batches (batch_id, kind, status,
+                            request_count)
+                            VALUES(%s, %s, %s, %s)
+                            RETURNING batch_id;"""
+
+update_batches_table = """UPDATE batches
+                          SET (status, output_file_id, updated_at)
+                            = (%s, %s, NOW())
+                          WHERE batch_id=%s;"""
+
+# no row back when the result was written by an earlier collect
+insert_batch_result = """INSERT INTO batch_results (batch_id, custom_id,
+                            trip_id)
+                        VALUES(%s, %s, %s)
+                        ON CONFLICT (batch_id, custom_id) DO NOTHING
+                        RETURNING batch_id;"""
+
+# batches that haven't finished or haven't had their results written yet
+select_open_batches = """SELECT batch_id, kind, status, request_count,
+                        output_file_id
+                        FROM batches
+                        WHERE status NOT IN ('written', 'failed',
+                                             'expired', 'cancelled')
+                        ORDER BY created_at;"""
+
+# number of trips per destination, length and budget
+select_trip_buckets = """SELECT destination, days_num, budget, COUNT(*)
+                        FROM trips
+                        GROUP BY destination, days_num, budget;"""
+
+insert_base_itineraries_table = """INSERT INTO base_itineraries
+                            (destination, days_num, budget_bucket, version,
+                             prompt_version, content_text)
+                            SELECT %s, %s, %s, COALESCE(MAX(version), 0) + 1,
+                                %s, %s
+                            FROM base_itineraries
+                            WHERE destination=%s AND days_num=%s
+                                AND budget_bucket=%s
+                            RETURNING version;"""
+
+# returns the latest base itinerary built from the current prompts
+select_base_itinerary = """SELECT content_text FROM base_itineraries
+                        WHERE destination=%s AND days_num=%s
+                            AND budget_bucket=%s AND prompt_version=%s
+                        ORDER BY version DESC
+                        LIMIT 1;"""
+
+# claims a key for a new request, taking over an expired one
+#   nothing is returned if the key is held or complete
+claim_idempotency_key = """INSERT INTO idempotency_keys (idempotency_key,
+                            request_hash, status, expires_at)
+                        VALUES(%s, %s, 'in_progress',
+                            NOW() + make_interval(secs => %s))
+                        ON CONFLICT (idempotency_key) DO UPDATE
+                        SET request_hash = EXCLUDED.request_hash,
+                            status = 'in_progress',
+                            status_code = NULL,
+                            content_type = NULL,
+                            body = NULL,
+                            created_at = NOW(),
+                            expires_at = EXCLUDED.expires_at
+                        WHERE idempotency_keys.expires_at < NOW()
+                        RETURNING idempotency_key;"""
+
+select_idempotency_key = """SELECT request_hash, status, status_code,
+                            content_type, body
+                        FROM idempotency_keys
+                        WHERE idempotency_key=%s AND expires_at >= NOW();"""
+
+complete_idempotency_key = """UPDATE idempotency_keys
+                        SET status = 'complete',
+                            status_code = %s,
+                            content_type = %s,
+                            body = %s,
+                            expires_at = NOW() + make_interval(secs => %s)
+                        WHERE idempotency_key=%s;"""
+
+release_idempotency_key = """DELETE FROM idempotency_keys
+                        WHERE idempotency_key=%s AND status='in_progress';"""
+
+delete_expired_idempotency_keys = """DELETE FROM idempotency_keys
+                        WHERE expires_at < NOW();"""
+
+# serializes the model calls of a trip across workers, see
+#   PostgresDB.lock_trip, session locks outlive the transaction
+try_lock_trip_requests = """SELECT pg_try_advisory_lock(%s::bigint);"""
+
+lock_trip_requests = """SELECT set_config('lock_timeout', %s, true);
+                        SELECT pg_advisory_lock(%s::bigint);"""
+
+unlock_trip_requests = """SELECT pg_advisory_unlock(%s::bigint);"""
+
+# the trip's newest itinerary, read on the primary
+select_latest_itinerary = """SELECT m.message_id,
+                            COALESCE(m.content_text, b.content_text)
+                        FROM messages m
+                        LEFT JOIN message_blobs b
+                            ON b.content_hash = m.content_hash
+                        WHERE m.trip_id=%s
+                            AND m.message_category='ITINERARY'
+                        ORDER BY m.message_id DESC
+                        LIMIT 1;"""
+
+# archiving trips untouched for months, see PostgresDB.archive_trips
+select_cold_trips = """SELECT trip_id FROM messages
+                        GROUP BY trip_id
+                        HAVING MAX(created_at)
+                            < NOW() - make_interval(months => %s)
+                        ORDER BY MAX(created_at)
+                        LIMIT %s;"""
+
+# holds off new messages of the trip until the archive is committed
+lock_trip = """SELECT trip_id FROM trips WHERE trip_id=%s FOR UPDATE;"""
+
+select_trip_cold = """SELECT COALESCE(MAX(created_at)
+                            < NOW() - make_interval(months => %s), FALSE)
+                        FROM messages
+                        WHERE trip_id=%s;"""
+
+# texts are exported inline, the trip's blobs may be deleted meanwhile
+export_trip_messages = """COPY (SELECT m.message_id, m.trip_id, m.role,
+                            m.content_type,
+                            COALESCE(m.content_text, b.content_text),
+                            m.message_category, m.created_at
+                        FROM messages m
+                        LEFT JOIN message_blobs b
+                            ON b.content_hash = m.content_hash
+                        WHERE m.trip_id=%s
+                        ORDER BY m.message_id) TO STDOUT;"""
+
+insert_archived_trip = """INSERT INTO archived_trips (trip_id,
+                            message_count, raw_bytes, archive)
+                        VALUES(%s, %s, %s, %s);"""
+
+# embeddings are rebuilt from embedding_cache once the trip is restored
+delete_archived_messages = """DELETE FROM message_embeddings
+                            WHERE trip_id=%s;
+                        DELETE FROM conversations WHERE trip_id=%s;
+                        DELETE FROM messages WHERE trip_id=%s;"""
+
+# a read, so trips that were never archived cost no write to restore
+select_trip_archived = """SELECT EXISTS (SELECT 1 FROM archived_trips
+                            WHERE trip_id=%s);"""
+
+# waits for an archive of the trip being committed, then takes the archive
+unarchive_trip = """SELECT trip_id FROM trips WHERE trip_id=%s FOR KEY SHARE;
+                    DELETE FROM archived_trips WHERE trip_id=%s
+                    RETURNING archive;"""
+
+# message ids are kept, they were never handed out again
+import_trip_messages = """COPY messages (message_id, trip_id, role,
+                            content_type, content_text, message_category,
+                            created_at) FROM STDIN;"""
+
+select_archive_report = """SELECT COUNT(*), COALESCE(SUM(message_count), 0),
+                            COALESCE(SUM(raw_bytes), 0),
+                            COALESCE(SUM(octet_length(archive)), 0)
+                        FROM archived_trips;"""
+
+# moving a trip between shards, see PostgresDB.move_trip
+select_trip_ids = """SELECT trip_id FROM trips ORDER BY trip_id;"""
+
+select_trip_messages = """SELECT m.message_id, m.role, m.content_type,
+                        m.content_text, m.content_hash, b.content_text,
+                        m.message_category, m.created_at
+                        FROM messages m
+                        LEFT JOIN message_blobs b
+                            ON b.content_hash = m.content_hash
+                        WHERE m.trip_id=%s
+                        ORDER BY m.message_id;"""
+
+copy_message = """INSERT INTO messages (trip_id, role, content_type,
+                            content_text, content_hash, message_category,
+                            created_at)
+                        VALUES(%s, %s, %s, %s, %s, %s, %s)
+                        RETURNING message_id;"""
+
+select_trip_conversation = """SELECT messages::text, last_message_id
+                        FROM conversations
+                        WHERE trip_id=%s;"""
+
+insert_conversation = """INSERT INTO conversations (trip_id, messages,
+                            last_message_id)
+                        VALUES(%s, %s::jsonb, %s);"""
+
+select_trip_itinerary_versions = """SELECT version, message_id,
+                        is_snapshot, body, created_at
+                        FROM itinerary_versions
+                        WHERE trip_id=%s;"""
+
+copy_itinerary_version = """INSERT INTO itinerary_versions (trip_id,
+                            version, message_id, is_snapshot, body,
+                            created_at)
+                        VALUES(%s, %s, %s, %s, %s, %s);"""
+
+select_trip_embeddings = """SELECT message_id, model, embedding
+                        FROM message_embeddings
+                        WHERE trip_id=%s;"""
+
+select_trip_batch_results = """SELECT batch_id, custom_id, created_at
+                        FROM batch_results
+                        WHERE trip_id=%s;"""
+
+copy_batch_result = """INSERT INTO batch_results (batch_id, custom_id,
+                            trip_id, created_at)
+                        VALUES(%s, %s, %s, %s)
+                        ON CONFLICT (batch_id, custom_id) DO NOTHING;"""
+
+# deletes the trip's messages, snapshot, versions, embeddings and batch
+#   results too
+delete_trip = """DELETE FROM trips WHERE trip_id=%s;"""
+
 # CASCADE means delete all data in other table that references this table
 drop_trips_table = """DROP table trips CASCADE;"""
 
@@ -0,0 +1,140 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+"""Maintenance commands for prompt-svc's Postgres database.
+
+Create or upgrade the tables of the database and of every shard, once per
+deploy (the Procfile's release phase) and never from a request, since
+ALTER TABLE and CREATE INDEX lock tables that requests are using:
+    $ python -m service.postgres.maintenance migrate
+
+Rebuild the conversation snapshot of every existing trip:
+    $ python -m service.postgres.maintenance backfill-conversations
+
+Move repeated message texts into message_blobs and report bytes saved:
+    $ python -m service.postgres.maintenance dedupe-messages
+    $ python -m service.postgres.maintenance dedupe-messages --min-length 64
+    $ python -m service.postgres.maintenance blob-report
+
+Move trips to the shard owning them after DATABASE_SHARD_URLS or
+DATABASE_DRAIN_SHARDS changed, see sharding.py:
+    $ python -m service.postgres.maintenance rebalance --dry-run
+    $ python -m service.postgres.maintenance rebalance
+An unsharded database is migrated by listing it as one of the shards.
+
+Move messages into a table partitioned by month (once, for databases
+created before it was), create the coming months' partitions, archive
+trips without a new message for months and report bytes saved:
+    $ python -m service.postgres.maintenance partition-messages
+    $ python -m service.postgres.maintenance create-partitions
+    $ python -m service.postgres.maintenance archive-trips --months 6
+    $ python -m service.postgres.maintenance archive-report
+Archived trips are restored when they are next read or written.
+Schedule create-partitions (or archive-trips, which also creates them) at
+least monthly: messages of a month without a partition go to
+messages_default.
+
+Delete expired Idempotency-Key responses (workers also do it hourly):
+    $ python -m service.postgres.maintenance expire-idempotency-keys
+"""
+
+import argparse
+
+from service.postgres.postgresdb import PostgresDB
+from service.postgres import sharding
+from service.postgres.records import BLOB_MIN_LENGTH, ARCHIVE_AFTER_MONTHS
+
+
+def migrate(postgressconn, args):
+    postgressconn.migrate()
+    print("Maintenance: schema migrated")
+
+
+def backfillConversations(postgressconn, args):
+    count = postgressconn.backfill_conversations()
+    print(f"Maintenance: {count or 0} conversation snapshots written")
+
+
+def printReport(report):
+    if report is None:
+        return
+    for name, value in report.items():
+        print(f"Maintenance: {name}: {value}")
+
+
+def dedupeMessages(postgressconn, args):
+    printReport(postgressconn.dedupe_messages(args.min_length))
+
+
+def blobReport(postgressconn, args):
+    printReport(postgressconn.get_blob_report())
+
+
+def rebalance(postgressconn, args):
+    if not sharding.enabled():
+        print("Maintenance: DATABASE_SHARD_URLS is not set")
+        return
+    moved = postgressconn.rebalance_trips(args.dry_run)
+    verb = "to move" if args.dry_run else "moved"
+    print(f"Maintenance: {moved or 0} trips {verb}")
+
+
+def partitionMessages(postgressconn, args):
+    moved = postgressconn.partition_messages()
+    print(f"Maintenance: {moved or 0} messages tables partitioned")
+
+
+def createPartitions(postgressconn, args):
+    postgressconn.create_partitions()
+    print("Maintenance: messages partitions created")
+
+
+def archiveTrips(postgressconn, args):
+    archived = postgressconn.archive_trips(args.months, args.limit)
+    print(f"Maintenance: {archived or 0} trips archived")
+    printReport(postgressconn.get_archive_report())
+
+
+def archiveReport(postgressconn, args):
+    printReport(postgressconn.get_archive_report())
+
+
+def expireIdempotencyKeys(postgressconn, args):
+    count = postgressconn.delete_expired_idempotency_keys()
+    print(f"Maintenance: {count or 0} expired idempotency keys deleted")
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "backfill-conversations": backfillConversations,
+    "dedupe-messages": dedupeMessages,
+    "blob-report": blobReport,
+    "rebalance": rebalance,
+    "partition-messages": partitionMessages,
+    "create-partitions": createPartitions,
+    "archive-trips": archiveTrips,
+    "archive-report": archiveReport,
+    "expire-idempotency-keys": expireIdempotencyKeys
+}
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=tuple(COMMANDS))
+    parser.add_argument("--min-length", type=int, default=BLOB_MIN_LENGTH,
+                        help="shortest text moved to message_blobs")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only list the trips rebalance would move")
+    parser.add_argument("--months", type=int, default=ARCHIVE_AFTER_MONTHS,
+                        help="archive trips without a message for this long")
+    parser.add_argument("--limit", type=int, default=1000,
+                        help="most trips archived per database")
+    args = parser.parse_args()
+
+    postgressconn = PostgresDB()
+    COMMANDS[args.command](postgressconn, args)
+    postgressconn.close_db_connection()
+
+
+if __name__ == '__main__':
+    run()
@@ -3,17 +3,93 @@
 """
 
 import service.postgres.SQLcmd as SQLcmd
+from service.postgres.records import (TRIP_COLUMNS, PROFILE_COLUMNS,
+                                      fetch_rows, row_to_dict,
+                                      rows_to_structs, rows_to_messages,
+                                      make_message, NON_CHAT_CATEGORIES,
+                                      blob_hash, BLOB_MIN_LENGTH,
+                                      add_months, month_partitions,
+                                      MESSAGE_PARTITIONS_AHEAD,
+                                      ARCHIVE_AFTER_MONTHS,
+                                      ARCHIVE_COMPRESSION_LEVEL)
+from service.serializer import serializer
+from service.serializer.serializer import Trip
+from service.cache.cache import db_cache, conversation_cache
+from service.itinerary import itinerary
+from service.postgres import sharding
 import psycopg2
+import psycopg2.extras
+import contextvars
+import threading
+import datetime
+import select
+import random
+import time
+import uuid
+import zlib
 import os
+import re
+import io
 from dotenv import load_dotenv
 
 load_dotenv()
 DATABASE_URL = os.environ['DATABASE_URL']
 
+# decode JSONB columns (conversation snapshots) with msgspec
+psycopg2.extras.register_default_jsonb(globally=True,
+                                       loads=serializer.decode)
 
-def init_db_connection():
+# drop other workers' cached conversations, itineraries and profiles when
+#   they change (Postgres LISTEN/NOTIFY), set to 0 to rely on the caches'
+#   TTLs, which bound how stale another worker's copy can get
+CACHE_NOTIFY = os.getenv('CACHE_NOTIFY', '1') == '1'
+
+# tells this worker's notifications apart from the other workers'
+WORKER_ID = uuid.uuid4().hex
+
+# seconds before a lost cache listener connects again, doubled after every
+#   failed attempt up to LISTEN_RETRY_MAX
+LISTEN_RETRY_DELAY = 1.0
+LISTEN_RETRY_MAX = 60.0
+
+# databases whose cache listener is disconnected, conversations aren't
+#   cached meanwhile as other workers' turns would go unnoticed
+listeners_down = set()
+
+# read replicas, comma separated connection strings, used by the read-only
+#   methods once they have replayed the user's last write
+DATABASE_REPLICA_URLS = [url.strip() for url in
+                         os.getenv('DATABASE_REPLICA_URLS', '').split(',')
+                         if url.strip()]
+
+# WAL position of the user's last write, replicas behind it aren't read
+#   set by main.py from the client's cookie or header for every request
+read_after_lsn = contextvars.ContextVar('read_after_lsn', default=None)
+
+# WAL position of the current request's last write, sent back to the client
+written_lsn = contextvars.ContextVar('written_lsn', default=None)
+
+# seconds a request waits for another request on the same trip, see
+#   lock_trip, it then goes ahead without the lock
+TRIP_LOCK_TIMEOUT = float(os.getenv('TRIP_LOCK_TIMEOUT', '120'))
+
+# times a new itinerary version is numbered again after a concurrent
+#   update of the trip took its number, see add_itinerary_version
+ITINERARY_VERSION_ATTEMPTS = 5
+
+LSN_FORMAT = re.compile(r'^[0-9A-F]{1,8}/[0-9A-F]{1,8}$')
+
+
+# Returns an LSN like "16/B374D848" sent by a client, None if malformed
+def parse_lsn(text):
+    if text is None or not LSN_FORMAT.match(text.upper()):
+        return None
+    return text.upper()
+
+
+def init_db_connection(url=DATABASE_URL):
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = psycopg2.connect(url)
         # can also change to auto commit (no need for cur.commit
         #   after SQL execution)
         # conn.autocommit = 1
@@ -24,37 +100,348 @@ def init_db_connection():
         print(f'Postgres: Could not connect to the Database: {error}.')
 
 
+# Drops cached trips' conversations and itineraries, and cached profiles,
+#   changed by other workers
+#   runs forever on its own connection, see start_cache_listener. A lost
+#   connection (database restart, failover) is opened again with backoff,
+#   the caches are cleared as changes sent meanwhile were missed.
+def listen_cache_changes(url=DATABASE_URL):
+    delay = LISTEN_RETRY_DELAY
+    lost = False
+    while True:
+        conn = init_db_connection(url)
+        try:
+            if conn is None:
+                raise psycopg2.OperationalError("no connection")
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.listen_cache_changes)
+            if lost:
+                # entries cached while disconnected may be stale too
+                db_cache.clear()
+                conversation_cache.clear()
+                listeners_down.discard(url)
+                print("Postgres: Cache listener reconnected.")
+                lost = False
+            delay = LISTEN_RETRY_DELAY
+            receive_cache_changes(conn)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Cache listener disconnected: {error}, '
+                  f'reconnecting in {delay:.0f}s.')
+        finally:
+            if conn is not None:
+                conn.close()
+
+        lost = True
+        listeners_down.add(url)
+        db_cache.clear()
+        conversation_cache.clear()
+        time.sleep(delay)
+        delay = min(delay * 2, LISTEN_RETRY_MAX)
+
+
+# Applies the notifications received on a listening connection
+#   returns only by raising, when the connection is lost
+def receive_cache_changes(conn):
+    while True:
+        if select.select([conn], [], [], 60) == ([], [], []):
+            continue
+        conn.poll()
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            key, _, worker_id = notify.payload.rpartition(':')
+            if worker_id == WORKER_ID:
+                continue
+            if notify.channel == 'profiles':
+                db_cache.invalidate(("profile", key))
+                db_cache.invalidate(("profile_prompt", key))
+            else:
+                conversation_cache.invalidate(("conversation", key))
+                db_cache.invalidate(("itinerary", key))
+
+
+# Starts the cross-worker invalidation listeners if CACHE_NOTIFY is set
+def start_cache_listener():
+    if not CACHE_NOTIFY:
+        return
+    # profiles are notified on the home database, trips on the shard
+    #   that owns them
+    urls = [DATABASE_URL] + [url for url in sharding.SHARDS.values()
+                             if url != DATABASE_URL]
+    for url in urls:
+        listener = threading.Thread(target=listen_cache_changes,
+                                    args=(url, ),
+                                    name="cache-listener",
+                                    daemon=True)
+        listener.start()
+    print(f"Postgres: listening for cache changes "
+          f"on {len(urls)} database(s)")
+
+
+# Creates or upgrades the tables, see PostgresDB.migrate
+def migrate_database():
+    postgressconn = PostgresDB()
+    postgressconn.migrate()
+    postgressconn.close_db_connection()
+
+
 class PostgresDB():
 
     def __init__(self) -> None:
         self.conn = init_db_connection()
-        self.create_table()  # Creates tables if they don't exist
+        self.replica_conn = None    # picked on the first read, see read_conn
+        self.shard_conns = {}       # connected on first use, see shard_conn
+        # tables are created by migrate, once per deploy: ALTER TABLE and
+        #   CREATE INDEX lock tables that other requests hold during model
+        #   calls, so running them here serialized every request
 
     # close connection with Postgres
     def close_db_connection(self):
         # close the communication with the database server
         #   by calling the close()
+        self.release_replica()
+        for conn in self.shard_conns.values():
+            conn.close()
+        self.shard_conns = {}
         if self.conn is not None:
             self.conn.close()
             print('Postgres: Database connection closed.')
 
-    # create trips and messages table (only use once)
+    # commit a write, and remember its WAL position when replicas are read
+    #   so the user's next reads wait for a replica that replayed it
+    #   conn is a shard's connection for trip-scoped writes
+    def commit(self, conn=None):
+        if conn is not None and conn is not self.conn:
+            conn.commit()
+            return
+        self.conn.commit()
+        if not DATABASE_REPLICA_URLS:
+            return
+        with self.conn.cursor() as cur:
+            cur.execute(SQLcmd.select_current_lsn)
+            written_lsn.set(cur.fetchone()[0])
+        self.conn.commit()
+        # reads after this write pick their connection again
+        self.release_replica()
+
+    def release_replica(self):
+        replica_conn, self.replica_conn = self.replica_conn, None
+        if replica_conn is not None and replica_conn is not self.conn:
+            replica_conn.close()
+
+    # connection of the read-only methods: a replica that replayed the
+    #   user's last write, the primary if there is none
+    def read_conn(self):
+        if not DATABASE_REPLICA_URLS:
+            return self.conn
+        if self.replica_conn is None:
+            self.replica_conn = self.caught_up_replica() or self.conn
+        return self.replica_conn
+
+    def caught_up_replica(self):
+        min_lsn = written_lsn.get() or read_after_lsn.get()
+        for url in random.sample(DATABASE_REPLICA_URLS,
+                                 len(DATABASE_REPLICA_URLS)):
+            conn = init_db_connection(url)
+            if conn is None:
+                continue
+            conn.autocommit = True
+            if min_lsn is None:
+                return conn
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_replica_caught_up, (min_lsn, ))
+                    if cur.fetchone()[0]:
+                        return conn
+                print(f"Postgres: replica behind {min_lsn}, trying another")
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(f'Postgres: Could not check replica: {error}.')
+            conn.close()
+        return None
+
+    # connection of a shard by name
+    # returns None if the shard can't be reached
+    def shard_conn(self, name):
+        conn = self.shard_conns.get(name)
+        if conn is None:
+            conn = init_db_connection(sharding.SHARDS[name])
+            if conn is None:
+                return None
+            self.shard_conns[name] = conn
+        return conn
+
+    # connection holding a trip's data: the shard owning trip_id, or
+    #   the home database when trips aren't sharded
+    def trip_conn(self, trip_id):
+        if not sharding.enabled():
+            return self.conn
+        return self.shard_conn(sharding.ring.shard_for(trip_id))
+
+    # connection of the read-only trip methods, replicas only serve the
+    #   home database
+    def trip_read_conn(self, trip_id):
+        if not sharding.enabled():
+            return self.read_conn()
+        return self.trip_conn(trip_id)
+
+    # connections holding trips, draining shards included since their
+    #   trips are readable until the rebalance command moved them
+    def trip_conns(self, read=False):
+        if not sharding.enabled():
+            return [self.read_conn() if read else self.conn]
+        return [self.shard_conn(name) for name in sharding.SHARDS]
+
+    # create or upgrade the tables of the home database and of every shard
+    #   run once per deploy by the migrate maintenance command
+    def migrate(self):
+        self.create_table()
+        for name in sharding.SHARDS:
+            conn = self.shard_conn(name)
+            if conn is not None:
+                self.create_shard_tables(conn)
+
+    # create trips and messages table (only use once, see migrate)
     def create_table(self):
         try:
             # create a new cursor, with statement will auto close the cursor
             with self.conn.cursor() as cur:
                 cur.execute(SQLcmd.create_trips_table)
                 print('Postgres: trips table created.')
+                cur.execute(SQLcmd.create_message_blobs_table)
                 cur.execute(SQLcmd.create_messages_table)
+                cur.execute(SQLcmd.alter_messages_table_blobs)
+                cur.execute(SQLcmd.alter_messages_table_created)
                 print('Postgres: messages table created.')
+                cur.execute(SQLcmd.create_archived_trips_table)
+                print('Postgres: archived_trips table created.')
                 cur.execute(SQLcmd.create_profiles_table)
+                cur.execute(SQLcmd.alter_profiles_table_prompt)
+                cur.execute(SQLcmd.alter_profiles_table_version)
+                cur.execute(SQLcmd.create_messages_trip_index)
+                cur.execute(SQLcmd.create_trips_user_index)
+                cur.execute(SQLcmd.create_profiles_user_index)
                 print('Postgres: profiles table created.')
+                cur.execute(SQLcmd.create_conversations_table)
+                print('Postgres: conversations table created.')
+                cur.execute(SQLcmd.create_batches_table)
+                cur.execute(SQLcmd.create_batch_results_table)
+                print('Postgres: batches table created.')
+                cur.execute(SQLcmd.create_base_itineraries_table)
+                print('Postgres: base_itineraries table created.')
+                cur.execute(SQLcmd.create_itinerary_versions_table)
+                print('Postgres: itinerary_versions table created.')
+                cur.execute(SQLcmd.create_message_embeddings_table)
+                cur.execute(SQLcmd.create_message_embeddings_index)
+                print('Postgres: message_embeddings table created.')
+                cur.execute(SQLcmd.create_embedding_cache_table)
+                print('Postgres: embedding_cache table created.')
+                cur.execute(SQLcmd.create_idempotency_keys_table)
+                cur.execute(SQLcmd.create_idempotency_keys_index)
+                print('Postgres: idempotency_keys table created.')
                 # commit changes to database
                 self.conn.commit()
+            self.create_message_partitions(self.conn)
             return
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Postgres: Could not create tables: {error}.')
 
+    # create the trip-scoped tables of a shard
+    def create_shard_tables(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.create_shard_trips_table)
+                cur.execute(SQLcmd.create_message_blobs_table)
+                cur.execute(SQLcmd.create_messages_table)
+                cur.execute(SQLcmd.alter_messages_table_created)
+                cur.execute(SQLcmd.create_messages_trip_index)
+                cur.execute(SQLcmd.create_archived_trips_table)
+                cur.execute(SQLcmd.create_trips_user_index)
+                cur.execute(SQLcmd.create_conversations_table)
+                cur.execute(SQLcmd.create_itinerary_versions_table)
+                cur.execute(SQLcmd.create_message_embeddings_table)
+                cur.execute(SQLcmd.create_message_embeddings_index)
+                cur.execute(SQLcmd.create_batch_results_table)
+                conn.commit()
+                print('Postgres: shard tables created.')
+            self.create_message_partitions(conn)
+        except (Exception, psycopg2.DatabaseError) as error:
+            conn.rollback()
+            print(f'Postgres: Could not create shard tables: {error}.')
+
+    # create the messages partitions of this month and the next
+    #   MESSAGE_PARTITIONS_AHEAD months, each in its own transaction: a
+    #   month whose rows already went to messages_default is skipped
+    def create_message_partitions(self, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.select_messages_partitioned)
+                partitioned = cur.fetchone()[0]
+            conn.commit()
+            if not partitioned:
+                print('Postgres: messages is not partitioned yet, '
+                      'see the partition-messages maintenance command.')
+                return
+
+            this_month = add_months(datetime.date.today(), 0)
+            months = [add_months(this_month, offset)
+                      for offset in range(MESSAGE_PARTITIONS_AHEAD + 1)]
+            for month in months:
+                try:
+                    with conn.cursor() as cur:
+                        self.add_message_partitions(cur, [month])
+                    conn.commit()
+                except psycopg2.DatabaseError as error:
+                    conn.rollback()
+                    print(f'Postgres: Could not create messages partition '
+                          f'of {month}: {error}.')
+        except (Exception, psycopg2.DatabaseError) as error:
+            conn.rollback()
+            print(f'Postgres: Could not create messages partitions: {error}.')
+
+    # create the default partition and the partitions of months, inside
+    #   the caller's transaction
+    def add_message_partitions(self, cur, months):
+        cur.execute(SQLcmd.create_messages_default_partition)
+        for name, start, end in month_partitions(months):
+            cur.execute(SQLcmd.create_messages_partition.format(name=name),
+                        (start, end))
+
+    # move every unpartitioned messages table into a partitioned one
+    # returns the number of tables moved
+    def partition_messages(self):
+        moved = 0
+        conn = self.conn
+        try:
+            for conn in self.trip_conns():
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_messages_partitioned)
+                    if cur.fetchone()[0]:
+                        conn.rollback()
+                        continue
+                    for statement in SQLcmd.partition_messages:
+                        cur.execute(statement)
+                    cur.execute(SQLcmd.select_unpartitioned_months)
+                    months = {row[0] for row in fetch_rows(cur)}
+                    this_month = add_months(datetime.date.today(), 0)
+                    months.update(
+                        add_months(this_month, offset)
+                        for offset in range(MESSAGE_PARTITIONS_AHEAD + 1))
+                    self.add_message_partitions(cur, sorted(months))
+                    for statement in SQLcmd.copy_unpartitioned_messages:
+                        cur.execute(statement)
+                    cur.execute(SQLcmd.create_messages_trip_index)
+                    self.commit(conn)
+                moved += 1
+                print(f"Postgres: messages partitioned into {len(months)} "
+                      f"months.")
+            return moved
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not partition messages: {error}.')
+
     # list all tables in database
     def get_tables(self):
         with self.conn.cursor() as cur:
@@ -70,6 +457,10 @@ class PostgresDB():
     def create_trip_to_db(self, destination, days_num, travelers_num, budget,
                           travel_preferences, user_id=None):
         # print(user_id)
+        if sharding.enabled():
+            return self.create_shard_trip(destination, days_num,
+                                          travelers_num, budget,
+                                          travel_preferences, user_id)
         try:
             # create a new cursor, with statement will auto close the cursor
             with self.conn.cursor() as cur:
@@ -86,7 +477,7 @@ class PostgresDB():
                                     budget, travel_preferences))
 
                 # commit the changes to the database
-                self.conn.commit()
+                self.commit()
 
                 # get the generated id back
                 rows = cur.fetchone()
@@ -95,7 +486,50 @@ class PostgresDB():
 
                 print('Postgres: create trip successful.')
 
-                return trip_id
+            # write-through: the new trip is likely read back right away
+            db_cache.put(("trip", str(trip_id)),
+                         row_to_dict(TRIP_COLUMNS,
+                                     (trip_id, user_id, destination,
+                                      days_num, travelers_num, budget,
+                                      travel_preferences)))
+
+            return trip_id
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not insert trip to the Database: {error}.')
+
+    # create a new trip on the shard owning a newly allocated id
+    #   an id already taken on its shard is replaced by another one
+    def create_shard_trip(self, destination, days_num, travelers_num,
+                          budget, travel_preferences, user_id=None):
+        trip_id = None
+        try:
+            for attempt in range(sharding.ID_ATTEMPTS):
+                new_trip_id = sharding.allocate_trip_id()
+                conn = self.trip_conn(new_trip_id)
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.insert_shard_trips_table,
+                                (new_trip_id, user_id, destination,
+                                 days_num, travelers_num, budget,
+                                 travel_preferences))
+                    rows = cur.fetchone()
+                self.commit(conn)
+                if rows:
+                    trip_id = rows[0]
+                    break
+                print(f"Postgres: trip id {new_trip_id} taken, retrying.")
+
+            if trip_id is None:
+                raise psycopg2.DatabaseError("no free trip id found")
+            print('Postgres: create trip successful.')
+
+            db_cache.put(("trip", str(trip_id)),
+                         row_to_dict(TRIP_COLUMNS,
+                                     (trip_id, user_id, destination,
+                                      days_num, travelers_num, budget,
+                                      travel_preferences)))
+
+            return trip_id
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Postgres: Could not insert trip to the Database: {error}.')
@@ -103,63 +537,252 @@ class PostgresDB():
     # create a new message to messages table
     def create_message_to_db(self, trip_id, role, content_type,
                              content_text, message_category):
+        conn = self.conn
         try:
+            conn = self.trip_conn(trip_id)
             # create a new cursor, with statement will auto close the cursor
-            with self.conn.cursor() as cur:
+            with conn.cursor() as cur:
+
+                # long texts are stored once in message_blobs and
+                #   referenced by hash
+                content_hash, stored_text = None, content_text
+                if content_text is not None and \
+                        len(content_text) >= BLOB_MIN_LENGTH:
+                    content_hash, stored_text = blob_hash(content_text), None
+                    cur.execute(SQLcmd.insert_message_blob,
+                                (content_hash, content_text))
 
                 # execute the INSERT statement
                 cur.execute(SQLcmd.insert_messages_table,
                             (trip_id, role, content_type,
-                             content_text, message_category))
-
-                # commit the changes to the database
-                self.conn.commit()
+                             stored_text, content_hash, message_category))
 
                 # get the generated id back
                 rows = cur.fetchone()
                 if rows:
                     message_id = rows[0]
 
+                # append to the trip's conversation snapshot in the same
+                #   transaction, so it never misses a message
+                if message_category == 'ITINERARY':
+                    self.add_itinerary_version(cur, trip_id, message_id,
+                                               content_text)
+
+                if message_category not in NON_CHAT_CATEGORIES:
+                    message_object = make_message(role, content_type,
+                                                  content_text)
+                    cur.execute(SQLcmd.append_conversation,
+                                (serializer.encode(message_object).decode(),
+                                 message_id, trip_id))
+                    # no snapshot yet: build it from every stored message,
+                    #   including the one just inserted, and the archived
+                    #   ones of a trip archived by archive_trips
+                    if cur.rowcount == 0:
+                        self.unarchive_trip(cur, trip_id)
+                        cur.execute(SQLcmd.seed_conversation, (trip_id, ))
+                    if CACHE_NOTIFY:
+                        cur.execute(SQLcmd.notify_conversation,
+                                    (f"{trip_id}:{WORKER_ID}", ))
+
+                # commit the changes to the database
+                self.commit(conn)
+
                 print(f"Postgres: New {message_category} message created.")
 
-                return message_id
+            # write-through: a new itinerary becomes the most recent one
+            if message_category == 'ITINERARY':
+                db_cache.put(("itinerary", str(trip_id)), content_text)
+
+            # write-through: extend the cached conversation, if any
+            if message_category not in NON_CHAT_CATEGORIES:
+                conversation_cache.append(("conversation", str(trip_id)),
+                                          message_object)
+
+            return message_id
 
         except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
             print(f'Could not insert message to the Database: {error}.')
 
+    # store the next version of a trip's itinerary, inside the caller's
+    #   transaction
+    # updates that gave up waiting for lock_trip can race for a version
+    #   number, the loser numbers and encodes its version again against the
+    #   winner's, instead of failing the whole message insert
+    # returns the version
+    def add_itinerary_version(self, cur, trip_id, message_id, content_text):
+        for attempt in range(ITINERARY_VERSION_ATTEMPTS):
+            cur.execute(SQLcmd.select_latest_itinerary_version, (trip_id, ))
+            version = cur.fetchone()[0] + 1
+            # the delta is taken from the stored previous version, a cached
+            #   recent itinerary may be another worker's stale copy
+            previous = None
+            if version > 1:
+                previous = self.get_itinerary_version(trip_id, version - 1)
+            is_snapshot, body = itinerary.encodeVersion(version, previous,
+                                                        content_text)
+            cur.execute(SQLcmd.insert_itinerary_version,
+                        (trip_id, version, message_id, is_snapshot, body))
+            if cur.fetchone() is not None:
+                return version
+            print(f"Postgres: itinerary version {version} of trip {trip_id} "
+                  f"was taken, numbering again.")
+
+        raise psycopg2.DatabaseError(
+            f"no free itinerary version for trip {trip_id}")
+
+    # list the itinerary versions of a trip
+    # returns an array of dictionaries, oldest version first
+    def get_itinerary_versions(self, trip_id):
+        try:
+            with self.trip_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_itinerary_versions, (trip_id, ))
+                versions = [{
+                    "version": version,
+                    "message_id": message_id,
+                    "stored_as": "snapshot" if is_snapshot else "delta",
+                    "bytes": size,
+                    "created_at": created_at.isoformat()
+                } for version, message_id, is_snapshot, size, created_at
+                    in fetch_rows(cur)]
+            return versions
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select itinerary versions: {error}.')
+
+    # rebuild one version of a trip's itinerary
+    # returns a string, normalized JSON when rebuilt from deltas (see
+    #   itinerary.reconstruct), None if the version doesn't exist
+    def get_itinerary_version(self, trip_id, version):
+        key = ("itinerary_version", str(trip_id), int(version))
+        cached = db_cache.get(key)
+        if cached is not None:
+            return cached
+
+        try:
+            with self.trip_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_itinerary_chain,
+                            (trip_id, version, trip_id, version))
+                rows = fetch_rows(cur)
+            if not rows or rows[-1][0] != int(version):
+                return None
+            # versions never change once written
+            text = itinerary.reconstruct(rows)
+            db_cache.put(key, text)
+            return text
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select itinerary version: {error}.')
+
+    # chat messages of a trip without an embedding of model
+    # returns an array of (message_id, content_text)
+    def get_unembedded_messages(self, trip_id, model):
+        try:
+            with self.trip_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_unembedded_messages,
+                            (trip_id, model))
+                return fetch_rows(cur)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select messages to embed: {error}.')
+
+    # store embeddings, rows of (message_id, trip_id, model, embedding)
+    #   each row is stored on its trip's shard
+    def create_message_embeddings(self, rows):
+        by_conn = {}
+        conn = self.conn
+        try:
+            for message_id, trip_id, model, data in rows:
+                by_conn.setdefault(self.trip_conn(trip_id), []).append(
+                    (message_id, trip_id, model, psycopg2.Binary(data)))
+            for conn, values in by_conn.items():
+                with conn.cursor() as cur:
+                    psycopg2.extras.execute_values(
+                        cur, SQLcmd.insert_message_embeddings, values)
+                    self.commit(conn)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not insert embeddings: {error}.')
+
+    # embeddings of texts already embedded with model, by content hash
+    # returns an array of (content_hash, embedding)
+    def get_cached_embeddings(self, model, hashes):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.select_cached_embeddings,
+                            (model, [psycopg2.Binary(h) for h in hashes]))
+                return fetch_rows(cur)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not select cached embeddings: {error}.')
+
+    # store embeddings, rows of (content_hash, model, embedding)
+    def create_cached_embeddings(self, rows):
+        try:
+            with self.conn.cursor() as cur:
+                psycopg2.extras.execute_values(
+                    cur, SQLcmd.insert_cached_embeddings,
+                    [(psycopg2.Binary(content_hash), model,
+                      psycopg2.Binary(data))
+                     for content_hash, model, data in rows])
+                self.commit()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not cache embeddings: {error}.')
+
+    # the chat history with ids, categories and embeddings for retrieval
+    #   embeddings of another model than 'model' come back as None
+    # returns an array of (message_id, role, content_type, content_text,
+    #   message_category, embedding)
+    def get_chat_turns(self, trip_id, model):
+        try:
+            with self.trip_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_chat_turns, (model, trip_id))
+                return fetch_rows(cur)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select chat turns: {error}.')
+
     # retrieve a chat history
     # returns an array of message_object(s)
     def get_chat_history(self, trip_id):
+        key = ("conversation", str(trip_id))
+        cached = None if listeners_down else conversation_cache.get(key)
+        if cached is not None:
+            # callers append their new messages to the returned list
+            return list(cached)
+
         try:
-            # create a blank array of message_object
-            chat_history = []
             # create a new cursor, with statement will auto close the cursor
-            with self.conn.cursor() as cur:
+            with self.trip_conn(trip_id).cursor() as cur:
+                # the conversation snapshot is a single primary key read
+                cur.execute(SQLcmd.select_conversation, (str(trip_id), ))
+                row = cur.fetchone()
+                if row is not None:
+                    print("Postgres: select conversation succesful.")
+                    if not listeners_down:
+                        conversation_cache.put(key, row[0])
+                    return list(row[0])
+
+                # trips without a snapshot yet (see backfill_conversations)
                 # fetch all messages with trip_id from 'messages' table
                 cur.execute(SQLcmd.select_message, (str(trip_id), ))
 
-                """Construct chat_history by appending each row of result.
-                Process the result set returned by the SELECT statement using
-                fetchone(). fetchone() fetches the next row in the result set,
-                returns NONE when no more row is available"""
-                row = cur.fetchone()
-                while row is not None:
-                    # turn each row of data into message_object
-                    message_object = {
-                        "role": row[0],
-                        "content": [
-                            {
-                                "type": row[1],
-                                "text": row[2]
-                            }
-                        ]
-                    }
-                    # then append to chat_history
-                    chat_history.append(message_object)
-                    row = cur.fetchone()
+                # fetch the result set in bulk and turn every row into a
+                #   message_object in one pass
+                chat_history = rows_to_messages(fetch_rows(cur))
 
                 print("Postgres: select chat-history message succesful.")
 
+            # archived trips are restored on their first read
+            if not chat_history and self.restore_trip(trip_id):
+                return self.get_chat_history(trip_id)
+
             return chat_history
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -168,8 +791,12 @@ class PostgresDB():
     # retrieve the most recent itinerary created by GPT
     # returns a string
     def get_recent_itinerary(self, trip_id):
+        cached = db_cache.get(("itinerary", str(trip_id)))
+        if cached is not None:
+            return cached
+
         try:
-            with self.conn.cursor() as cur:
+            with self.trip_read_conn(trip_id).cursor() as cur:
                 # fetch all messages with trip_id from 'messages' table
                 cur.execute(SQLcmd.select_recent_itinerary, (str(trip_id), ))
 
@@ -178,8 +805,17 @@ class PostgresDB():
                 fetchone(). fetchone() fetches the next row in the result set,
                 returns NONE when no more row is available"""
                 row = cur.fetchone()
-                recent_itinerary = row[2]
-                print('Postgres: select message successful.')
+
+            # archived trips are restored on their first read
+            if row is None and self.restore_trip(trip_id):
+                with self.trip_conn(trip_id).cursor() as cur:
+                    cur.execute(SQLcmd.select_recent_itinerary,
+                                (str(trip_id), ))
+                    row = cur.fetchone()
+
+            recent_itinerary = row[2]
+            print('Postgres: select message successful.')
+            db_cache.put(("itinerary", str(trip_id)), recent_itinerary)
             return recent_itinerary
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -188,14 +824,8 @@ class PostgresDB():
     # retrieve all trips
     def get_all_trips(self):
         try:
-            result = []
-            with self.conn.cursor() as cur:
-                cur.execute(SQLcmd.select_all_trips, ())
-                print("Postgres: select trips successful.")
-                row = cur.fetchone()
-                while row is not None:
-                    result.append(row)
-                    row = cur.fetchone()
+            result = self.select_trips(SQLcmd.select_all_trips, ())
+            print("Postgres: select trips successful.")
 
             return result
 
@@ -205,20 +835,17 @@ class PostgresDB():
     # retieve a trip
     # returns a library
     def get_trip(self, trip_id):
+        cached = db_cache.get(("trip", str(trip_id)))
+        if cached is not None:
+            return dict(cached)
+
         try:
-            with self.conn.cursor() as cur:
+            with self.trip_read_conn(trip_id).cursor() as cur:
                 cur.execute(SQLcmd.select_trip, (str(trip_id), ))
                 print("Postgres: select trip successful.")
-                row = cur.fetchone()
-                respond = {
-                    "trip_id": row[0],
-                    "user_id": row[1],
-                    "destination": row[2],
-                    "days_num": row[3],
-                    "travelers_num": row[4],
-                    "budget": row[5],
-                    "travel_preference": row[6]
-                }
+                respond = row_to_dict(TRIP_COLUMNS, cur.fetchone())
+            if respond is not None:
+                db_cache.put(("trip", str(trip_id)), dict(respond))
             return respond
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -234,7 +861,7 @@ class PostgresDB():
                 print("Postgres: message table dropped.")
 
                 # commit the changes to the database
-                self.conn.commit()
+                self.commit()
             return
 
         except (Exception, psycopg2.DatabaseError) as error:
@@ -247,41 +874,42 @@ class PostgresDB():
                 cur.execute(SQLcmd.truncate_table, (table_name,))
                 print(f"Postgres: {table_name} truncated.")
                 # commit the changes to the database
-                self.conn.commit()
+                self.commit()
             return
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Postgres: Could not truncate table: {error}.')
 
     # get all trip of a user
+    # returns an array of Trip structs
     def get_trip_from_user(self, user_id):
         try:
-            with self.conn.cursor() as cur:
-                cur.execute(SQLcmd.select_trip_from_user, (str(user_id), ))
-                print("Postgres: select trip successful.")
-                history = []
-                row = cur.fetchone()
-                while row is not None:
-                    # turn each row of data into message_object
-                    trip_object = {
-                        "trip_id": row[0],
-                        "user_id": row[1],
-                        "destination": row[2],
-                        "days_num": row[3],
-                        "travelers_num": row[4],
-                        "budget": row[5],
-                        "travel_preference": row[6]
-                    }
-                    # then append to chat_history
-                    history.append(trip_object)
-                    row = cur.fetchone()
+            rows = self.select_trips(SQLcmd.select_trip_from_user,
+                                     (str(user_id), ), read=True)
+            print("Postgres: select trip successful.")
+            history = rows_to_structs(Trip, rows)
 
-                print("Postgres: select trips from a user succesful.")
+            print("Postgres: select trips from a user succesful.")
 
             return history
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Postgres: Could not select trips: {error}.')
 
+    # run a trips query on every database holding trips
+    # returns the rows of all of them, in trip_id order
+    def select_trips(self, statement, params, read=False):
+        def select(conn):
+            with conn.cursor() as cur:
+                cur.execute(statement, params)
+                return fetch_rows(cur)
+
+        conns = self.trip_conns(read)
+        if len(conns) == 1:
+            return select(conns[0])
+        rows = [row for shard_rows in sharding.fan_out(select, conns)
+                for row in shard_rows]
+        return sorted(rows, key=lambda row: row[0])
+
     # insert user
     def create_user_to_db(self, id, provider, access_token,
                           first_name, last_name, email, url):
@@ -295,7 +923,7 @@ class PostgresDB():
                              first_name, last_name, email, url))
 
                 # commit the changes to the database
-                self.conn.commit()
+                self.commit()
 
                 # get the generated id back
                 rows = cur.fetchone()
@@ -312,30 +940,28 @@ class PostgresDB():
     # retieve a profile
     # returns a library
     def get_profile(self, user_id):
+        cached = db_cache.get(("profile", str(user_id)))
+        if cached is not None:
+            return dict(cached)
+
         try:
-            with self.conn.cursor() as cur:
+            with self.read_conn().cursor() as cur:
                 cur.execute(SQLcmd.select_profile, (str(user_id), ))
-                print("Postgres: select trip successful.")
-                row = cur.fetchone()
-                respond = {
-                    "profile_id": row[0],
-                    "user_id": row[1],
-                    "age": row[2],
-                    "travelStyle": row[3],
-                    "travelPriorities": row[4],
-                    "travelAvoidances": row[5],
-                    "dietaryRestrictions": row[6],
-                    "accomodations": row[7]
-                }
+                print("Postgres: select profile successful.")
+                respond = row_to_dict(PROFILE_COLUMNS, cur.fetchone())
+            if respond is not None:
+                db_cache.put(("profile", str(user_id)), dict(respond))
             return respond
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Postgres: Could not select profile: {error}.')
 
     # create a profile
+    #   profile_prompt is the profile block rendered for GPT prompts
     def insert_profile(self, user_id, age,
                        travelStyle, travelPriorities, travelAvoidances,
-                       dietaryRestrictions, accomodations):
+                       dietaryRestrictions, accomodations,
+                       profile_prompt=None, profile_prompt_tokens=None):
         try:
             # create a new cursor, with statement will auto close the cursor
             with self.conn.cursor() as cur:
@@ -344,19 +970,27 @@ class PostgresDB():
                 cur.execute(SQLcmd.insert_profiles_table,
                             (user_id, age,
                              travelStyle, travelPriorities, travelAvoidances,
-                             dietaryRestrictions, accomodations))
-
-                # commit the changes to the database
-                self.conn.commit()
+                             dietaryRestrictions, accomodations,
+                             profile_prompt, profile_prompt_tokens))
 
                 # get the generated id back
                 rows = cur.fetchone()
                 if rows:
                     profile_id = rows[0]
 
+                if CACHE_NOTIFY:
+                    cur.execute(SQLcmd.notify_profile,
+                                (f"{user_id}:{WORKER_ID}", ))
+
+                # commit the changes to the database
+                self.commit()
+
                 print("Postgres: New profile created.")
 
-                return profile_id
+            db_cache.invalidate(("profile", str(user_id)))
+            db_cache.invalidate(("profile_prompt", str(user_id)))
+
+            return profile_id
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Could not insert profile to the Database: {error}.')
@@ -364,7 +998,8 @@ class PostgresDB():
     # update a profile
     def update_profile(self, age, travelStyle, travelPriorities,
                        travelAvoidances, dietaryRestrictions,
-                       accomodations, user_id):
+                       accomodations, user_id,
+                       profile_prompt=None, profile_prompt_tokens=None):
         try:
             # create a new cursor, with statement will auto close the cursor
             with self.conn.cursor() as cur:
@@ -373,19 +1008,685 @@ class PostgresDB():
                 cur.execute(SQLcmd.update_profiles_table,
                             (age, travelStyle, travelPriorities,
                              travelAvoidances, dietaryRestrictions,
-                             accomodations, user_id))
-
-                # commit the changes to the database
-                self.conn.commit()
+                             accomodations, profile_prompt,
+                             profile_prompt_tokens, user_id))
 
                 # get the generated id back
                 rows = cur.fetchone()
                 if rows:
                     profile_id = rows[0]
 
+                if CACHE_NOTIFY:
+                    cur.execute(SQLcmd.notify_profile,
+                                (f"{user_id}:{WORKER_ID}", ))
+
+                # commit the changes to the database
+                self.commit()
+
                 print("Postgres: New profile created.")
 
-                return profile_id
+            db_cache.invalidate(("profile", str(user_id)))
+            db_cache.invalidate(("profile_prompt", str(user_id)))
+
+            return profile_id
 
         except (Exception, psycopg2.DatabaseError) as error:
             print(f'Could not insert profile to the Database: {error}.')
+
+    # claim an idempotency key for a request, held for 'timeout' seconds
+    #   or until complete_idempotency_key
+    #   keys are only read on the primary, so their commits don't hold the
+    #   user's next reads back like self.commit() does
+    # returns True if claimed, False if another request holds or completed
+    #   the key, None if the lookup failed
+    def claim_idempotency_key(self, key, request_hash, timeout):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.claim_idempotency_key,
+                            (psycopg2.Binary(key),
+                             psycopg2.Binary(request_hash), timeout))
+                claimed = cur.fetchone() is not None
+            self.conn.commit()
+            return claimed
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not claim idempotency key: {error}.')
+
+    # returns (request_hash, status, status_code, content_type, body),
+    #   None if the key isn't held
+    def get_idempotency_key(self, key):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.select_idempotency_key,
+                            (psycopg2.Binary(key), ))
+                row = cur.fetchone()
+            self.conn.commit()
+            return row
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not select idempotency key: {error}.')
+
+    # store the response of a claimed key, kept for 'ttl' seconds
+    def complete_idempotency_key(self, key, status_code, content_type,
+                                 body, ttl):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.complete_idempotency_key,
+                            (status_code, content_type,
+                             psycopg2.Binary(body), ttl,
+                             psycopg2.Binary(key)))
+            self.conn.commit()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not store idempotent response: {error}.')
+
+    # give up a claimed key so the request can be retried
+    def release_idempotency_key(self, key):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.release_idempotency_key,
+                            (psycopg2.Binary(key), ))
+            self.conn.commit()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not release idempotency key: {error}.')
+
+    # returns the number of expired idempotency keys deleted
+    def delete_expired_idempotency_keys(self):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.delete_expired_idempotency_keys, ())
+                count = cur.rowcount
+            self.conn.commit()
+            print(f"Postgres: {count} expired idempotency keys deleted.")
+            return count
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            self.conn.rollback()
+            print(f'Postgres: Could not delete idempotency keys: {error}.')
+
+    # serialize the model calls of a trip across every worker with a
+    #   session advisory lock, held until unlock_trip or the connection
+    #   is closed
+    # returns True if another request held the lock and this one waited
+    #   for it, the cached history and itinerary of the trip are dropped
+    #   then since the other request may have run on another worker
+    def lock_trip(self, trip_id, timeout=TRIP_LOCK_TIMEOUT):
+        conn = self.trip_conn(trip_id)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.try_lock_trip_requests, (trip_id, ))
+                if cur.fetchone()[0]:
+                    conn.commit()
+                    return False
+                print(f"Postgres: waiting for another request on trip "
+                      f"{trip_id}.")
+                cur.execute(SQLcmd.lock_trip_requests,
+                            (f"{int(timeout * 1000)}ms", trip_id))
+            conn.commit()
+
+            conversation_cache.invalidate(("conversation", str(trip_id)))
+            db_cache.invalidate(("itinerary", str(trip_id)))
+            return True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not lock trip {trip_id}: {error}.')
+            return False
+
+    def unlock_trip(self, trip_id):
+        conn = self.trip_conn(trip_id)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.unlock_trip_requests, (trip_id, ))
+            conn.commit()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not unlock trip {trip_id}: {error}.')
+
+    # the trip's newest itinerary, uncached and read on the primary
+    # returns (message_id, content_text), (0, None) without an itinerary
+    def get_latest_itinerary(self, trip_id):
+        try:
+            with self.trip_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_latest_itinerary, (trip_id, ))
+                row = cur.fetchone()
+            return row if row is not None else (0, None)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select latest itinerary: {error}.')
+            return (0, None)
+
+    # the trip route's itinerary with the ETag of the row it was read from,
+    #   the cached recent itinerary can be older than get_trip_etag
+    # returns (etag, itinerary), (None, None) if the lookup failed
+    def get_trip_itinerary(self, trip_id):
+        try:
+            with self.trip_read_conn(trip_id).cursor() as cur:
+                cur.execute(SQLcmd.select_latest_itinerary, (str(trip_id), ))
+                row = cur.fetchone()
+
+            # archived trips are restored on their first read
+            if row is None and self.restore_trip(trip_id):
+                with self.trip_conn(trip_id).cursor() as cur:
+                    cur.execute(SQLcmd.select_latest_itinerary,
+                                (str(trip_id), ))
+                    row = cur.fetchone()
+
+            message_id, recent_itinerary = row or (0, None)
+            return f"t{trip_id}-m{message_id}", recent_itinerary
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select trip itinerary: {error}.')
+            return None, None
+
+    # ETags of the GET routes, from index-only lookups
+    # returns a string, None if the lookup failed
+    def get_trip_etag(self, trip_id):
+        row = self._select_etag(SQLcmd.select_trip_etag, trip_id,
+                                self.trip_read_conn(trip_id))
+        return None if row is None else f"t{trip_id}-m{row[0]}"
+
+    # a user's trips are spread over every shard
+    def get_history_etag(self, user_id):
+        rows = sharding.fan_out(
+            lambda conn: self._select_etag(SQLcmd.select_history_etag,
+                                           user_id, conn),
+            self.trip_conns(read=True))
+        if None in rows:
+            return None
+        count = sum(row[0] for row in rows)
+        return f"h{count}-t{max(row[1] for row in rows)}"
+
+    def get_profile_etag(self, user_id):
+        row = self._select_etag(SQLcmd.select_profile_etag, user_id,
+                                self.read_conn())
+        return None if row is None else f"p{row[0]}-v{row[1]}"
+
+    def _select_etag(self, statement, key, conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute(statement, (key, ))
+                return cur.fetchone()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select ETag: {error}.')
+
+    # record a newly submitted provider batch
+    def create_batch_to_db(self, batch_id, kind, status, request_count):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.insert_batches_table,
+                            (batch_id, kind, status, request_count))
+                self.commit()
+                print(f"Postgres: New {kind} batch {batch_id} created.")
+            return batch_id
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Could not insert batch to the Database: {error}.')
+
+    # update the status of a provider batch
+    def update_batch_status(self, batch_id, status, output_file_id=None):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.update_batches_table,
+                            (status, output_file_id, batch_id))
+                self.commit()
+                print(f"Postgres: batch {batch_id} is {status}.")
+            return batch_id
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Could not update batch in the Database: {error}.')
+
+    # create the message of one batch result, once per batch and custom_id
+    #   the result is recorded in the message's transaction, so a collect
+    #   rerun after a crash skips exactly the results already written
+    # returns the message_id, None if written before or on failure
+    def create_batch_message(self, batch_id, custom_id, trip_id, role,
+                             content_text, message_category):
+        conn = self.conn
+        try:
+            conn = self.trip_conn(trip_id)
+            with conn.cursor() as cur:
+                cur.execute(SQLcmd.insert_batch_result,
+                            (batch_id, custom_id, trip_id))
+                if cur.fetchone() is None:
+                    conn.rollback()
+                    print(f"Postgres: batch result {custom_id} of "
+                          f"{batch_id} was already written.")
+                    return None
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Could not insert batch result to the Database: {error}.')
+            return None
+
+        # commits the batch result with the message, or rolls both back
+        return self.create_message_to_db(trip_id=trip_id, role=role,
+                                         content_type="text",
+                                         content_text=content_text,
+                                         message_category=message_category)
+
+    # retrieve batches whose results are not written yet
+    # returns an array of row tuples
+    #   (batch_id, kind, status, request_count, output_file_id)
+    def get_open_batches(self):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.select_open_batches, ())
+                result = fetch_rows(cur)
+                print("Postgres: select open batches successful.")
+            return result
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select batches: {error}.')
+
+    # retrieve the profile block rendered when the profile was written
+    # returns a string, None when the user has no profile or the profile
+    #   predates the profile_prompt column
+    def get_profile_prompt(self, user_id):
+        key = ("profile_prompt", str(user_id))
+        cached = db_cache.get(key)
+        if cached is not None:
+            return cached
+
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.select_profile_prompt, (str(user_id), ))
+                row = cur.fetchone()
+            if row is None or row[0] is None:
+                return None
+            db_cache.put(key, row[0])
+            return row[0]
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select profile prompt: {error}.')
+
+    # store the rendered profile block of an existing profile
+    def set_profile_prompt(self, user_id, profile_prompt,
+                           profile_prompt_tokens):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.update_profile_prompt,
+                            (profile_prompt, profile_prompt_tokens,
+                             str(user_id)))
+                self.commit()
+            db_cache.put(("profile_prompt", str(user_id)), profile_prompt)
+            return profile_prompt
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Could not update profile prompt in the Database: {error}.')
+
+    # rebuild every trip's conversation snapshot from the messages table
+    # returns the number of snapshots written
+    def backfill_conversations(self):
+        conn = self.conn
+        try:
+            count = 0
+            for conn in self.trip_conns():
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.backfill_conversations, ())
+                    count += cur.rowcount
+                    self.commit(conn)
+            conversation_cache.clear()
+            print(f"Postgres: backfilled {count} conversations.")
+            return count
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not backfill conversations: {error}.')
+
+    # move texts of min_length characters or more into message_blobs and
+    #   delete blobs of deleted trips
+    # returns the bytes saved report, see get_blob_report
+    #   every shard has its own message_blobs
+    def dedupe_messages(self, min_length=BLOB_MIN_LENGTH):
+        conn = self.conn
+        try:
+            for conn in self.trip_conns():
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.dedupe_message_blobs, (min_length, ))
+                    print(f"Postgres: {cur.rowcount} message blobs created.")
+                    cur.execute(SQLcmd.dedupe_messages, (min_length, ))
+                    print(f"Postgres: {cur.rowcount} messages deduplicated.")
+                    cur.execute(SQLcmd.delete_unused_blobs, ())
+                    print(f"Postgres: {cur.rowcount} unused blobs deleted.")
+                    self.commit(conn)
+            return self.get_blob_report()
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not deduplicate messages: {error}.')
+
+    # returns how many bytes of message text message_blobs saves
+    def get_blob_report(self):
+        try:
+            references, referenced_bytes, blobs, blob_bytes = 0, 0, 0, 0
+            for conn in self.trip_conns():
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_blob_report, ())
+                    row = cur.fetchone()
+                references += row[0]
+                referenced_bytes += row[1]
+                blobs += row[2]
+                blob_bytes += row[3]
+            # every reference still stores a 32 byte hash
+            return {
+                "referencing_messages": references,
+                "referenced_bytes": referenced_bytes,
+                "blobs": blobs,
+                "blob_bytes": blob_bytes,
+                "bytes_saved": referenced_bytes - blob_bytes - 32 * references
+            }
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not report message blobs: {error}.')
+
+    # move every trip that isn't on the shard owning it, see sharding.py
+    # returns the number of trips moved (to be moved with dry_run)
+    def rebalance_trips(self, dry_run=False):
+        moved = 0
+        try:
+            for name in sharding.SHARDS:
+                conn = self.shard_conn(name)
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_trip_ids, ())
+                    trip_ids = [row[0] for row in fetch_rows(cur)]
+                conn.commit()
+
+                for trip_id in trip_ids:
+                    owner = sharding.ring.shard_for(trip_id)
+                    if owner == name:
+                        continue
+                    print(f"Postgres: trip {trip_id} moves from {name} "
+                          f"to {owner}.")
+                    if dry_run or self.move_trip(trip_id, name, owner):
+                        moved += 1
+            return moved
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not rebalance trips: {error}.')
+
+    # move a trip and everything stored with it from one shard to another
+    #   the target assigns new message ids, the trip is deleted from the
+    #   source once the copy is committed
+    # returns True if the trip moved
+    def move_trip(self, trip_id, source, target):
+        source_conn = self.shard_conn(source)
+        target_conn = self.shard_conn(target)
+        try:
+            with source_conn.cursor() as src, target_conn.cursor() as dst:
+                src.execute(SQLcmd.select_trip, (trip_id, ))
+                trip = src.fetchone()
+                if trip is None:
+                    return False
+                dst.execute(SQLcmd.insert_shard_trips_table, trip)
+                if dst.fetchone() is not None:
+                    self.copy_trip(src, dst, trip_id)
+                # the trip is already there when an earlier move stopped
+                #   before deleting it from the source, its copy was
+                #   committed with it. Another trip given the same id on
+                #   the target must not cost this one its data.
+                elif not self.same_trip(dst, trip):
+                    source_conn.rollback()
+                    target_conn.rollback()
+                    print(f"Postgres: trip id {trip_id} is taken by another "
+                          f"trip on {target}, not moved.")
+                    return False
+                self.commit(target_conn)
+
+                src.execute(SQLcmd.delete_trip, (trip_id, ))
+                self.commit(source_conn)
+
+            print(f"Postgres: moved trip {trip_id} to {target}.")
+            return True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            for conn in (source_conn, target_conn):
+                if conn is not None:
+                    conn.rollback()
+            print(f'Postgres: Could not move trip {trip_id}: {error}.')
+            return False
+
+    # whether the trip stored under trip's id on a cursor's shard is 'trip'
+    def same_trip(self, cur, trip):
+        cur.execute(SQLcmd.select_trip, (trip[0], ))
+        row = cur.fetchone()
+        return row is not None and tuple(row) == tuple(trip)
+
+    # copy a trip's messages, snapshot, itinerary versions and embeddings
+    #   between two shards' cursors
+    def copy_trip(self, src, dst, trip_id):
+        message_ids = {}
+        # an archived trip moves as a live one, it is archived again on
+        #   its new shard
+        if self.unarchive_trip(src, trip_id):
+            src.execute(SQLcmd.seed_conversation, (trip_id, ))
+        src.execute(SQLcmd.select_trip_messages, (trip_id, ))
+        for (message_id, role, content_type, content_text, content_hash,
+             blob_text, message_category, created_at) in fetch_rows(src):
+            if content_hash is not None:
+                dst.execute(SQLcmd.insert_message_blob,
+                            (content_hash, blob_text))
+            dst.execute(SQLcmd.copy_message,
+                        (trip_id, role, content_type, content_text,
+                         content_hash, message_category, created_at))
+            message_ids[message_id] = dst.fetchone()[0]
+
+        src.execute(SQLcmd.select_trip_conversation, (trip_id, ))
+        conversation = src.fetchone()
+        if conversation is not None:
+            messages, last_message_id = conversation
+            dst.execute(SQLcmd.insert_conversation,
+                        (trip_id, messages,
+                         message_ids.get(last_message_id, last_message_id)))
+
+        src.execute(SQLcmd.select_trip_itinerary_versions, (trip_id, ))
+        for version, message_id, is_snapshot, body, created_at in \
+                fetch_rows(src):
+            dst.execute(SQLcmd.copy_itinerary_version,
+                        (trip_id, version,
+                         message_ids.get(message_id, message_id),
+                         is_snapshot, body, created_at))
+
+        src.execute(SQLcmd.select_trip_embeddings, (trip_id, ))
+        psycopg2.extras.execute_values(
+            dst, SQLcmd.insert_message_embeddings,
+            [(message_ids[message_id], trip_id, model,
+              psycopg2.Binary(embedding))
+             for message_id, model, embedding in fetch_rows(src)
+             if message_id in message_ids])
+
+        src.execute(SQLcmd.select_trip_batch_results, (trip_id, ))
+        for batch_id, custom_id, created_at in fetch_rows(src):
+            dst.execute(SQLcmd.copy_batch_result,
+                        (batch_id, custom_id, trip_id, created_at))
+
+    # create the messages partitions of the coming months on every
+    #   database, run monthly by the create-partitions maintenance command
+    def create_partitions(self):
+        for conn in self.trip_conns():
+            if conn is not None:
+                self.create_message_partitions(conn)
+
+    # archive trips without a new message for 'months' months, oldest
+    #   first, and create the coming months' messages partitions
+    # returns the number of trips archived
+    def archive_trips(self, months=ARCHIVE_AFTER_MONTHS, limit=1000):
+        archived = 0
+        try:
+            for conn in self.trip_conns():
+                self.create_message_partitions(conn)
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_cold_trips, (months, limit))
+                    trip_ids = [row[0] for row in fetch_rows(cur)]
+                conn.commit()
+
+                for trip_id in trip_ids:
+                    if self.archive_trip(conn, trip_id, months):
+                        archived += 1
+            return archived
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not archive trips: {error}.')
+
+    # export a trip's messages with COPY into one compressed archived_trips
+    #   row and delete them, its snapshot and its embeddings
+    # returns True if the trip was archived
+    def archive_trip(self, conn, trip_id, months):
+        try:
+            with conn.cursor() as cur:
+                # a message added since the trip was picked keeps it live
+                cur.execute(SQLcmd.lock_trip, (trip_id, ))
+                cur.execute(SQLcmd.select_trip_cold, (months, trip_id))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    return False
+
+                exported = io.BytesIO()
+                cur.copy_expert(
+                    cur.mogrify(SQLcmd.export_trip_messages,
+                                (trip_id, )).decode(), exported)
+                raw = exported.getvalue()
+                archive = zlib.compress(raw, ARCHIVE_COMPRESSION_LEVEL)
+                cur.execute(SQLcmd.insert_archived_trip,
+                            (trip_id, raw.count(b'\n'), len(raw),
+                             psycopg2.Binary(archive)))
+                cur.execute(SQLcmd.delete_archived_messages,
+                            (trip_id, trip_id, trip_id))
+                self.commit(conn)
+
+            conversation_cache.invalidate(("conversation", str(trip_id)))
+            print(f"Postgres: archived trip {trip_id}, {len(raw)} bytes "
+                  f"into {len(archive)}.")
+            return True
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            conn.rollback()
+            print(f'Postgres: Could not archive trip {trip_id}: {error}.')
+            return False
+
+    # put an archived trip's messages back, inside the caller's transaction
+    # returns True if the trip was archived
+    def unarchive_trip(self, cur, trip_id):
+        cur.execute(SQLcmd.unarchive_trip, (trip_id, trip_id))
+        row = cur.fetchone()
+        if row is None:
+            return False
+        cur.copy_expert(SQLcmd.import_trip_messages,
+                        io.BytesIO(zlib.decompress(row[0])))
+        print(f"Postgres: restored archived trip {trip_id}.")
+        return True
+
+    # restore an archived trip with its conversation snapshot
+    # returns True if the trip was archived
+    def restore_trip(self, trip_id):
+        conn = self.trip_conn(trip_id)
+        try:
+            with conn.cursor() as cur:
+                # new and unknown trips miss too, they are only read
+                cur.execute(SQLcmd.select_trip_archived, (trip_id, ))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    return False
+                restored = self.unarchive_trip(cur, trip_id)
+                if restored:
+                    cur.execute(SQLcmd.seed_conversation, (trip_id, ))
+            self.commit(conn)
+            return restored
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            if conn is not None:
+                conn.rollback()
+            print(f'Postgres: Could not restore trip {trip_id}: {error}.')
+            return False
+
+    # returns how many bytes archiving saves
+    def get_archive_report(self):
+        try:
+            trips, messages, raw_bytes, archive_bytes = 0, 0, 0, 0
+            for conn in self.trip_conns():
+                with conn.cursor() as cur:
+                    cur.execute(SQLcmd.select_archive_report, ())
+                    row = cur.fetchone()
+                trips += row[0]
+                messages += row[1]
+                raw_bytes += row[2]
+                archive_bytes += row[3]
+            return {
+                "archived_trips": trips,
+                "archived_messages": messages,
+                "raw_bytes": raw_bytes,
+                "archive_bytes": archive_bytes,
+                "bytes_saved": raw_bytes - archive_bytes
+            }
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not report archived trips: {error}.')
+
+    # count trips per (destination, days_num, budget)
+    # returns an array of row tuples (destination, days_num, budget, count)
+    #   a bucket can appear once per shard, callers add the counts up
+    def get_trip_buckets(self):
+        try:
+            result = self.select_trips(SQLcmd.select_trip_buckets, ())
+            print("Postgres: select trip buckets successful.")
+            return result
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select trip buckets: {error}.')
+
+    # store a new version of a base itinerary
+    # returns the version number
+    def create_base_itinerary(self, destination, days_num, budget_bucket,
+                              prompt_version, content_text):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.insert_base_itineraries_table,
+                            (destination, days_num, budget_bucket,
+                             prompt_version, content_text,
+                             destination, days_num, budget_bucket))
+                self.commit()
+                version = cur.fetchone()[0]
+                print(f"Postgres: New base itinerary for {destination}, "
+                      f"{days_num} days, {budget_bucket} budget "
+                      f"(version {version}).")
+
+            db_cache.put(("base", destination, days_num, budget_bucket,
+                          prompt_version), content_text)
+            return version
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Could not insert base itinerary to the Database: {error}.')
+
+    # retrieve the latest base itinerary of a trip bucket
+    # returns a string, empty when nothing was precomputed
+    def get_base_itinerary(self, destination, days_num, budget_bucket,
+                           prompt_version):
+        key = ("base", destination, days_num, budget_bucket, prompt_version)
+        cached = db_cache.get(key)
+        if cached is not None:
+            return cached
+
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(SQLcmd.select_base_itinerary,
+                            (destination, days_num, budget_bucket,
+                             prompt_version))
+                row = cur.fetchone()
+            # misses are cached too, most trips have no base itinerary
+            base_itinerary = row[0] if row is not None else ""
+            db_cache.put(key, base_itinerary)
+            return base_itinerary
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(f'Postgres: Could not select base itinerary: {error}.')
@@ -0,0 +1,95 @@
+""" Row mapping helpers for the PostgresDB class.
+    Turns rows returned by the SQLcmd SELECT statements into the dictionaries
+    returned by prompt-svc, using precompiled column maps so no per-row
+    lookups are needed.
+"""
+
+import datetime
+import hashlib
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# number of rows pulled from the driver per fetchmany() call
+FETCH_ARRAYSIZE = int(os.getenv('POSTGRES_FETCH_ARRAYSIZE', '1000'))
+
+# message texts this long or longer are stored once in message_blobs
+#   (system prompts, update requests and itineraries all are)
+BLOB_MIN_LENGTH = int(os.getenv('MESSAGE_BLOB_MIN_LENGTH', '256'))
+
+# months of messages partitions created ahead of the current one
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MESSAGE_PARTITIONS_AHEAD', '2'))
+
+# trips without a new message for this many months are archived
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '6'))
+
+# zlib level of archived trips, they are written once and rarely read
+ARCHIVE_COMPRESSION_LEVEL = 9
+
+# column maps, in the same order as the SQLcmd SELECT statements
+TRIP_COLUMNS = ("trip_id", "user_id", "destination", "days_num",
+                "travelers_num", "budget", "travel_preference")
+
+PROFILE_COLUMNS = ("profile_id", "user_id", "age", "travelStyle",
+                   "travelPriorities", "travelAvoidances",
+                   "dietaryRestrictions", "accomodations")
+
+
+# fetch every row of the current result set in arraysize batches
+# returns a list of row tuples
+def fetch_rows(cur):
+    cur.arraysize = FETCH_ARRAYSIZE
+    rows = []
+    for batch in iter(cur.fetchmany, []):
+        rows.extend(batch)
+    return rows
+
+
+# map a single row to a dictionary using a column map
+def row_to_dict(columns, row):
+    if row is None:
+        return None
+    return dict(zip(columns, row))
+
+
+# map a list of rows to a list of msgspec Structs, fields in column order
+def rows_to_structs(struct, rows):
+    return [struct(*row) for row in rows]
+
+
+# key of a text in message_blobs, same as sha256(convert_to(text, 'UTF8'))
+def blob_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+# message categories kept out of the chat history (batch results)
+NON_CHAT_CATEGORIES = ("WEATHER", "RECOMMENDATION")
+
+
+# build the message object GPT expects from a stored message
+def make_message(role, content_type, content_text):
+    return {"role": role,
+            "content": [{"type": content_type, "text": content_text}]}
+
+
+# map select_message rows of (role, content_type, content_text,
+#   message_category) straight to the message objects GPT expects
+def rows_to_messages(rows):
+    return [{"role": role,
+             "content": [{"type": content_type, "text": content_text}]}
+            for role, content_type, content_text, _ in rows]
+
+
+# first day of the month 'offset' months after the month of day
+def add_months(day, offset):
+    month = day.year * 12 + day.month - 1 + offset
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+# messages partitions of the months starting on each day of months
+# returns a list of (table name, first day, first day of the next month)
+def month_partitions(months):
+    return [(f"messages_y{month.year}m{month.month:02d}",
+             month, add_months(month, 1))
+            for month in months]
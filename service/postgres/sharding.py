@@ -0,0 +1,100 @@
+""" Hash sharding of trip-scoped data for the PostgresDB class.
+    A trip and everything stored with it (messages, conversation snapshot,
+    itinerary versions, embeddings) live on the shard that owns its trip_id
+    on a consistent hash ring. Users, profiles, batches and base itineraries
+    stay on the home database (DATABASE_URL).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect
+import hashlib
+import random
+import time
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# shards as comma separated name=connection string pairs, the ring is built
+#   from the names so a shard can move to another host without rehashing
+#   e.g. "a=postgresql://db-a/prompt,b=postgresql://db-b/prompt"
+DATABASE_SHARD_URLS = os.getenv('DATABASE_SHARD_URLS', '')
+
+# shards still read and drained by the rebalance command, but no longer
+#   given trips, comma separated names
+DATABASE_DRAIN_SHARDS = os.getenv('DATABASE_DRAIN_SHARDS', '')
+
+# points per shard on the ring, more points spread trips more evenly
+VIRTUAL_NODES = int(os.getenv('DATABASE_SHARD_VNODES', '128'))
+
+# trip ids: seconds since ID_EPOCH in the high bits and random low bits,
+#   53 bits in total so JavaScript clients read them exactly. A duplicate
+#   can only collide on the shard owning that id, where the insert is
+#   retried with a new id.
+ID_EPOCH = 1704067200   # 2024-01-01
+ID_RANDOM_BITS = 21
+
+# ids tried before a trip insert gives up
+ID_ATTEMPTS = 5
+
+# threads shared by the fan-out queries of this worker
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="shard")
+
+
+def parse_shards(text):
+    shards = {}
+    for item in text.split(','):
+        name, _, url = item.strip().partition('=')
+        if name and url:
+            shards[name.strip()] = url.strip()
+    return shards
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+# Consistent hash ring of shard names, each with VIRTUAL_NODES points
+class HashRing():
+
+    def __init__(self, names, vnodes=VIRTUAL_NODES) -> None:
+        points = sorted((ring_hash(f"{name}#{i}"), name)
+                        for name in names for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    # name of the shard owning a trip
+    def shard_for(self, trip_id):
+        index = bisect(self.hashes, ring_hash(str(trip_id)))
+        return self.names[index % len(self.names)]
+
+
+# Ring of the shards given new trips, None when trips aren't sharded
+def make_ring(shards, draining, vnodes=VIRTUAL_NODES):
+    if not shards:
+        return None
+    return HashRing([name for name in shards if name not in draining],
+                    vnodes)
+
+
+SHARDS = parse_shards(DATABASE_SHARD_URLS)
+DRAINING = {name.strip() for name in DATABASE_DRAIN_SHARDS.split(',')
+            if name.strip()}
+ring = make_ring(SHARDS, DRAINING)
+
+
+# whether trips are sharded at all
+def enabled():
+    return ring is not None
+
+
+# a new trip id, see ID_EPOCH
+def allocate_trip_id():
+    seconds = int(time.time()) - ID_EPOCH
+    return (seconds << ID_RANDOM_BITS) | random.getrandbits(ID_RANDOM_BITS)
+
+
+# Runs func(conn) on every connection at once
+# returns the results, in the order of conns
+def fan_out(func, conns):
+    return list(executor.map(func, conns))
@@ -0,0 +1,132 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+"""Precomputes base itineraries for the most requested trips.
+
+Mines the trips table for the top destination / length / budget buckets
+and stores a new version of each bucket's base itinerary:
+    $ python -m service.precompute.precompute --top 50
+    $ python -m service.precompute.precompute --top 50 --dry-run
+
+initialRequest starts from these and only personalizes them.
+"""
+
+import argparse
+import hashlib
+import re
+
+from service.prompt import prompt
+from service.prompt import planner
+from service.promptType import promptType
+from service.postgres.postgresdb import PostgresDB
+from service.destination import destination as places
+
+# per person budget buckets, upper bounds in dollars
+BUDGET_BUCKETS = (("low", 1500), ("medium", 5000), ("high", None))
+
+# budget written in the base itinerary's prompt for each bucket
+BUDGET_EXAMPLES = {
+    "low": "$1,000",
+    "medium": "$3,000",
+    "high": "$8,000",
+    "any": "a moderate amount"
+}
+
+# party size the base itineraries are planned for
+BASE_TRAVELERS_NUM = "2"
+
+# base itineraries built from older prompts are ignored
+PROMPT_VERSION = hashlib.sha256(
+    prompt.SYSTEM_ITINERARY.encode()).hexdigest()[:16]
+
+
+# Buckets a free text budget like "$10,000" or "2000 USD"
+def budgetBucket(budget):
+    digits = re.sub(r'\D', '', str(budget or '').split('.')[0])
+    if not digits:
+        return "any"
+    amount = int(digits)
+    for bucket, limit in BUDGET_BUCKETS:
+        if limit is None or amount <= limit:
+            return bucket
+
+
+# Returns the (destination, days_num, budget_bucket) key of a trip
+#   the destination is only lowercased in the key, prompts keep its casing
+def bucketKey(destination, days_num, budget):
+    return (places.canonicalize(destination).lower(),
+            str(planner.parseDays(days_num)),
+            budgetBucket(budget))
+
+
+# Returns the stored base itinerary of a trip's bucket, None if there is
+#   none for the current prompts
+def findBase(postgressconn, destination, days_num, budget):
+    return postgressconn.get_base_itinerary(
+        *bucketKey(destination, days_num, budget), PROMPT_VERSION)
+
+
+# Returns the 'top' most requested buckets as (key, destination, count)
+#   tuples, destination being the bucket's most requested spelling
+def mineBuckets(postgressconn, top):
+    counts = {}
+    spellings = {}
+    for destination, days_num, budget, count in \
+            postgressconn.get_trip_buckets() or []:
+        key = bucketKey(destination, days_num, budget)
+        counts[key] = counts.get(key, 0) + count
+        names = spellings.setdefault(key, {})
+        name = places.canonicalize(destination)
+        names[name] = names.get(name, 0) + count
+
+    return [(key, max(spellings[key], key=spellings[key].get), count)
+            for key, count in sorted(counts.items(),
+                                     key=lambda item: -item[1])[:top]]
+
+
+# Generates and stores the base itinerary of every bucket
+# returns the number of base itineraries stored
+def generateBases(p, postgressconn, buckets):
+    stored = 0
+    for key, destination, count in buckets:
+        _, days_num, budget_bucket = key
+        messages = p.initialPlanATrip(destination, BASE_TRAVELERS_NUM,
+                                      days_num, "",
+                                      BUDGET_EXAMPLES[budget_bucket])
+        completion = p.prompt(promptType.PromptType.ChatCompletions,
+                              messages, route="itinerary",
+                              days_num=days_num)
+        if 'error' in completion:
+            print(f"Precompute: {destination}, {days_num} days failed: "
+                  f"{completion['error']}")
+            continue
+
+        postgressconn.create_base_itinerary(
+            *key, PROMPT_VERSION,
+            completion.choices[0].message.content)
+        stored += 1
+
+    return stored
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--top", type=int, default=50)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only list the buckets")
+    args = parser.parse_args()
+
+    postgressconn = PostgresDB()
+    buckets = mineBuckets(postgressconn, args.top)
+    for (_, days_num, budget_bucket), destination, count in buckets:
+        print(f"Precompute: {count} trips to {destination}, "
+              f"{days_num} days, {budget_bucket} budget")
+
+    if not args.dry_run:
+        stored = generateBases(prompt.Prompt(), postgressconn, buckets)
+        print(f"Precompute: stored {stored}/{len(buckets)} base itineraries")
+    postgressconn.close_db_connection()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,101 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import numpy as np
+import base64
+import os
+
+from service.routing import routing
+from service.postgres.records import blob_hash
+
+load_dotenv()
+
+# texts per embeddings request, the provider accepts up to 2048
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '256'))
+
+# embeddings requests of one call sent at the same time
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', '4'))
+
+# threads shared by every batched embeddings call of this worker
+executor = ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY,
+                              thread_name_prefix="embeddings")
+
+
+# Turns one embedding of a response into a float32 vector
+#   base64 is what requestBatch asks for, a list is what the provider
+#   sends for models without base64 support
+def toVector(embedding):
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype=np.float32)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+# Embeds one provider-sized batch of texts
+# returns a (len(texts), dimensions) float32 array
+def requestBatch(client, model, texts):
+    response = client.embeddings.create(model=model, input=texts,
+                                        encoding_format="base64")
+    data = sorted(response.data, key=lambda item: item.index)
+    return np.stack([toVector(item.embedding) for item in data])
+
+
+###########################################################
+#
+#  Embeds many texts at once
+#
+#  Receives:
+#   - client:         OpenAI client, or a stand-in with the
+#                     same embeddings.create
+#   - texts:          list of strings, repeats are embedded once
+#   - route:          routing table entry of the embeddings model
+#   - postgressconn:  optional PostgresDB, its embedding_cache
+#                     serves texts embedded before and keeps
+#                     the new ones
+#
+#  Returns:
+#   - a contiguous (len(texts), dimensions) float32 NumPy
+#     array, row i is the embedding of texts[i]
+#
+###########################################################
+def embed(client, texts, route="embedded", postgressconn=None):
+    model = routing.routing_table.getRoute(route)["model"]
+
+    # each distinct text once, keyed by the hash of its content
+    hashes = [blob_hash(text) for text in texts]
+    unique = dict(zip(hashes, texts))
+
+    vectors = {}
+    if postgressconn is not None and unique:
+        for content_hash, data in postgressconn.get_cached_embeddings(
+                model, list(unique)) or []:
+            vectors[bytes(content_hash)] = np.frombuffer(data,
+                                                         dtype=np.float32)
+
+    missing = [content_hash for content_hash in unique
+               if content_hash not in vectors]
+    batches = [missing[i:i + EMBEDDING_BATCH_SIZE]
+               for i in range(0, len(missing), EMBEDDING_BATCH_SIZE)]
+    futures = [executor.submit(requestBatch, client, model,
+                               [unique[key] for key in batch])
+               for batch in batches]
+
+    new_rows = []
+    for batch, future in zip(batches, futures):
+        for content_hash, vector in zip(batch, future.result()):
+            vectors[content_hash] = vector
+            new_rows.append((content_hash, model, vector.tobytes()))
+
+    if postgressconn is not None and new_rows:
+        postgressconn.create_cached_embeddings(new_rows)
+    print(f"Embeddings: {len(texts)} texts, {len(unique)} distinct, "
+          f"{len(missing)} embedded in {len(batches)} requests")
+
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    result = np.empty((len(texts), len(next(iter(vectors.values())))),
+                      dtype=np.float32)
+    for row, content_hash in enumerate(hashes):
+        result[row] = vectors[content_hash]
+    return result
@@ -0,0 +1,260 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import threading
+import time
+
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+# number of recent requests kept per route for percentiles and budgets
+HEDGE_WINDOW = 200
+
+# first-token latencies needed before the percentile delay is trusted
+HEDGE_MIN_SAMPLES = 20
+
+# threads shared by every hedged request of this worker
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+# seconds a hedged request may go without receiving anything, before its
+#   first token included, unless the route sets stall_timeout
+HEDGE_STALL_TIMEOUT = 30.0
+
+
+###########################################################
+#
+#  First-token latencies and hedge counters of a route
+#
+###########################################################
+class RouteStats():
+
+    def __init__(self) -> None:
+        self.latencies = deque(maxlen=HEDGE_WINDOW)
+        self.decisions = deque(maxlen=HEDGE_WINDOW)   # True when hedged
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.lock = threading.Lock()
+
+    def observe(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    # Seconds to wait for the first token before hedging
+    def delay(self, percentile, default_delay):
+        with self.lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return default_delay
+            latencies = sorted(self.latencies)
+        return latencies[int(percentile / 100 * (len(latencies) - 1))]
+
+    # Whether one more hedge keeps the recent hedge rate within budget
+    def allowHedge(self, budget):
+        with self.lock:
+            recent = self.decisions
+            return (sum(recent) + 1) / (len(recent) + 1) <= budget
+
+    def record(self, hedged, hedge_won=False):
+        with self.lock:
+            self.requests += 1
+            self.decisions.append(hedged)
+            if hedged:
+                self.hedged += 1
+            if hedge_won:
+                self.hedge_wins += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedged / max(self.requests, 1),
+                "win_rate": self.hedge_wins / max(self.hedged, 1)
+            }
+
+
+route_stats = {}
+route_stats_lock = threading.Lock()
+
+
+def getRouteStats(route):
+    with route_stats_lock:
+        if route not in route_stats:
+            route_stats[route] = RouteStats()
+        return route_stats[route]
+
+
+# Returns hedge metrics of every route that hedged
+def stats():
+    with route_stats_lock:
+        routes = dict(route_stats)
+    return {route: s.stats() for route, s in routes.items()}
+
+
+###########################################################
+#
+#  One of the requests of a hedged completion
+#
+#  'started' is set on the first token (or when the request
+#  ends). cancel() is called from the winner's side: it closes
+#  the stream, so the request stops without waiting for a next
+#  chunk that a stalled response may never send. A read already
+#  blocked on the socket ends within stall_timeout at the latest.
+#
+###########################################################
+class Attempt():
+
+    def __init__(self) -> None:
+        self.started = threading.Event()
+        self.cancelled = threading.Event()
+        self.stream = None
+        self.lock = threading.Lock()
+
+    # Keeps the request's stream, closed right away if already cancelled
+    def opened(self, stream):
+        with self.lock:
+            self.stream = stream
+        if self.cancelled.is_set():
+            self.close()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.close()
+
+    def close(self):
+        with self.lock:
+            stream, self.stream = self.stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                print(f"Hedge: could not close a stream: {e}")
+
+
+# Streams one chat completion and assembles it into a ChatCompletion
+#   a response stalled for 'stall_timeout' seconds fails the request
+# returns None if cancelled
+def streamCompletion(client, messages, params, stats, attempt,
+                     stall_timeout):
+    start = time.monotonic()
+    started = attempt.started
+    try:
+        stream = client.chat.completions.create(
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            timeout=stall_timeout,
+            **params
+        )
+        attempt.opened(stream)
+        parts = []
+        role = "assistant"
+        finish_reason = None
+        usage = None
+        chunk = None
+
+        for chunk in stream:
+            if attempt.cancelled.is_set():
+                return None
+            if chunk.usage is not None:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta.role:
+                    role = choice.delta.role
+                if choice.delta.content:
+                    if not started.is_set():
+                        stats.observe(time.monotonic() - start)
+                        started.set()
+                    parts.append(choice.delta.content)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+
+        return ChatCompletion(
+            id=chunk.id if chunk else "",
+            object="chat.completion",
+            created=chunk.created if chunk else int(time.time()),
+            model=chunk.model if chunk else params.get("model", ""),
+            choices=[Choice(index=0,
+                            finish_reason=finish_reason or "stop",
+                            message=ChatCompletionMessage(
+                                role=role, content="".join(parts)))],
+            usage=usage
+        )
+    finally:
+        started.set()
+        attempt.close()
+
+
+###########################################################
+#
+#  Sends a chat completion, hedged with a second request
+#
+#  Receives:
+#   - route:    route name, keeps latencies and budgets apart
+#   - params:   chat completion parameters of the route
+#   - hedge:    the route's hedging options from routing.json
+#                 percentile:     first-token latency percentile
+#                                 to wait before hedging (95)
+#                 default_delay:  seconds to wait until enough
+#                                 latencies are known (3.0)
+#                 budget:         max fraction of hedged requests
+#                                 (0.05)
+#                 model:          optional alternate model for the
+#                                 hedge request
+#                 stall_timeout:  seconds either request may wait
+#                                 for data, first token included
+#                                 (HEDGE_STALL_TIMEOUT)
+#
+#  Returns:
+#   - the ChatCompletion of whichever request finished first
+#
+#  Throws:
+#   - the error of the primary request if both requests failed
+#
+###########################################################
+def hedgedCompletion(client, route, messages, params, hedge):
+    stats = getRouteStats(route)
+    delay = stats.delay(hedge.get("percentile", 95),
+                        hedge.get("default_delay", 3.0))
+
+    stall_timeout = hedge.get("stall_timeout", HEDGE_STALL_TIMEOUT)
+
+    first = Attempt()
+    primary = executor.submit(streamCompletion, client, messages, params,
+                              stats, first, stall_timeout)
+
+    if first.started.wait(delay) or \
+            not stats.allowHedge(hedge.get("budget", 0.05)):
+        stats.record(False)
+        return primary.result()
+
+    print(f"Hedge: no first token on {route} after {delay:.2f}s, hedging")
+    hedge_params = dict(params)
+    if hedge.get("model"):
+        hedge_params["model"] = hedge["model"]
+    second = Attempt()
+    secondary = executor.submit(streamCompletion, client, messages,
+                                hedge_params, stats, second, stall_timeout)
+
+    # take the first request to succeed, the other one is cancelled
+    pending = {primary: first, secondary: second}
+    winner = None
+    while pending and winner is None:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.pop(future)
+            if future.exception() is None and winner is None:
+                winner = future
+
+    # closing the loser's stream frees its thread now, not after its
+    #   next chunk, which a stalled request may never send
+    for loser in pending.values():
+        loser.cancel()
+
+    stats.record(True, hedge_won=winner is secondary)
+    if winner is None:
+        return primary.result()
+    return winner.result()
@@ -0,0 +1,73 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+import re
+
+# Expected reply sizes in tokens, measured on gpt-4o itineraries:
+#   a day holds ~8 events of ~100 tokens in ITINERARY_JSON format
+TOKENS_PER_DAY = 900
+TOKENS_ITINERARY_BASE = 200
+TOKENS_WEATHER = 1400           # 24 hourly WEATHER_JSON entries
+TOKENS_RECOMMENDATION = 700     # 8 recommendations of up to 2 sentences
+
+# headroom over the expected size before a reply counts as runaway
+HEADROOM = 1.3
+
+# days assumed when a trip's length can't be read
+DEFAULT_DAYS = 7
+
+# most tokens a model writes in one reply, larger max_tokens are refused
+#   with a 400, longer replies are finished by continuation requests
+MODEL_OUTPUT_LIMITS = {
+    "gpt-4o": 16384,
+    "gpt-4o-mini": 16384,
+}
+DEFAULT_OUTPUT_LIMIT = 4096
+
+# continuation requests sent after a reply is cut off by max_tokens
+MAX_CONTINUATIONS = 3
+
+PROMPT_CONTINUE = """Continue exactly where your previous reply stopped.
+                  Do not repeat anything and do not add any introduction."""
+
+
+# Reads a number of days from values like 5, "5" or "5 days"
+def parseDays(days_num):
+    match = re.search(r'\d+', str(days_num or ''))
+    if match is None:
+        return DEFAULT_DAYS
+    return max(int(match.group()), 1)
+
+
+###########################################################
+#
+#  Plans the output size of a route
+#
+#  Receives:
+#   - route:     routing table entry of the request
+#   - days_num:  trip length, for itinerary and personalize routes
+#   - model:     model the request is routed to, max_tokens is
+#                kept under its output limit
+#
+#  Returns:
+#   - a dictionary of chat completion parameters, empty when
+#     the route has no expected size
+#
+#  No stop sequences are set: every planned route answers in
+#  JSON, and cutting it at a stop sequence leaves it unparsable.
+#
+###########################################################
+def planOutput(route, days_num=None, model=None):
+    match(route):
+        case "itinerary" | "personalize":
+            days = parseDays(days_num)
+            expected = TOKENS_ITINERARY_BASE + days * TOKENS_PER_DAY
+        case "weather":
+            expected = TOKENS_WEATHER
+        case "recommendation":
+            expected = TOKENS_RECOMMENDATION
+        case _:
+            return {}
+
+    limit = MODEL_OUTPUT_LIMITS.get(model, DEFAULT_OUTPUT_LIMIT)
+    return {"max_tokens": min(int(expected * HEADROOM), limit)}
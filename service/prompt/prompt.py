@@ -3,6 +3,12 @@
 
 from service.promptType.promptType import PromptType
 from service.client.client import Client
+from service.routing import routing
+from service.prompt import hedge
+from service.prompt import planner
+from service.prompt import embeddings
+import threading
+import base64
 
 # The initial prompt context message for chatGPT to know how to answer
 PROMPT_ITINERARY = """You are a professional vacation planner helping users
@@ -27,6 +33,16 @@ ITINERARY_JSON = {
     "nearby activity": "string"
 }
 
+# Output format instructions, part of the system prompt so that every trip
+#   starts with the same byte-stable prefix (and hits the provider's
+#   prompt cache)
+PROMPT_ITINERARY_FORMAT = f"""Use the following json format with this schema:
+                    {ITINERARY_JSON} where time is based on 12 hour clock,
+                    cost is a dollar amount, and average duration is in hours.
+                    It will be housed within this structure " "Day 1": [],
+                    "Day 2": [], "Day 3": [] " and so on until the last
+                    day."""
+
 PROMPT_UPDATE = f"""Give me an updated itinerary of everything we discussed up
                     to this point. Use the following json format with this
                     schema: {ITINERARY_JSON} where time is based on 12 hour
@@ -45,6 +61,90 @@ WEATHER_JSON = {
     "chance_of_rain": "number"
 }
 
+PROMPT_WEATHER_FORMAT = f"""Answer in json format with this schema:
+                    {WEATHER_JSON} using a 12 hour clock. The WEATHER_JSON
+                    formatted output will be housed within this structure
+                    "forecast":[]. Weather conditions will be identified as
+                    "Clear Night", "Rainy Night", "Cloudy Night", "Sunny",
+                    "Partly Cloudy", "Rainy", "Stormy", "Cloudy", or
+                    "Snowy"."""
+
+PROMPT_RECOMMENDATION = """. Provide 8 different event recommendations
+                    instead. Each recommendation is a maximum of 2 sentences.
+                    output should be like: { "Event 1": { "recommendation":
+                    "Some recommendation text"},"Event 2": {"recommendation":
+                    "Another recommendation text"},...}"""
+
+# Sent after a precomputed base itinerary to fit it to the user's trip
+PROMPT_PERSONALIZE = """Adjust this itinerary to my request above: the party
+                    size, budget, preferences and profile. Keep everything
+                    that already fits and answer with the complete itinerary
+                    in the same json format."""
+
+# Event used when recommendations are generated for a whole itinerary
+PROMPT_RECOMMENDATION_TRIP = """Recommend events for the most recent
+                    itinerary"""
+
+
+# Cleans a string of indentation spaces
+def cleanString(string):
+    return ' '.join(string.split())
+
+
+# Renders a user's profile as the profile block of trip planning prompts
+#   stored with the profile when it's written, see updateUserProfile
+def renderProfile(age, travelStyle, travelPriorities, travelAvoidances,
+                  dietaryRestrictions, accomodations):
+    return cleanString(f"""
+        Plan a trip for a person {age} years old. This person's
+        travel style involves: {travelStyle}. This person
+        prioritizes: {travelPriorities}. This person avoids:
+        {travelAvoidances}. Dietary restrictions:
+        {dietaryRestrictions}. Additional accomodations include:
+        {accomodations}.
+        """)
+
+
+# System prompts, cleaned once so they are identical for every request
+SYSTEM_ITINERARY = cleanString(PROMPT_ITINERARY + " " +
+                               PROMPT_ITINERARY_FORMAT)
+SYSTEM_LOCAL_INFO = cleanString(PROMPT_ITINERARY)
+SYSTEM_WEATHER = cleanString(PROMPT_WEATHER + " " + PROMPT_WEATHER_FORMAT)
+
+# Token usage of every chat completion made by this worker
+#   cached_tokens counts prompt tokens served from the provider's prefix cache
+usage_stats = {
+    "requests": 0,
+    "prompt_tokens": 0,
+    "cached_tokens": 0,
+    "completion_tokens": 0
+}
+usage_lock = threading.Lock()
+
+
+# Adds a completion's usage to usage_stats, returns its cached_tokens
+def recordUsage(completion):
+    usage = getattr(completion, 'usage', None)
+    if usage is None:
+        return 0
+
+    # prompt_tokens_details is only sent by newer API versions
+    details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(details, dict):
+        cached_tokens = details.get('cached_tokens') or 0
+    else:
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0
+
+    with usage_lock:
+        usage_stats["requests"] += 1
+        usage_stats["prompt_tokens"] += usage.prompt_tokens or 0
+        usage_stats["cached_tokens"] += cached_tokens
+        usage_stats["completion_tokens"] += usage.completion_tokens or 0
+
+    print(f"Prompt: {usage.prompt_tokens} prompt tokens, "
+          f"{cached_tokens} cached")
+    return cached_tokens
+
 
 # Prompt class used to make chat GPT prompts
 class Prompt():
@@ -60,6 +160,10 @@ class Prompt():
     #   - promptType:  a PromptType enumeration of the prompt
     #                  type
     #   - options:     options used for the prompt
+    #   - route:       routing table entry used to pick the model and
+    #                  generation parameters, defaults to the
+    #                  prompt type's value
+    #   - days_num:    trip length, sizes max_tokens of itineraries
     #
     #  Returns:
     #   - a response from the ChatGPT client
@@ -69,32 +173,41 @@ class Prompt():
     #                    invalid
     #
     ###########################################################
-    def prompt(self, promptType, options):
+    def prompt(self, promptType, options, route=None, days_num=None):
         match(promptType):
             case PromptType.ChatCompletions:
-                return self.promptChatCompletions(options)
+                return self.promptChatCompletions(
+                    options, route or promptType.value, days_num)
             case PromptType.Embeddings:
-                return self.promptEmbeddings(options)
+                return self.promptEmbeddings(
+                    options, route or promptType.value)
             case PromptType.Images:
                 return self.promptImages(options)
             case _:
                 raise TypeError("Invalid Prompt Type: {promptType}")
 
     # Helper method for Chat GPT chat completion prompts
-    def promptChatCompletions(self, messages):
+    def promptChatCompletions(self, messages, route="chat", days_num=None):
 
         try:
             # print(messages)
             # Make call to chat GPT API
-            completion = self.client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                temperature=1,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
-            )
+            params = routing.getChatParams(route, messages)
+            params.update(planner.planOutput(route, days_num,
+                                             params.get("model")))
+            completion = self.completeChat(messages, route, params)
+
+            # a reply cut off by max_tokens is continued instead of retried
+            continuations = 0
+            while (completion.choices[0].finish_reason == "length" and
+                   continuations < planner.MAX_CONTINUATIONS):
+                continuations += 1
+                print(f"Prompt: {route} reply hit max_tokens, "
+                      f"continuing ({continuations})")
+                completion = self.continueChat(messages, route, params,
+                                               completion)
             # print(completion)
+            recordUsage(completion)
             return completion
         except Exception as e:
             print(e)
@@ -102,16 +215,63 @@ class Prompt():
                 "error": f"Error proocessing request: {e}"
             }
 
+    # Sends one chat completion request
+    def completeChat(self, messages, route, params):
+        hedging = routing.routing_table.getHedge(route)
+        if hedging:
+            # second request if the first one stalls, see hedge.py
+            return hedge.hedgedCompletion(self.client, route, messages,
+                                          params, hedging)
+        return self.client.chat.completions.create(
+            messages=messages,
+            **params
+        )
+
+    # Asks the model to continue a reply cut off by max_tokens
+    # returns 'completion' with the continuation appended to its content
+    def continueChat(self, messages, route, params, completion):
+        message = completion.choices[0].message
+        continued = self.completeChat(messages + [
+            {
+                "role": "assistant",
+                "content": [{"type": "text", "text": message.content}]
+            },
+            {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": cleanString(planner.PROMPT_CONTINUE)
+                }]
+            }
+        ], route, params)
+
+        message.content += continued.choices[0].message.content or ""
+        completion.choices[0].finish_reason = \
+            continued.choices[0].finish_reason
+        if completion.usage is not None and continued.usage is not None:
+            completion.usage.prompt_tokens += continued.usage.prompt_tokens
+            completion.usage.completion_tokens += \
+                continued.usage.completion_tokens
+            completion.usage.total_tokens += continued.usage.total_tokens
+        return completion
+
     # Helper method for Chat GPT embedded prompts
-    def promptEmbeddings(self, options):
+    def promptEmbeddings(self, options, route="embedded"):
         print(options)
         completion = self.client.embeddings.create(
-            model="text-embedding-ada-002",
+            model=routing.routing_table.getRoute(route)["model"],
             input=options.get('text')
         )
 
         return completion.to_json()
 
+    # Embeds many texts in deduplicated, concurrent, provider-sized batches
+    #   postgressconn's embedding_cache serves texts embedded before
+    # returns a (len(texts), dimensions) float32 NumPy array
+    def promptEmbeddingBatch(self, texts, route="embedded",
+                             postgressconn=None):
+        return embeddings.embed(self.client, texts, route, postgressconn)
+
     # Helper method for Chat GPT image prompts
     def promptImages(self, options):
         completion = self.client.images.generate(
@@ -122,15 +282,53 @@ class Prompt():
 
         return completion.to_json()
 
+    # Generates one image and returns its PNG bytes
+    #   the bytes come back in the response, generated URLs expire
+    def promptImageBytes(self, text, size, route="image"):
+        completion = self.client.images.generate(
+            model=routing.routing_table.getRoute(route)["model"],
+            prompt=text,
+            n=1,
+            size=size,
+            response_format="b64_json"
+        )
+
+        return base64.b64decode(completion.data[0].b64_json)
+
     # Helper method for intial trip planning message construction
+    #   profile is the user's rendered profile block, may be empty
     def initialPlanATrip(self, destination, travelers_num, days_num,
-                         travel_preferences, budget):
+                         travel_preferences, budget, profile=""):
 
         userText = self.planATripMessage(destination, travelers_num,
                                          days_num, travel_preferences, budget)
 
-        return self.messageConstructor(cleanString(PROMPT_ITINERARY),
-                                       userText)
+        return self.messageConstructor(SYSTEM_ITINERARY, userText,
+                                       profileText=profile)
+
+    # Helper method for trip planning from a precomputed base itinerary
+    #   returns the initial messages (stored with the trip) and the
+    #   messages sent to GPT, which add the base and a personalize request
+    def personalizeATrip(self, base_itinerary, destination, travelers_num,
+                         days_num, travel_preferences, budget, profile=""):
+
+        messages = self.initialPlanATrip(destination, travelers_num,
+                                         days_num, travel_preferences,
+                                         budget, profile=profile)
+
+        return messages, messages + [
+            {
+                "role": "assistant",
+                "content": [{"type": "text", "text": base_itinerary}]
+            },
+            {
+                "role": "user",
+                "content": [{
+                    "type": "text",
+                    "text": cleanString(PROMPT_PERSONALIZE)
+                }]
+            }
+        ]
 
     # Constructs the initial plan a trip message
     def planATripMessage(self, destination, travelers_num, days_num,
@@ -142,13 +340,7 @@ class Prompt():
                 area, enjoying local food, with a one or two night
                 life. We will strictly stay in {destination}. Budget should
                 be {budget} per person without airfare, but include
-                ehotels, meals and other expenses. {travel_preferences}
-                Use the following json format with this schema:
-                {ITINERARY_JSON}
-                where time is based on 12 hour clock, cost is a dollar amount,
-                and average duration is in hours. It will be housed within this
-                structure " "Day 1": [], "Day 2": [], "Day 3": [] " and so on
-                until the last day."""
+                ehotels, meals and other expenses. {travel_preferences}"""
 
         return cleanString(message)  # removes whitespace from indendation
 
@@ -160,16 +352,9 @@ class Prompt():
     def getHourlyForcast(self, location):
 
         forcastMessage = f"""give me an hourly forcast for weather in
-                      {location} for the next 24 hours in
-                      json format with this schema: {WEATHER_JSON}
-                      using a 12 hour clock. The WEATHER_JSON formatted output
-                      will be housed within this structure "forecast":[].
-                      Weather conditions will be identified as "Clear Night",
-                     "Rainy Night", "Cloudy Night", "Sunny", "Partly Cloudy",
-                       "Rainy", "Stormy", "Cloudy", or "Snowy"
-                       """
-
-        return self.messageConstructor(cleanString(PROMPT_WEATHER),
+                      {location} for the next 24 hours."""
+
+        return self.messageConstructor(SYSTEM_WEATHER,
                                        cleanString(forcastMessage))
 
     # Constructs the initial plan a trip message
@@ -180,6 +365,10 @@ class Prompt():
 
         return cleanString(message)  # removes whitespace from indendation
 
+    # Asks for event recommendations, sent after the chat history
+    def getTravelRecommendation(self, event=PROMPT_RECOMMENDATION_TRIP):
+        return cleanString(event) + cleanString(PROMPT_RECOMMENDATION)
+
     def getLocalInfo(self, destination, time, date,
                      resterauntConditions):
 
@@ -193,11 +382,14 @@ class Prompt():
                         to do around this area. {resterauntConditions}
                         """
 
-        return self.messageConstructor(cleanString(PROMPT_ITINERARY),
+        return self.messageConstructor(SYSTEM_LOCAL_INFO,
                                        cleanString(localInfoMessage))
 
     # Helper method to construct messages
-    def messageConstructor(self, systemText, userText):
+    #   Messages always come in the same order so the prompt starts with a
+    #   byte-stable prefix: the shared system prompt, then the user's
+    #   profile block (when given), then the per-request user text.
+    def messageConstructor(self, systemText, userText, profileText=""):
 
         messages = [
             {
@@ -208,21 +400,28 @@ class Prompt():
                         "text": systemText
                     }
                 ]
-            },
-            {
-                "role": "user",
+            }
+        ]
+
+        if profileText:
+            messages.append({
+                "role": "system",
                 "content": [
                     {
                         "type": "text",
-                        "text": userText
+                        "text": cleanString(profileText)
                     }
                 ]
-            }
-        ]
+            })
+
+        messages.append({
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": userText
+                }
+            ]
+        })
 
         return messages
-
-
-# Cleans a string of indentation spaces
-def cleanString(string):
-    return ' '.join(string.split())
@@ -0,0 +1,194 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import numpy as np
+import hashlib
+import threading
+import os
+import re
+
+from service.prompt import prompt
+from service.routing import routing
+from service.postgres.records import make_message
+from service.postgres.postgresdb import PostgresDB
+
+load_dotenv()
+
+# conversations estimated over this many tokens are sent as retrieved turns
+#   instead of the full history
+RETRIEVAL_MIN_TOKENS = int(os.getenv('RETRIEVAL_MIN_TOKENS', '3000'))
+
+# past chat messages picked by similarity to the user's new message
+RETRIEVAL_TOP_K = int(os.getenv('RETRIEVAL_TOP_K', '6'))
+
+# most recent chat messages always sent, so follow-ups keep their context
+RETRIEVAL_RECENT = 2
+
+# set to 1 to embed with localEmbed instead of the provider (development)
+EMBEDDINGS_LOCAL = os.getenv('EMBEDDINGS_LOCAL', '0') == '1'
+
+# message categories that are embedded and retrieved, the system prompts,
+#   the user's trip request and the latest itinerary are always sent
+EMBEDDED_CATEGORIES = ("USERCHAT", "GPTCHAT")
+ALWAYS_SENT = ("SYSTEMPROMPT", "USERPROMPT")
+
+LOCAL_DIMENSIONS = 256
+WORDS = re.compile(r"\w+")
+
+# embeddings of new messages are computed off the request thread
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="embed")
+
+# prompt tokens of the full histories vs of what retrieval sent
+retrieval_stats = {
+    "requests": 0,
+    "history_tokens": 0,
+    "sent_tokens": 0
+}
+retrieval_lock = threading.Lock()
+
+
+# Embeddings are stored as float32 bytes, 6KB for 1536 dimensions
+def packVector(vector):
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def unpackVector(data):
+    return np.frombuffer(data, dtype=np.float32)
+
+
+# Stand-in for the provider's embeddings: hashed bag of words, unit length
+#   close enough to rank messages sharing words with the question
+def localEmbed(texts, postgressconn=None):
+    vectors = np.zeros((len(texts), LOCAL_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in WORDS.findall(text.lower()):
+            digest = hashlib.blake2b(word.encode(), digest_size=4).digest()
+            column = int.from_bytes(digest, 'little') % LOCAL_DIMENSIONS
+            vectors[row, column] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# Returns the function used to embed a list of texts, see
+#   Prompt.promptEmbeddingBatch
+def getEmbed():
+    if EMBEDDINGS_LOCAL:
+        return localEmbed
+    p = prompt.Prompt()
+    return lambda texts, postgressconn=None: p.promptEmbeddingBatch(
+        texts, postgressconn=postgressconn)
+
+
+# Returns the name of the model getEmbed embeds with, stored with every
+#   embedding: vectors of different models can't be compared
+def embeddingModel():
+    if EMBEDDINGS_LOCAL:
+        return "local"
+    return routing.routing_table.getRoute("embedded")["model"]
+
+
+# Embeds every chat message of a trip that has no embedding of the current
+#   model yet, replacing embeddings of a previous model
+# returns the number of messages embedded
+def embedTrip(postgressconn, trip_id, embed=None):
+    model = embeddingModel()
+    rows = postgressconn.get_unembedded_messages(trip_id, model) or []
+    if not rows:
+        return 0
+    embed = embed or getEmbed()
+    vectors = embed([text for _, text in rows], postgressconn=postgressconn)
+    postgressconn.create_message_embeddings(
+        [(message_id, trip_id, model, packVector(vector))
+         for (message_id, _), vector in zip(rows, vectors)])
+    return len(rows)
+
+
+def _embedTripJob(trip_id):
+    postgressconn = PostgresDB()
+    try:
+        count = embedTrip(postgressconn, trip_id)
+        print(f"Retrieval: embedded {count} messages of trip {trip_id}")
+    except Exception as error:
+        print(f"Retrieval: could not embed trip {trip_id}: {error}")
+    finally:
+        postgressconn.close_db_connection()
+
+
+# Embeds a trip's new messages in the background
+def embedTripAsync(trip_id):
+    executor.submit(_embedTripJob, trip_id)
+
+
+###########################################################
+#
+#  Picks the past messages worth sending with a new question
+#
+#  Receives:
+#   - turns:     (message_id, role, content_type, content_text,
+#                 message_category, embedding) of every message,
+#                system prompts first (see get_chat_turns)
+#   - query:     embedding of the user's new message
+#   - k:         number of past chat messages picked by similarity
+#
+#  Returns:
+#   - an array of 'message' objects: system prompts, the trip
+#     request, the top-k similar chat messages, the latest
+#     chat messages and the latest itinerary, in the order
+#     they were written
+#
+###########################################################
+def selectContext(turns, query, k=RETRIEVAL_TOP_K):
+    chats = [turn for turn in turns if turn[4] in EMBEDDED_CATEGORIES]
+    itineraries = [turn for turn in turns if turn[4] == "ITINERARY"]
+
+    keep = {turn[0] for turn in chats[-RETRIEVAL_RECENT:]}
+    if itineraries:
+        keep.add(itineraries[-1][0])
+
+    # messages embedded after the question came in are sent as they are
+    candidates = []
+    for turn in chats:
+        if turn[0] in keep:
+            continue
+        if turn[5] is None:
+            keep.add(turn[0])
+        else:
+            candidates.append(turn)
+
+    # provider embeddings are unit length, so dot products are cosines
+    if candidates and k > 0:
+        matrix = np.stack([unpackVector(turn[5]) for turn in candidates])
+        scores = matrix @ np.asarray(query, dtype=np.float32)
+        for index in np.argsort(scores)[-k:]:
+            keep.add(candidates[index][0])
+
+    head = [turn for turn in turns if turn[4] in ALWAYS_SENT]
+    body = sorted((turn for turn in turns if turn[0] in keep),
+                  key=lambda turn: turn[0])
+    return [make_message(turn[1], turn[2], turn[3]) for turn in head + body]
+
+
+# Returns the messages to send with a new chat message on a long trip
+#   falls back to None (send the full history) if anything is missing
+def retrieveContext(postgressconn, trip_id, history, user_text):
+    history_tokens = routing.estimateTokens(history)
+    if history_tokens <= RETRIEVAL_MIN_TOKENS:
+        return None
+
+    try:
+        turns = postgressconn.get_chat_turns(trip_id, embeddingModel())
+        if not turns:
+            return None
+        query = getEmbed()([user_text], postgressconn=postgressconn)[0]
+        messages = selectContext(turns, query)
+    except Exception as error:
+        print(f"Retrieval: sending the full history of {trip_id}: {error}")
+        return None
+
+    with retrieval_lock:
+        retrieval_stats["requests"] += 1
+        retrieval_stats["history_tokens"] += history_tokens
+        retrieval_stats["sent_tokens"] += routing.estimateTokens(messages)
+    return messages
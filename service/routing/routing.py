@@ -0,0 +1,127 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+from service.serializer import serializer
+
+load_dotenv()
+
+# Routing table mapping each route (or PromptType value) to the model and
+#   generation parameters it uses, see routing.json
+ROUTING_FILE = os.getenv('PROMPT_ROUTING_FILE',
+                         os.path.join(os.path.dirname(__file__),
+                                      'routing.json'))
+
+# seconds between checks of the routing file's modification time
+RELOAD_INTERVAL = 1.0
+
+# rough number of characters per token, used for size-based rules
+CHARS_PER_TOKEN = 4
+
+# route keys that configure prompt-svc instead of the completion request
+ROUTE_OPTIONS = ("rules", "hedge")
+
+
+###########################################################
+#
+#  Routing table loaded from a JSON file, reloaded when
+#  the file changes.
+#
+#  File format:
+#   {"default": {params for every route},
+#    "routes": {"<route>": {params overriding the default,
+#                           "rules": [{"max_prompt_tokens": N,
+#                                      params used under N tokens}],
+#                           "hedge": {hedging options, see hedge.py}}}}
+#
+###########################################################
+class RoutingTable():
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.table = {"default": {}, "routes": {}}
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.reload()
+
+    # Reloads the table if the file changed since it was last read
+    #   a file that can't be parsed keeps the previous table in use
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path, 'rb') as f:
+                table = serializer.decode(f.read())
+            table.setdefault("default", {})
+            table.setdefault("routes", {})
+            self.table = table
+            self.mtime = mtime
+            print(f"Routing: loaded {self.path}")
+        except (OSError, ValueError) as error:
+            print(f"Routing: could not load {self.path}: {error}")
+
+    def _refresh(self):
+        now = time.monotonic()
+        if now - self.checked < RELOAD_INTERVAL:
+            return
+        with self.lock:
+            if now - self.checked >= RELOAD_INTERVAL:
+                self.checked = now
+                self.reload()
+
+    # Returns the generation parameters of a route
+    #   prompt_tokens picks the first size-based rule it fits under
+    def getRoute(self, route, prompt_tokens=None):
+        self._refresh()
+        table = self.table
+        config = table["routes"].get(route, {})
+
+        params = dict(table["default"])
+        params.update((k, v) for k, v in config.items()
+                      if k not in ROUTE_OPTIONS)
+
+        if prompt_tokens is not None:
+            for rule in config.get("rules", []):
+                if prompt_tokens <= rule.get("max_prompt_tokens", 0):
+                    params.update((k, v) for k, v in rule.items()
+                                  if k != "max_prompt_tokens")
+                    break
+
+        return params
+
+    # Returns the hedging options of a route, None when it doesn't hedge
+    def getHedge(self, route):
+        self._refresh()
+        return self.table["routes"].get(route, {}).get("hedge")
+
+
+# Estimates the number of tokens in a string
+def estimateTextTokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+
+# Estimates the number of tokens in an array of 'message' objects
+def estimateTokens(messages):
+    chars = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            for part in content or []:
+                chars += len(part.get('text') or '')
+    return chars // CHARS_PER_TOKEN
+
+
+routing_table = RoutingTable(ROUTING_FILE)
+
+
+# Returns the chat completion parameters for messages sent on a route
+def getChatParams(route, messages):
+    return routing_table.getRoute(route, estimateTokens(messages))
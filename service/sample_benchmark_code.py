@@ -0,0 +1,171 @@
+"""Microbenchmarks for prompt-svc hot paths.
+Simply run $ python -m service.sample_benchmark_code to print the timings.
+No database or OpenAI key is needed, rows and payloads are generated locally.
+"""
+
+import json
+import timeit
+
+from service.postgres.records import fetch_rows, rows_to_messages
+from service.serializer import serializer
+from service.itinerary import itinerary
+
+NUM_MESSAGES = 10000
+NUM_DAYS = 14
+REPEAT = 20
+NUM_VERSIONS = 100
+
+
+# Stand-in for a psycopg2 cursor holding an already executed result set
+class FakeCursor():
+
+    def __init__(self, rows) -> None:
+        self.rows = rows
+        self.pos = 0
+        self.arraysize = 1
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        row = self.rows[self.pos]
+        self.pos += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = size or self.arraysize
+        batch = self.rows[self.pos:self.pos + size]
+        self.pos += len(batch)
+        return batch
+
+
+def make_message_rows(num_messages):
+    return [("assistant" if i % 2 else "user", "text",
+             f"message number {i} " * 20, "GPTCHAT")
+            for i in range(num_messages)]
+
+
+# the fetchone() loop get_chat_history used before records.py
+def fetchone_chat_history(cur):
+    chat_history = []
+    row = cur.fetchone()
+    while row is not None:
+        message_object = {
+            "role": row[0],
+            "content": [
+                {
+                    "type": row[1],
+                    "text": row[2]
+                }
+            ]
+        }
+        chat_history.append(message_object)
+        row = cur.fetchone()
+    return chat_history
+
+
+def bulk_chat_history(cur):
+    return rows_to_messages(fetch_rows(cur))
+
+
+def benchmark_chat_history():
+    rows = make_message_rows(NUM_MESSAGES)
+    assert (fetchone_chat_history(FakeCursor(rows)) ==
+            bulk_chat_history(FakeCursor(rows)))
+
+    for name, func in (("fetchone loop", fetchone_chat_history),
+                       ("bulk mapping", bulk_chat_history)):
+        seconds = timeit.timeit(lambda: func(FakeCursor(rows)),
+                                number=REPEAT) / REPEAT
+        print(f"get_chat_history {name}: {NUM_MESSAGES} messages "
+              f"in {seconds * 1000:.2f} ms")
+
+
+def make_itinerary(days_num):
+    event = {
+        "time": "9:00 AM",
+        "location": "Senso-ji Temple",
+        "activity": "Walk through Nakamise street and the temple grounds",
+        "average duration": 2,
+        "cost": 0,
+        "travel methods": "Ginza subway line to Asakusa station",
+        "nearby resteraunts": "Daikokuya Tempura, Asakusa Imahan",
+        "tips": "Arrive early to avoid the crowds",
+        "nearby activity": "Sumida river cruise"
+    }
+    return {f"Day {day}": [dict(event) for _ in range(8)]
+            for day in range(1, days_num + 1)}
+
+
+def benchmark_json():
+    itinerary = make_itinerary(NUM_DAYS)
+    history = rows_to_messages(make_message_rows(NUM_MESSAGES))
+    payloads = (("itinerary", {"gpt-message": json.dumps(itinerary),
+                               "trip_id": 1}),
+                ("history", {"messages": history}))
+
+    for name, payload in payloads:
+        body = json.dumps(payload)
+        assert serializer.decode(serializer.encode(payload)) == payload
+        for label, func in (("stdlib encode", lambda: json.dumps(payload)),
+                            ("msgspec encode",
+                             lambda: serializer.encode(payload)),
+                            ("stdlib decode", lambda: json.loads(body)),
+                            ("msgspec decode",
+                             lambda: serializer.decode(body))):
+            seconds = timeit.timeit(func, number=REPEAT) / REPEAT
+            print(f"{name} {label}: {len(body)} bytes "
+                  f"in {seconds * 1000:.2f} ms")
+
+
+# 100 versions of a trip, each update changing one event of one day
+def make_itinerary_versions(num_versions):
+    base = make_itinerary(NUM_DAYS)
+    versions = [json.dumps(base)]
+    for i in range(1, num_versions):
+        current = json.loads(versions[-1])
+        day = f"Day {i % NUM_DAYS + 1}"
+        current[day][i % 8]["activity"] = f"Updated activity {i}"
+        versions.append(json.dumps(current))
+    return versions
+
+
+def benchmark_itinerary_versions():
+    versions = make_itinerary_versions(NUM_VERSIONS)
+    rows = []
+    for version, text in enumerate(versions, start=1):
+        previous = versions[version - 2] if version > 1 else None
+        rows.append((version,) + itinerary.encodeVersion(version, previous,
+                                                         text))
+
+    # the ITINERARY messages keep every version whole, itinerary_versions
+    #   is stored on top of them
+    message_bytes = sum(len(text) for text in versions)
+    version_bytes = sum(len(body) for _, _, body in rows)
+    print(f"itinerary versions: {NUM_VERSIONS} versions, "
+          f"messages {message_bytes} bytes, itinerary_versions "
+          f"{version_bytes} bytes, total {message_bytes + version_bytes} "
+          f"bytes (+{version_bytes / message_bytes:.1%} over messages "
+          f"alone)")
+
+    # the slowest version to rebuild is the one before a snapshot
+    last = max(version for version, is_snapshot, _ in rows if is_snapshot)
+    chain = rows[last - 1 - itinerary.SNAPSHOT_INTERVAL:last - 1]
+    assert (json.loads(itinerary.reconstruct(chain)) ==
+            json.loads(versions[last - 2]))
+
+    for label, func in (("parse whole version",
+                         lambda: itinerary.parseItinerary(versions[-1])),
+                        (f"rebuild from {len(chain) - 1} deltas",
+                         lambda: itinerary.reconstruct(chain))):
+        seconds = timeit.timeit(func, number=REPEAT) / REPEAT
+        print(f"itinerary versions {label}: {seconds * 1000:.2f} ms")
+
+
+def run():
+    benchmark_chat_history()
+    benchmark_json()
+    benchmark_itinerary_versions()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,85 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+from flask.json.provider import JSONProvider
+import msgspec
+
+
+###########################################################
+#
+#  Typed payloads
+#
+#  Structs are encoded directly by msgspec and decode requests
+#  with validation, so routes don't need per-key checks.
+#  strict=False lets numbers sent as strings ("5") still decode.
+#
+###########################################################
+
+# a row of the 'trips' table, as returned by get-trip-history
+class Trip(msgspec.Struct):
+    trip_id: int
+    user_id: str | None
+    destination: str
+    days_num: str
+    travelers_num: str
+    budget: str
+    travel_preference: str | None
+
+
+# a chat message sent from UI's chat-box to trip-planning-chat
+class ChatMessage(msgspec.Struct):
+    trip_id: int
+    message: str
+
+
+# profile form posted to /v1/prompt/profile
+class Profile(msgspec.Struct, rename={
+        "travelStyle": "travel-style",
+        "travelPriorities": "travel-priorities",
+        "travelAvoidances": "travel-avoidances",
+        "dietaryRestrictions": "dietary-restrictions"}):
+    age: int
+    travelStyle: str
+    travelPriorities: str
+    travelAvoidances: str
+    dietaryRestrictions: str
+    accomodations: str
+
+
+_encoder = msgspec.json.Encoder()
+_decoder = msgspec.json.Decoder()
+
+
+# Decodes a JSON document, into 'type' when given
+# Throws:
+#   - ValueError: if the document is not valid JSON or doesn't match 'type'
+def decode(data, type=None):
+    try:
+        if type is None:
+            return _decoder.decode(data)
+        return msgspec.json.decode(data, type=type, strict=False)
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e)) from e
+
+
+# Encodes an object (dicts, lists, Structs...) to JSON bytes
+def encode(obj):
+    return _encoder.encode(obj)
+
+
+# Flask JSON provider backed by msgspec, used for request.get_json()
+#   and for every dict/list returned from a route
+class MsgspecJSONProvider(JSONProvider):
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return decode(s)
+
+    # skip the bytes -> str -> bytes round-trip of JSONProvider.response
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(encode(obj), mimetype=self.mimetype)
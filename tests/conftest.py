@@ -0,0 +1,53 @@
+# CS467 Online Capstone: GPT API Challenge
+# Kongkom Hiranpradit, Connor Flattum, Nathan Swaim, Noah Zajicek
+
+"""Shared fakes of prompt-svc's unit tests.
+
+The modules under test read DATABASE_URL and OPENAI_API_KEY when they are
+imported, no database or API is reached by these tests.
+"""
+
+from types import SimpleNamespace
+import os
+
+from openai.types.chat import ChatCompletion
+import pytest
+
+os.environ.setdefault('DATABASE_URL', 'postgresql://test@127.0.0.1:1/test')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+os.environ.setdefault('CACHE_NOTIFY', '0')
+
+
+# Chat completion as returned by the OpenAI client
+def makeCompletion(content, finish_reason="stop"):
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "gpt-test",
+        "choices": [{
+            "index": 0,
+            "finish_reason": finish_reason,
+            "message": {"role": "assistant", "content": content}
+        }]
+    })
+
+
+# Stand-in for the OpenAI client's chat completions, replies with
+#   reply(request) and records every request
+class FakeClient():
+
+    def __init__(self, reply=lambda request: "reply") -> None:
+        self.reply = reply
+        self.requests = []
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **request):
+        self.requests.append(request)
+        return makeCompletion(self.reply(request))
+
+
+@pytest.fixture
+def fake_client():
+    return FakeClient()
@@ -0,0 +1,149 @@
+import pytest
+
+from service.batch import batch
+from service.prompt import planner
+from service.serializer import serializer
+
+
+# Stand-in for PostgresDB's trips, batches and batch results
+class FakeBatchDB():
+
+    def __init__(self, trips, histories=None) -> None:
+        self.trips = trips
+        self.histories = histories or {}
+        self.batches = {}
+        self.messages = []
+        self.results = set()
+        self.crash_on = None    # message number raising like a lost worker
+
+    def get_all_trips(self):
+        return self.trips
+
+    def get_chat_history(self, trip_id):
+        return list(self.histories.get(trip_id, []))
+
+    def create_batch_to_db(self, batch_id, kind, status, request_count):
+        self.batches[batch_id] = [kind, status, request_count, None]
+        return batch_id
+
+    def update_batch_status(self, batch_id, status, output_file_id=None):
+        self.batches[batch_id][1] = status
+        self.batches[batch_id][3] = output_file_id
+        return batch_id
+
+    def get_open_batches(self):
+        return [(batch_id, kind, status, count, output_file_id)
+                for batch_id, (kind, status, count, output_file_id)
+                in self.batches.items()
+                if status not in ('written', 'failed', 'expired',
+                                  'cancelled')]
+
+    def create_batch_message(self, batch_id, custom_id, trip_id, role,
+                             content_text, message_category):
+        if (batch_id, custom_id) in self.results:
+            return None
+        if self.crash_on == len(self.messages):
+            self.crash_on = None
+            raise RuntimeError("worker lost")
+        self.results.add((batch_id, custom_id))
+        self.messages.append((trip_id, role, content_text, message_category))
+        return len(self.messages)
+
+
+TRIPS = [(1, "user", "Paris"), (2, "user", "Tokyo"), (3, "user", "Rome")]
+
+
+def uploadedRequests(client):
+    upload = next(iter(client.uploads.values()))
+    return [serializer.decode(line) for line in upload.splitlines()]
+
+
+def test_submit_sizes_every_request_for_its_kind():
+    client = batch.LocalBatchClient()
+    db = FakeBatchDB(TRIPS)
+
+    batch_id = batch.submitBatch(client, db, "weather")
+
+    requests = uploadedRequests(client)
+    assert [request["custom_id"] for request in requests] == \
+        ["weather-1", "weather-2", "weather-3"]
+    assert {request["body"]["max_tokens"] for request in requests} == \
+        {planner.planOutput("weather")["max_tokens"]}
+    assert db.batches[batch_id] == ["weather", "completed", 3, None]
+
+
+def test_submit_skips_trips_without_history():
+    client = batch.LocalBatchClient()
+    db = FakeBatchDB(TRIPS, {2: [{"role": "user", "content": []}]})
+
+    batch.submitBatch(client, db, "recommendation", limit=2)
+
+    requests = uploadedRequests(client)
+    assert [request["custom_id"] for request in requests] == \
+        ["recommendation-2"]
+    assert requests[0]["body"]["messages"][-1]["role"] == "user"
+
+
+def test_submit_without_requests_creates_no_batch():
+    db = FakeBatchDB([])
+    assert batch.submitBatch(batch.LocalBatchClient(), db, "weather") is None
+    assert db.batches == {}
+
+
+def test_collect_writes_every_result_once():
+    client = batch.LocalBatchClient()
+    db = FakeBatchDB(TRIPS)
+    batch_id = batch.submitBatch(client, db, "weather")
+
+    batch.collectBatches(client, db)
+    batch.collectBatches(client, db)
+
+    assert [message[0] for message in db.messages] == [1, 2, 3]
+    assert {message[3] for message in db.messages} == {batch.WEATHER}
+    assert serializer.decode(db.messages[0][2])["local"] is True
+    assert db.batches[batch_id][1] == "written"
+    assert db.get_open_batches() == []
+
+
+def test_collect_rerun_after_a_crash_skips_written_results():
+    client = batch.LocalBatchClient()
+    db = FakeBatchDB(TRIPS)
+    batch_id = batch.submitBatch(client, db, "weather")
+    db.crash_on = 2
+
+    with pytest.raises(RuntimeError):
+        batch.collectBatches(client, db)
+    assert db.batches[batch_id][1] == "completed"
+
+    # the output file is written again from the top
+    written = batch.writeResults(client, db, "weather", batch_id,
+                                 db.batches[batch_id][3])
+    assert written == 1
+    assert [message[0] for message in db.messages] == [1, 2, 3]
+
+
+def test_failed_results_are_not_written():
+    client = batch.LocalBatchClient()
+    output = serializer.encode({"custom_id": "weather-1", "response": None,
+                                "error": {"message": "rate limited"}})
+    client.uploads["file-out"] = output
+    db = FakeBatchDB(TRIPS)
+
+    assert batch.writeResults(client, db, "weather", "batch-1",
+                              "file-out") == 0
+    assert db.messages == []
+
+
+def test_local_collect_leaves_provider_batches_open():
+    client = batch.LocalBatchClient()
+    db = FakeBatchDB(TRIPS)
+    db.create_batch_to_db("batch-provider", "weather", "in_progress", 3)
+    batch_id = batch.submitBatch(client, db, "weather")
+
+    batch.collectBatches(client, db, client.jobs)
+
+    assert db.batches[batch_id][1] == "written"
+    assert db.batches["batch-provider"][1] == "in_progress"
+    assert [row[0] for row in db.get_open_batches()] == ["batch-provider"]
+    with pytest.raises(KeyError):
+        client.batches.retrieve("batch-provider")
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+import threading
+import time
+
+from service.prompt import hedge
+
+
+def makeChunk(content=None, finish_reason=None):
+    return SimpleNamespace(
+        id="chatcmpl-test", created=0, model="gpt-test", usage=None,
+        choices=[SimpleNamespace(
+            delta=SimpleNamespace(role="assistant", content=content),
+            finish_reason=finish_reason)])
+
+
+# Stream that sends 'parts' then finishes, or stalls before its first
+#   chunk until it is closed
+class FakeStream():
+
+    def __init__(self, parts, stall=False) -> None:
+        self.parts = parts
+        self.stall = stall
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        if self.stall:
+            self.closed.wait(5)
+            raise ConnectionError("stream closed")
+        for part in self.parts:
+            yield makeChunk(part)
+        yield makeChunk(finish_reason="stop")
+
+    def close(self):
+        self.closed.set()
+
+
+# Client whose first request stalls and second one answers
+class FakeHedgeClient():
+
+    def __init__(self) -> None:
+        self.streams = [FakeStream([], stall=True),
+                        FakeStream(["hedged ", "reply"])]
+        self.requests = []
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **request):
+        self.requests.append(request)
+        return self.streams[len(self.requests) - 1]
+
+
+def test_stalled_primary_is_closed_by_the_hedge():
+    client = FakeHedgeClient()
+    options = {"default_delay": 0.05, "budget": 1.0, "stall_timeout": 9}
+
+    completion = hedge.hedgedCompletion(client, "test-stall", [],
+                                        {"model": "gpt-test"}, options)
+
+    assert completion.choices[0].message.content == "hedged reply"
+    # the winner closed the stalled stream instead of leaving its thread
+    #   blocked until the stall timeout
+    assert client.streams[0].closed.wait(1)
+    assert [request["timeout"] for request in client.requests] == [9, 9]
+    assert hedge.getRouteStats("test-stall").stats()["hedge_wins"] == 1
+
+
+def test_attempt_cancelled_before_its_stream_opened_closes_it():
+    attempt = hedge.Attempt()
+    attempt.cancel()
+    stream = FakeStream([])
+
+    attempt.opened(stream)
+
+    assert stream.closed.is_set()
+
+
+def test_unhedged_request_is_assembled_from_its_chunks():
+    stream = FakeStream(["a", "b"])
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        create=lambda **request: stream)))
+    start = time.monotonic()
+
+    completion = hedge.hedgedCompletion(client, "test-fast", [], {},
+                                        {"default_delay": 1.0})
+
+    assert completion.choices[0].message.content == "ab"
+    assert completion.choices[0].finish_reason == "stop"
+    assert time.monotonic() - start < 1.0
+    assert stream.closed.is_set()
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+from service.images import images
+from service.main import app
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(images, "IMAGE_CACHE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def storeImage(key, size, served_at):
+    path = images.imagePath(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b"x" * size)
+    os.utime(path, (served_at, served_at))
+    return path
+
+
+def test_evict_removes_least_recently_served_images(image_dir):
+    old = storeImage("aa" + "1" * 62, 100, 1000)
+    served = storeImage("bb" + "2" * 62, 100, 2000)
+    new = storeImage("cc" + "3" * 62, 100, 3000)
+
+    assert images.evict(max_bytes=250) == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(served) and os.path.exists(new)
+    assert images.evict(max_bytes=250) == 0
+
+
+def test_serving_an_image_marks_it_recently_served(image_dir):
+    text = images.destinationPrompt("Paris, France")
+    key = images.imageKey(text, "512x512")
+    path = storeImage(key, 100, 1000)
+
+    assert images.requestImage(text, "512x512") == ("ready", key)
+    assert os.stat(path).st_mtime > 1000
+
+
+def test_image_route_needs_a_user_and_a_known_destination(monkeypatch):
+    requested = []
+    monkeypatch.setattr(images, "requestImage", lambda text, size:
+                        requested.append(text) or ("pending", "key"))
+    client = app.test_client()
+
+    response = client.get('/v1/prompt/image?destination=paris')
+    assert response.status_code == 401
+
+    headers = {"Authorization": "Bearer user-1"}
+    response = client.get('/v1/prompt/image?destination=nowhere-' + "x" * 20,
+                          headers=headers)
+    assert response.status_code == 404
+
+    response = client.get('/v1/prompt/image?destination=nyc',
+                          headers=headers)
+    assert response.status_code == 202
+    assert requested == [images.destinationPrompt("New York City, USA")]
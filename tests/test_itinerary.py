@@ -0,0 +1,31 @@
+from service.itinerary import itinerary
+
+
+REPLY_1 = '```json\n{"Day 1": [{"activity": "Louvre"}],\n "Day 2": []}\n```'
+REPLY_2 = '```json\n{"Day 1": [{"activity": "Orsay"}],\n "Day 2": []}\n```'
+
+
+def encodeReplies(replies):
+    rows = []
+    for version, text in enumerate(replies, start=1):
+        previous = replies[version - 2] if version > 1 else None
+        rows.append((version,) + itinerary.encodeVersion(version, previous,
+                                                         text))
+    return rows
+
+
+def test_snapshot_is_rebuilt_byte_for_byte():
+    rows = encodeReplies([REPLY_1])
+    assert rows[0][1] is True
+    assert itinerary.reconstruct(rows) == REPLY_1
+
+
+def test_version_rebuilt_from_deltas_is_normalized():
+    rows = encodeReplies([REPLY_1, REPLY_2])
+    assert rows[1][1] is False
+
+    text = itinerary.reconstruct(rows)
+    assert text != REPLY_2
+    assert text == '{"Day 1":[{"activity":"Orsay"}],"Day 2":[]}'
+    assert itinerary.parseItinerary(text) == \
+        itinerary.parseItinerary(REPLY_2)
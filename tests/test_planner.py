@@ -0,0 +1,49 @@
+from service.prompt import planner
+from service.prompt import prompt
+
+from conftest import FakeClient, makeCompletion
+
+
+# Client that cuts its replies off at max_tokens until the last one
+class FakeLengthClient(FakeClient):
+
+    def __init__(self, parts) -> None:
+        super().__init__()
+        self.parts = parts
+
+    def _create(self, **request):
+        self.requests.append(request)
+        last = len(self.requests) == len(self.parts)
+        return makeCompletion(self.parts[len(self.requests) - 1],
+                              "stop" if last else "length")
+
+
+def test_itinerary_size_grows_with_the_trip():
+    assert planner.planOutput("itinerary", "3 days", "gpt-4o") == \
+        {"max_tokens": int((200 + 3 * 900) * planner.HEADROOM)}
+    assert planner.planOutput("chat", 3, "gpt-4o") == {}
+
+
+def test_long_trip_is_kept_under_the_model_output_limit():
+    limit = planner.MODEL_OUTPUT_LIMITS["gpt-4o"]
+    assert planner.planOutput("itinerary", 14, "gpt-4o") == \
+        {"max_tokens": limit}
+    assert planner.planOutput("personalize", "30 days", "gpt-4o-mini") == \
+        {"max_tokens": planner.MODEL_OUTPUT_LIMITS["gpt-4o-mini"]}
+    assert planner.planOutput("itinerary", 14, "unknown-model") == \
+        {"max_tokens": planner.DEFAULT_OUTPUT_LIMIT}
+
+
+def test_long_trip_reply_is_finished_by_continuations():
+    p = prompt.Prompt()
+    p.client = FakeLengthClient(['{"Day 1": [], ', '"Day 14": []}'])
+    messages = [{"role": "user", "content": "plan a 14 day trip"}]
+
+    completion = p.promptChatCompletions(messages, "itinerary", "14 days")
+
+    assert completion.choices[0].message.content == \
+        '{"Day 1": [], "Day 14": []}'
+    assert completion.choices[0].finish_reason == "stop"
+    limit = planner.MODEL_OUTPUT_LIMITS[p.client.requests[0]["model"]]
+    assert all(request["max_tokens"] <= limit
+               for request in p.client.requests)
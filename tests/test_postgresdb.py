@@ -0,0 +1,169 @@
+import psycopg2
+import pytest
+
+from service.cache.cache import conversation_cache
+from service.postgres import SQLcmd
+from service.postgres import postgresdb
+from service.postgres.postgresdb import PostgresDB
+
+
+# PostgresDB without a database connection
+def makeDB():
+    db = PostgresDB.__new__(PostgresDB)
+    db.conn = None
+    db.replica_conn = None
+    db.shard_conns = {}
+    return db
+
+
+# Cursor over an in-memory itinerary_versions table, 'racer' runs before
+#   each insert like a concurrent update committing first
+class FakeVersionCursor():
+
+    def __init__(self, versions, racer=lambda versions: None) -> None:
+        self.versions = versions
+        self.racer = racer
+        self.row = None
+
+    def execute(self, statement, params):
+        if statement is SQLcmd.select_latest_itinerary_version:
+            self.row = (max(self.versions, default=0), )
+        elif statement is SQLcmd.insert_itinerary_version:
+            self.racer(self.versions)
+            _, version, _, _, body = params
+            if version in self.versions:
+                self.row = None
+            else:
+                self.versions[version] = body
+                self.row = (version, )
+        else:
+            raise AssertionError(statement)
+
+    def fetchone(self):
+        return self.row
+
+
+def test_itinerary_version_is_numbered_after_the_last():
+    db = makeDB()
+    db.get_itinerary_version = lambda trip_id, version: '{"Day 1": []}'
+    cur = FakeVersionCursor({1: '{"Day 1": []}'})
+
+    assert db.add_itinerary_version(cur, 7, 20, '{"Day 1": ["a"]}') == 2
+    assert set(cur.versions) == {1, 2}
+
+
+def test_itinerary_version_taken_concurrently_is_numbered_again():
+    def racer(versions):
+        versions.setdefault(2, "concurrent")
+
+    db = makeDB()
+    bases = []
+
+    def get_itinerary_version(trip_id, version):
+        bases.append(version)
+        return cur.versions[version]
+
+    db.get_itinerary_version = get_itinerary_version
+    cur = FakeVersionCursor({1: '{"Day 1": []}'}, racer)
+
+    assert db.add_itinerary_version(cur, 7, 21, '{"Day 1": ["b"]}') == 3
+    # the retry is encoded against the version that won the race
+    assert bases == [1, 2]
+    assert cur.versions[2] == "concurrent"
+
+
+def test_itinerary_version_gives_up_after_every_attempt():
+    def racer(versions):
+        versions[max(versions, default=0) + 1] = "concurrent"
+
+    db = makeDB()
+    db.get_itinerary_version = lambda trip_id, version: None
+    cur = FakeVersionCursor({}, racer)
+
+    with pytest.raises(psycopg2.DatabaseError):
+        db.add_itinerary_version(cur, 7, 22, '{"Day 1": []}')
+
+
+# Connection whose cursors execute 'statements' and whose poll() fails
+#   like a database restart
+class FakeListenConn():
+
+    def __init__(self, rows=None) -> None:
+        self.rows = rows or {}
+        self.statements = []
+        self.row = None
+        self.closed = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        self.row = self.rows.get(statement)
+
+    def fetchone(self):
+        return self.row
+
+    def poll(self):
+        raise psycopg2.OperationalError("server closed the connection")
+
+    def close(self):
+        self.closed = True
+
+
+class StopListening(BaseException):
+    pass
+
+
+def test_dropped_listener_reconnects_and_bypasses_the_conversation_cache(
+        monkeypatch):
+    stale = [{"role": "user", "content": "before the restart"}]
+    fresh = stale + [{"role": "user", "content": "another worker's turn"}]
+    conversation_cache.put(("conversation", "9"), stale)
+
+    db = makeDB()
+    trips = FakeListenConn({SQLcmd.select_conversation: (fresh, )})
+    db.trip_conn = lambda trip_id: trips
+
+    listens = [FakeListenConn(), FakeListenConn()]
+    polled_down = []
+    read_down = []
+
+    def select(rlist, wlist, xlist, timeout):
+        polled_down.append(set(postgresdb.listeners_down))
+        return (rlist, [], [])
+
+    def sleep(delay):
+        # the listener is down: the stale snapshot isn't used or replaced
+        read_down.append(db.get_chat_history(9))
+        if len(read_down) == len(listens):
+            raise StopListening()
+
+    monkeypatch.setattr(postgresdb, "listeners_down", set())
+    monkeypatch.setattr(postgresdb, "init_db_connection",
+                        lambda url: listens[len(polled_down)])
+    monkeypatch.setattr(postgresdb.select, "select", select)
+    monkeypatch.setattr(postgresdb.time, "sleep", sleep)
+
+    with pytest.raises(StopListening):
+        postgresdb.listen_cache_changes("postgresql://shard")
+
+    assert read_down == [fresh, fresh]
+    assert conversation_cache.get(("conversation", "9")) is None
+    # LISTEN again on the new connection, which is trusted again
+    assert [conn.statements for conn in listens] == \
+        [[SQLcmd.listen_cache_changes]] * 2
+    assert all(conn.closed for conn in listens)
+    assert polled_down == [set(), set()]
+    assert postgresdb.listeners_down == {"postgresql://shard"}
+
+    postgresdb.listeners_down.clear()
+    assert db.get_chat_history(9) == fresh
+    assert conversation_cache.get(("conversation", "9")) == fresh
+    conversation_cache.invalidate(("conversation", "9"))
@@ -0,0 +1,79 @@
+from service.cache.cache import db_cache
+from service.precompute import precompute
+from service.prompt import prompt
+
+
+# Stand-in for PostgresDB's trip buckets and base_itineraries
+class FakeBaseDB():
+
+    def __init__(self, buckets=()) -> None:
+        self.buckets = list(buckets)
+        self.bases = {}
+
+    def get_trip_buckets(self):
+        return self.buckets
+
+    def create_base_itinerary(self, destination, days_num, budget_bucket,
+                              prompt_version, content_text):
+        self.bases[(destination, days_num, budget_bucket,
+                    prompt_version)] = content_text
+        return 1
+
+    def get_base_itinerary(self, destination, days_num, budget_bucket,
+                           prompt_version):
+        return self.bases.get((destination, days_num, budget_bucket,
+                               prompt_version), "")
+
+
+def test_budget_bucket():
+    assert precompute.budgetBucket("$1,000") == "low"
+    assert precompute.budgetBucket("2000 USD") == "medium"
+    assert precompute.budgetBucket("$8,000.50") == "high"
+    assert precompute.budgetBucket("") == "any"
+    assert precompute.budgetBucket(None) == "any"
+
+
+def test_bucket_key_collapses_aliases_and_casing():
+    key = precompute.bucketKey("NYC", "5 days", "$1,200")
+    assert key == ("new york city, usa", "5", "low")
+    assert precompute.bucketKey("  new   york ", 5, "1200") == key
+
+
+def test_bucket_key_of_unknown_destination():
+    assert precompute.bucketKey("Smallville", None, "") == \
+        ("smallville", "7", "any")
+
+
+def test_mine_buckets_keeps_most_requested_spelling():
+    db = FakeBaseDB([("smallville", "3", "$900", 2),
+                     ("Smallville", "3", "$1,000", 5),
+                     ("NYC", "4", "$6,000", 1)])
+
+    buckets = precompute.mineBuckets(db, top=10)
+
+    assert buckets == [
+        (("smallville", "3", "low"), "Smallville", 7),
+        (("new york city, usa", "4", "high"), "New York City, USA", 1)
+    ]
+    assert precompute.mineBuckets(db, top=1) == buckets[:1]
+
+
+def test_generated_base_is_found_by_trip_lookup(fake_client):
+    db_cache.clear()
+    db = FakeBaseDB([("Smallville", "3", "$1,000", 5)])
+    p = prompt.Prompt()
+    p.client = fake_client
+    fake_client.reply = lambda request: '{"Day 1": []}'
+
+    buckets = precompute.mineBuckets(db, top=1)
+    assert precompute.generateBases(p, db, buckets) == 1
+
+    # the prompt keeps the destination's casing, only the key is lowercased
+    user_text = fake_client.requests[0]["messages"][-1]["content"][0]["text"]
+    assert "trip to Smallville." in user_text
+    assert list(db.bases) == [("smallville", "3", "low",
+                               precompute.PROMPT_VERSION)]
+
+    assert precompute.findBase(db, "SMALLVILLE ", "3 days", "$800") == \
+        '{"Day 1": []}'
+    assert precompute.findBase(db, "Smallville", "4", "$800") == ""
@@ -0,0 +1,18 @@
+from service.postgres.records import make_message, rows_to_messages
+
+
+def test_rows_to_messages_keeps_every_row_in_order():
+    rows = [("system", "text", "You plan trips.", "SYSTEMPROMPT"),
+            ("user", "text", "Plan Paris.", "USERPROMPT"),
+            ("assistant", "text", '{"Day 1": []}', "ITINERARY")]
+
+    messages = rows_to_messages(rows)
+
+    assert messages == [make_message(*row[:3]) for row in rows]
+    # every message owns its content list, appending to one changes no other
+    messages[0]["content"].append({"type": "text", "text": "more"})
+    assert [len(message["content"]) for message in messages] == [2, 1, 1]
+
+
+def test_rows_to_messages_of_no_rows():
+    assert rows_to_messages([]) == []
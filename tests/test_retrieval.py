@@ -0,0 +1,126 @@
+import numpy as np
+
+from service.retrieval import retrieval
+from service.routing import routing
+
+
+def vector(*values):
+    return retrieval.packVector(np.asarray(values, dtype=np.float32) /
+                                np.linalg.norm(values))
+
+
+# (message_id, role, content_type, content_text, message_category,
+#   embedding) rows like get_chat_turns'
+def turn(message_id, category, embedding=None, role="user"):
+    return (message_id, role, "text", f"message {message_id}", category,
+            embedding)
+
+
+def sentIds(messages):
+    return [int(message["content"][0]["text"].split()[1])
+            for message in messages]
+
+
+TURNS = [
+    turn(1, "SYSTEMPROMPT", role="system"),
+    turn(2, "USERPROMPT"),
+    turn(3, "ITINERARY", role="assistant"),
+    turn(4, "USERCHAT", vector(1, 0, 0)),
+    turn(5, "GPTCHAT", vector(0, 1, 0)),
+    turn(6, "USERCHAT", vector(0.9, 0.1, 0)),
+    turn(7, "GPTCHAT", vector(0, 0, 1)),
+    turn(8, "ITINERARY", role="assistant"),
+    turn(9, "USERCHAT", vector(0, 1, 0)),
+    turn(10, "GPTCHAT", vector(0, 1, 0)),
+]
+
+
+def test_select_context_picks_the_top_k_similar_turns():
+    messages = retrieval.selectContext(TURNS, [1, 0, 0], k=2)
+
+    # prompts, the 2 turns closest to the query, the latest itinerary and
+    #   the 2 latest turns, in the order they were written
+    assert sentIds(messages) == [1, 2, 4, 6, 8, 9, 10]
+
+
+def test_select_context_always_sends_prompts_and_latest_turns():
+    messages = retrieval.selectContext(TURNS, [0, 0, 1], k=0)
+
+    assert sentIds(messages) == [1, 2, 8, 9, 10]
+    assert messages[0]["role"] == "system"
+
+
+def test_select_context_sends_unembedded_turns():
+    turns = TURNS[:4] + [turn(5, "GPTCHAT")] + TURNS[5:]
+
+    messages = retrieval.selectContext(turns, [1, 0, 0], k=1)
+
+    assert sentIds(messages) == [1, 2, 4, 5, 8, 9, 10]
+
+
+def test_local_embed_is_unit_length_and_ranks_shared_words():
+    vectors = retrieval.localEmbed(["Louvre museum tickets",
+                                    "museum opening hours",
+                                    "ramen near the hotel",
+                                    ""])
+
+    assert vectors.dtype == np.float32
+    assert vectors.shape == (4, retrieval.LOCAL_DIMENSIONS)
+    assert np.allclose(np.linalg.norm(vectors[:3], axis=1), 1)
+    assert not vectors[3].any()
+    query = retrieval.localEmbed(["which museum"])[0]
+    assert vectors[1] @ query > vectors[2] @ query
+
+
+def test_local_embed_vectors_round_trip_as_float32_bytes():
+    vectors = retrieval.localEmbed(["a b c"])
+    data = retrieval.packVector(vectors[0])
+
+    assert len(data) == 4 * retrieval.LOCAL_DIMENSIONS
+    assert np.array_equal(retrieval.unpackVector(data), vectors[0])
+
+
+# Stand-in for PostgresDB's embedding reads and writes
+class FakeEmbeddingDB():
+
+    def __init__(self, turns) -> None:
+        self.turns = turns
+        self.models = []
+        self.stored = []
+
+    def get_unembedded_messages(self, trip_id, model):
+        self.models.append(model)
+        return [(1, "first"), (2, "second")]
+
+    def create_message_embeddings(self, rows):
+        self.stored.extend(rows)
+
+    def get_chat_turns(self, trip_id, model):
+        self.models.append(model)
+        return self.turns
+
+
+def test_embed_trip_stores_vectors_of_the_current_model():
+    db = FakeEmbeddingDB([])
+    model = routing.routing_table.getRoute("embedded")["model"]
+
+    count = retrieval.embedTrip(db, 7, embed=retrieval.localEmbed)
+
+    assert count == 2
+    assert db.models == [model]
+    assert [(row[0], row[1], row[2]) for row in db.stored] == \
+        [(1, 7, model), (2, 7, model)]
+
+
+def test_retrieve_context_reads_embeddings_of_the_current_model(
+        monkeypatch):
+    db = FakeEmbeddingDB(TURNS)
+    monkeypatch.setattr(retrieval, "RETRIEVAL_MIN_TOKENS", -1)
+    monkeypatch.setattr(retrieval, "getEmbed",
+                        lambda: lambda texts, postgressconn=None:
+                        [np.asarray([1, 0, 0], dtype=np.float32)])
+
+    messages = retrieval.retrieveContext(db, 7, [], "museum")
+
+    assert db.models == [routing.routing_table.getRoute("embedded")["model"]]
+    assert sentIds(messages)[:2] == [1, 2]
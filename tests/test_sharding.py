@@ -0,0 +1,262 @@
+from collections import Counter
+from types import SimpleNamespace
+import random
+import os
+
+import pytest
+
+from service.cache.cache import db_cache, conversation_cache
+from service.postgres import SQLcmd
+from service.postgres import sharding
+from service.postgres.postgresdb import PostgresDB
+
+TRIP_IDS = [sharding.allocate_trip_id() for _ in range(30000)]
+
+
+def owners(ring):
+    return {trip_id: ring.shard_for(trip_id) for trip_id in TRIP_IDS}
+
+
+def test_parse_shards():
+    assert sharding.parse_shards(" a=postgresql://db-a/p, b = postgresql://"
+                                 "db-b/p,broken,") == {
+        "a": "postgresql://db-a/p", "b": "postgresql://db-b/p"}
+    assert sharding.make_ring({}, set()) is None
+
+
+def test_ring_spreads_trips_evenly():
+    counts = Counter(owners(sharding.HashRing(["a", "b", "c"])).values())
+
+    assert set(counts) == {"a", "b", "c"}
+    for count in counts.values():
+        assert abs(count - 10000) < 1500
+
+
+def test_new_shard_only_takes_its_share_of_trips():
+    before = owners(sharding.HashRing(["a", "b", "c"]))
+    after = owners(sharding.HashRing(["a", "b", "c", "d"]))
+
+    moved = [trip_id for trip_id in TRIP_IDS
+             if before[trip_id] != after[trip_id]]
+    assert {after[trip_id] for trip_id in moved} == {"d"}
+    assert 0.15 < len(moved) / len(TRIP_IDS) < 0.35
+
+
+def test_draining_shard_gets_no_trips_and_others_keep_theirs():
+    shards = {"a": "url-a", "b": "url-b", "c": "url-c"}
+    before = owners(sharding.make_ring(shards, set()))
+    after = owners(sharding.make_ring(shards, {"c"}))
+
+    assert "c" not in set(after.values())
+    for trip_id in TRIP_IDS:
+        if before[trip_id] != "c":
+            assert after[trip_id] == before[trip_id]
+
+
+def test_trip_id_layout(monkeypatch):
+    monkeypatch.setattr(sharding.time, "time",
+                        lambda: sharding.ID_EPOCH + 1000)
+    monkeypatch.setattr(sharding.random, "getrandbits",
+                        lambda bits: (1 << bits) - 1)
+
+    trip_id = sharding.allocate_trip_id()
+
+    assert trip_id >> sharding.ID_RANDOM_BITS == 1000
+    assert trip_id & ((1 << sharding.ID_RANDOM_BITS) - 1) == \
+        (1 << sharding.ID_RANDOM_BITS) - 1
+
+
+def test_trip_ids_fit_javascript_numbers_for_decades():
+    seconds = 80 * 365 * 24 * 3600
+    largest = (seconds << sharding.ID_RANDOM_BITS) | \
+        ((1 << sharding.ID_RANDOM_BITS) - 1)
+    assert largest < 2 ** 53
+    assert all(0 < trip_id < 2 ** 53 for trip_id in TRIP_IDS)
+
+
+# Shard with an in-memory trips table, changes are kept on commit
+class FakeShard():
+
+    def __init__(self, trips=()) -> None:
+        self.trips = {trip[0]: trip for trip in trips}
+        self.pending = dict(self.trips)
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeShardCursor(self)
+
+    def commit(self):
+        self.trips = dict(self.pending)
+        self.commits += 1
+
+    def rollback(self):
+        self.pending = dict(self.trips)
+        self.rollbacks += 1
+
+
+class FakeShardCursor():
+
+    def __init__(self, shard) -> None:
+        self.shard = shard
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, params):
+        trips = self.shard.pending
+        if statement is SQLcmd.select_trip:
+            self.row = trips.get(params[0])
+        elif statement is SQLcmd.insert_shard_trips_table:
+            self.row = None
+            if params[0] not in trips:
+                trips[params[0]] = tuple(params)
+                self.row = (params[0], )
+        elif statement is SQLcmd.delete_trip:
+            trips.pop(params[0], None)
+        else:
+            raise AssertionError(statement)
+
+    def fetchone(self):
+        return self.row
+
+
+TRIP = (42, "user", "Paris", "3", "2", "$1,000", "museums")
+
+
+def makeShardedDB(source, target):
+    db = PostgresDB.__new__(PostgresDB)
+    db.conn = None
+    db.replica_conn = None
+    db.shard_conns = {"a": source, "b": target}
+    db.copied = []
+    db.copy_trip = lambda src, dst, trip_id: db.copied.append(trip_id)
+    return db
+
+
+def test_move_trip_copies_then_deletes_the_source():
+    source, target = FakeShard([TRIP]), FakeShard()
+    db = makeShardedDB(source, target)
+
+    assert db.move_trip(42, "a", "b")
+
+    assert db.copied == [42]
+    assert target.trips == {42: TRIP}
+    assert source.trips == {}
+
+
+def test_move_trip_rerun_after_the_copy_only_deletes_the_source():
+    source, target = FakeShard([TRIP]), FakeShard([TRIP])
+    db = makeShardedDB(source, target)
+
+    assert db.move_trip(42, "a", "b")
+
+    # the conflict means an earlier run committed the copy
+    assert db.copied == []
+    assert source.trips == {}
+    assert target.trips == {42: TRIP}
+
+
+def test_move_trip_keeps_a_trip_whose_id_is_taken_on_the_target():
+    other = (42, "someone else", "Rome", "5", "1", "$900", "")
+    source, target = FakeShard([TRIP]), FakeShard([other])
+    db = makeShardedDB(source, target)
+
+    assert not db.move_trip(42, "a", "b")
+
+    assert db.copied == []
+    assert source.trips == {42: TRIP}
+    assert target.trips == {42: other}
+    assert source.commits == target.commits == 0
+
+
+def test_move_trip_of_a_missing_trip():
+    db = makeShardedDB(FakeShard(), FakeShard())
+    assert not db.move_trip(random.getrandbits(20), "a", "b")
+
+
+# two empty databases to move trips between, the cross-shard SQL isn't
+#   covered by the fakes above
+#   e.g. "a=postgresql://localhost/shard_a,b=postgresql://localhost/shard_b"
+TEST_SHARDS = sharding.parse_shards(
+    os.getenv('TEST_DATABASE_SHARD_URLS', ''))
+
+
+@pytest.fixture
+def shard_db(monkeypatch):
+    if len(TEST_SHARDS) < 2:
+        pytest.skip("TEST_DATABASE_SHARD_URLS needs two databases")
+    source, target = list(TEST_SHARDS)[:2]
+    owner = SimpleNamespace(name=source)
+    monkeypatch.setattr(sharding, "SHARDS", TEST_SHARDS)
+    monkeypatch.setattr(sharding, "ring", SimpleNamespace(
+        shard_for=lambda trip_id: owner.name))
+
+    db = PostgresDB.__new__(PostgresDB)
+    db.conn = None
+    db.replica_conn = None
+    db.shard_conns = {}
+    for name in (source, target):
+        db.create_shard_tables(db.shard_conn(name))
+    db_cache.clear()
+    conversation_cache.clear()
+    yield db, owner, source, target
+
+    for name in (source, target):
+        with db.shard_conn(name).cursor() as cur:
+            cur.execute("DELETE FROM trips WHERE user_id = 'shard-test';")
+        db.shard_conn(name).commit()
+    db.close_db_connection()
+
+
+def tripRows(db, shard, trip_id):
+    with db.shard_conn(shard).cursor() as cur:
+        counts = []
+        for table in ("trips", "messages", "conversations",
+                      "itinerary_versions"):
+            cur.execute(f"SELECT COUNT(*) FROM {table} WHERE trip_id=%s;",
+                        (trip_id, ))
+            counts.append(cur.fetchone()[0])
+    return counts
+
+
+def test_move_trip_between_databases(shard_db):
+    db, owner, source, target = shard_db
+    trip_id = db.create_shard_trip("Paris", "3", "2", "$1,000", "",
+                                   user_id="shard-test")
+    db.create_message_to_db(trip_id, "user", "text", "Plan my trip",
+                            "USERPROMPT")
+    db.create_message_to_db(trip_id, "assistant", "text",
+                            '{"Day 1": ["Louvre"]}', "ITINERARY")
+    history = db.get_chat_history(trip_id)
+
+    assert db.move_trip(trip_id, source, target)
+
+    owner.name = target
+    db_cache.clear()
+    conversation_cache.clear()
+    assert tripRows(db, source, trip_id) == [0, 0, 0, 0]
+    assert tripRows(db, target, trip_id) == [1, 2, 1, 1]
+    assert db.get_chat_history(trip_id) == history
+    assert db.get_itinerary_version(trip_id, 1) == '{"Day 1": ["Louvre"]}'
+
+
+def test_move_trip_keeps_its_data_when_the_id_is_taken(shard_db):
+    db, owner, source, target = shard_db
+    trip_id = db.create_shard_trip("Paris", "3", "2", "$1,000", "",
+                                   user_id="shard-test")
+    db.create_message_to_db(trip_id, "user", "text", "Plan my trip",
+                            "USERPROMPT")
+    with db.shard_conn(target).cursor() as cur:
+        cur.execute(SQLcmd.insert_shard_trips_table,
+                    (trip_id, "shard-test", "Rome", "5", "1", "$900", ""))
+    db.shard_conn(target).commit()
+
+    assert not db.move_trip(trip_id, source, target)
+
+    assert tripRows(db, source, trip_id) == [1, 1, 1, 0]
+    assert tripRows(db, target, trip_id) == [1, 0, 0, 0]